@@ -0,0 +1,70 @@
+"""
+Import-time benchmark.
+
+Imports each target module in a fresh interpreter several times and reports the median wall
+time plus which heavy third-party packages got pulled in along the way.
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --module vibescraper.vibe_search --runs 20 --importtime
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['openai', 'tiktoken', 'sqlalchemy', 'bs4', 'googleapiclient', 'numpy', 'pandas', 'html5lib']
+
+DEFAULT_TARGETS = ['vibescraper', 'vibescraper.config', 'vibescraper.vibe_search']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'heavy': heavy}}))
+"""
+
+
+def probe(module, env):
+    code = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure vibescraper import cost')
+    parser.add_argument('--module', action='append', help='module to import (repeatable)')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--importtime', action='store_true', help='also print the 15 slowest imports from -X importtime')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.join(ROOT, 'src') + os.pathsep + env.get('PYTHONPATH', '')
+
+    print(f"{'module':<28}{'median ms':>12}{'min ms':>10}  heavy imports")
+    for module in args.module or DEFAULT_TARGETS:
+        results = [probe(module, env) for _ in range(args.runs)]
+        times = [r['seconds'] * 1000 for r in results]
+        heavy = ', '.join(results[-1]['heavy']) or '-'
+        print(f'{module:<28}{statistics.median(times):>12.1f}{min(times):>10.1f}  {heavy}')
+
+        if args.importtime:
+            out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                 env=env, capture_output=True, text=True)
+            rows = []
+            for line in out.stderr.splitlines():
+                if not line.startswith('import time:') or 'cumulative' in line:
+                    continue
+                _, cumulative_us, name = line.split('|')
+                rows.append((int(cumulative_us), name.strip()))
+            for cumulative_us, name in sorted(rows, reverse=True)[:15]:
+                print(f'    {cumulative_us / 1000:>8.1f} ms  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""
+Offline, reproducible benchmarks for the vibescraper pipeline.
+
+Everything runs against benchmarks/fake_services.py: recorded HTML pages, Brave-style search
+results and an OpenAI-compatible endpoint with configurable latency and deterministic embeddings.
+
+Benchmarks:
+    chunker             HTMLSemanticChunker.split_html_by_semantics over the recorded pages
+    page_top_similar    PageEmbeddingProcessor._find_top_similar (similarity + page summary)
+    combined_top_similar CombinedResultsProcessor._find_top_similar (similarity + combined summary)
+    vibe_search         the whole pipeline, end to end
+
+Each reports latency percentiles, throughput and peak traced memory, and can be compared
+against a saved baseline:
+
+    python benchmarks/bench_pipeline.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench_pipeline.py --baseline benchmarks/baseline.json --fail-on-regression
+
+Note: tiktoken downloads its encoding on first use; run once with network access (or set
+TIKTOKEN_CACHE_DIR to a populated cache) for fully offline runs.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeServices
+
+
+def summarize_samples(samples, items_per_run=1):
+    samples = np.array(samples)
+    total = samples.sum()
+    return {
+        'runs': len(samples),
+        'mean': float(samples.mean()),
+        'min': float(samples.min()),
+        'max': float(samples.max()),
+        'p50': float(np.percentile(samples, 50)),
+        'p90': float(np.percentile(samples, 90)),
+        'p99': float(np.percentile(samples, 99)),
+        'throughput': float(len(samples) * items_per_run / total) if total else None,
+    }
+
+
+async def measure(make_call, runs, warmup=1, items_per_run=1):
+    """Time `await make_call()` runs times, then once more under tracemalloc for peak memory"""
+    for _ in range(warmup):
+        await make_call()
+
+    samples = []
+    for _ in range(runs):
+        gc.collect()
+        start = time.perf_counter()
+        await make_call()
+        samples.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    await make_call()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = summarize_samples(samples, items_per_run)
+    stats['peak_memory_bytes'] = peak
+    return stats
+
+
+async def bench_chunker(services, runs):
+    from vibescraper.html_parser import process_html_with_semantic_chunker
+
+    pages = [body.decode('utf-8') for body in services.pages.values()]
+
+    async def call():
+        for html in pages:
+            process_html_with_semantic_chunker(html)
+
+    stats = await measure(call, runs, items_per_run=len(pages))
+    stats['unit'] = 'pages/s'
+    stats['bytes_per_run'] = sum(len(p) for p in pages)
+    return stats
+
+
+def _synthetic_chunks(services, n_chunks):
+    from vibescraper.html_parser import process_html_with_semantic_chunker
+
+    chunks = []
+    for body in services.pages.values():
+        chunks.extend(process_html_with_semantic_chunker(body.decode('utf-8')))
+    return [chunks[i % len(chunks)] + f' #{i}' for i in range(n_chunks)]
+
+
+async def bench_page_top_similar(services, runs, n_chunks, dimensions, top_k):
+    from vibescraper.page_embedder import PageEmbeddingProcessor, embedding_matrix
+
+    chunks = _synthetic_chunks(services, n_chunks)
+    embeddings = embedding_matrix([services.embedder.embed(c, dimensions) for c in chunks])
+    query_embedding = services.embedder.embed('software job market hiring salaries', dimensions).tolist()
+
+    async def call():
+        processor = PageEmbeddingProcessor(f'{services.base_url}/pages/bench', 'software job market', top_k=top_k,
+                                           text_model='gpt-4o-mini', dimensions=dimensions)
+        processor.chunks = chunks
+        processor.embeddings = embeddings
+        await processor._find_top_similar(query_embedding, k=top_k)
+
+    stats = await measure(call, runs)
+    stats['unit'] = 'pages/s'
+    stats['chunks'] = n_chunks
+    return stats
+
+
+async def bench_combined_top_similar(services, runs, n_pages, dimensions, top_k):
+    from vibescraper.page_embedder import PageEmbeddingProcessor, CombinedResultsProcessor
+
+    chunks = _synthetic_chunks(services, n_pages * top_k)
+    query_embedding = services.embedder.embed('software job market hiring salaries', dimensions).tolist()
+
+    pages = []
+    for p in range(n_pages):
+        page = PageEmbeddingProcessor(f'{services.base_url}/pages/bench-{p}', 'software job market', top_k=top_k,
+                                      dimensions=dimensions)
+        page.query_embedding = query_embedding
+        page.page_summary = f'Summary of page {p}: ' + ' '.join(chunks[p * top_k:(p + 1) * top_k])[:2000]
+        page.top_results = [{
+            'chunk_text': chunk,
+            'embedding': services.embedder.embed(chunk, dimensions).tolist(),
+            'similarity': 0.0,
+            'rank': r + 1,
+        } for r, chunk in enumerate(chunks[p * top_k:(p + 1) * top_k])]
+        pages.append(page)
+
+    async def call():
+        combined = CombinedResultsProcessor('software job market', text_model='gpt-4o-mini',
+                                            dimensions=dimensions, top_k=top_k)
+        for page in pages:
+            combined.add_page_results(page)
+        await combined.process_combined_results()
+
+    stats = await measure(call, runs)
+    stats['unit'] = 'runs/s'
+    stats['pages'] = n_pages
+    return stats
+
+
+async def bench_vibe_search(services, runs, domain_count, top_k):
+    import vibescraper.vibe_search as vibe_search_module
+    from vibescraper.fetch_scheduler import FetchScheduler
+
+    vibe_search_module.search_engine = 'brave'
+
+    async def call():
+        scheduler = FetchScheduler(min_delay=0, per_host_concurrency=domain_count)
+        try:
+            await vibe_search_module.vibe_search('What is the state of the software development job market in 2025?',
+                                                 text_model='gpt-4o-mini', top_k=top_k,
+                                                 domain_count=domain_count, scheduler=scheduler)
+        finally:
+            scheduler.close()
+
+    stats = await measure(call, runs, items_per_run=1)
+    stats['unit'] = 'queries/s'
+    stats['pages_per_query'] = domain_count
+    return stats
+
+
+def compare(results, baseline, threshold):
+    """Print p50/throughput deltas against a baseline; return the names of regressed benchmarks"""
+    regressions = []
+    print(f"\n{'benchmark':<24}{'p50 (ms)':>12}{'baseline':>12}{'change':>10}{'peak MB':>10}")
+    for name, stats in results['benchmarks'].items():
+        base = baseline.get('benchmarks', {}).get(name)
+        p50 = stats['p50'] * 1000
+        peak = stats['peak_memory_bytes'] / 1e6
+        if not base:
+            print(f'{name:<24}{p50:>12.2f}{"-":>12}{"-":>10}{peak:>10.2f}')
+            continue
+        base_p50 = base['p50'] * 1000
+        change = (p50 - base_p50) / base_p50 if base_p50 else 0.0
+        flag = ' !' if change > threshold else ''
+        print(f'{name:<24}{p50:>12.2f}{base_p50:>12.2f}{change:>+10.1%}{peak:>10.2f}{flag}')
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+async def run(args, services):
+    benchmarks = {}
+    selected = set(args.only or ['chunker', 'page_top_similar', 'combined_top_similar', 'vibe_search'])
+
+    if 'chunker' in selected:
+        benchmarks['chunker'] = await bench_chunker(services, args.runs)
+    if 'page_top_similar' in selected:
+        benchmarks['page_top_similar'] = await bench_page_top_similar(
+            services, args.runs, args.chunks, args.dimensions, args.top_k)
+    if 'combined_top_similar' in selected:
+        benchmarks['combined_top_similar'] = await bench_combined_top_similar(
+            services, args.runs, args.domain_count, args.dimensions, args.top_k)
+    if 'vibe_search' in selected:
+        benchmarks['vibe_search'] = await bench_vibe_search(services, args.runs, args.domain_count, args.top_k)
+    return benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline vibescraper benchmarks')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--only', nargs='*', choices=['chunker', 'page_top_similar', 'combined_top_similar', 'vibe_search'])
+    parser.add_argument('--domain-count', type=int, default=4)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--chunks', type=int, default=200, help='chunks per page for page_top_similar')
+    parser.add_argument('--dimensions', type=int, default=1536)
+    parser.add_argument('--llm-latency', type=float, default=0.0)
+    parser.add_argument('--embedding-latency', type=float, default=0.0)
+    parser.add_argument('--page-latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--llm-cache', action='store_true', help='leave the LLM response cache enabled')
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', help='compare against this results JSON')
+    parser.add_argument('--save-baseline', help='write results JSON as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='p50 slowdown counted as a regression')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    services = FakeServices(llm_latency=args.llm_latency, embedding_latency=args.embedding_latency,
+                            page_latency=args.page_latency, jitter=args.jitter).start()
+
+    # Must be set before vibescraper is imported: config builds the OpenAI clients from the environment
+    os.environ.update(services.environ())
+    if not args.llm_cache:
+        os.environ['VIBESCRAPER_LLM_CACHE_DISABLED'] = '1'
+
+    # The pipeline writes its db, cache and JSON output to the working directory
+    workdir = tempfile.mkdtemp(prefix='vibescraper-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        benchmarks = asyncio.run(run(args, services))
+    finally:
+        os.chdir(cwd)
+        services.stop()
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'settings': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'save_baseline')},
+        'requests': services.counts,
+        'benchmarks': benchmarks,
+    }
+
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=4)
+            print(f'Wrote {path}')
+
+    if regressions and args.fail_on_regression:
+        print(f'Regressions: {", ".join(regressions)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+"""
+Local stand-ins for everything vibe_search talks to over the network.
+
+One threaded HTTP server on localhost serves:
+    /pages/<name>               recorded HTML pages from fixtures/pages
+    /robots.txt                 an allow-all robots.txt
+    /res/v1/web/search          Brave-style web search results pointing at /pages/...
+    /v1/embeddings              OpenAI-compatible embeddings (deterministic bag-of-words vectors)
+    /v1/chat/completions        OpenAI-compatible chat completions (deterministic text, optional streaming)
+    /v1/files, /v1/batches      OpenAI-compatible Batch API: uploaded JSONL request files are answered with
+                                the same embeddings and completions, batch_latency seconds after submission
+
+Point the package at it with FakeServices.environ() before importing vibescraper.
+"""
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class DeterministicEmbedder:
+    """Bag-of-words embeddings: each word gets a fixed random vector, so overlapping texts score as similar"""
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self._word_vectors = {}
+        self._lock = threading.Lock()
+
+    def _word_vector(self, word, dimensions):
+        key = (word, dimensions)
+        vector = self._word_vectors.get(key)
+        if vector is None:
+            digest = hashlib.sha256(f'{self.seed}:{word}'.encode('utf-8')).digest()
+            rng = np.random.default_rng(int.from_bytes(digest[:8], 'little'))
+            vector = rng.standard_normal(dimensions).astype(np.float32)
+            with self._lock:
+                self._word_vectors[key] = vector
+        return vector
+
+    def embed(self, text, dimensions):
+        words = [w for w in text.lower().split() if w.isalnum()] or ['<empty>']
+        total = np.zeros(dimensions, dtype=np.float32)
+        for word in words:
+            total += self._word_vector(word, dimensions)
+        norm = np.linalg.norm(total)
+        return total / norm if norm else total
+
+
+class FakeServices:
+    """
+    Start with start() (or use as a context manager). Latencies are in seconds; jitter is a
+    deterministic +/- fraction so repeated runs see the same latency sequence.
+    """
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR, llm_latency=0.0, embedding_latency=0.0,
+                 page_latency=0.0, search_latency=0.0, jitter=0.0, stream_chunk_words=8, seed=0,
+                 batch_latency=0.0):
+        self.fixtures_dir = fixtures_dir
+        self.llm_latency = llm_latency
+        self.embedding_latency = embedding_latency
+        self.page_latency = page_latency
+        self.search_latency = search_latency
+        self.batch_latency = batch_latency
+        self.jitter = jitter
+        self.stream_chunk_words = stream_chunk_words
+        self.embedder = DeterministicEmbedder(seed)
+        self.rng = np.random.default_rng(seed)
+        self.counts = {}
+        self._lock = threading.Lock()
+        self.pages = self._load_pages()
+        self.search_results = self._load_search_results()
+        self.files = {}
+        self.batches = {}
+        self.server = None
+        self.thread = None
+
+    def _load_pages(self):
+        pages = {}
+        pages_dir = os.path.join(self.fixtures_dir, 'pages')
+        for name in sorted(os.listdir(pages_dir)):
+            if name.endswith('.html'):
+                with open(os.path.join(pages_dir, name), 'rb') as f:
+                    pages[name] = f.read()
+        return pages
+
+    def _load_search_results(self):
+        path = os.path.join(self.fixtures_dir, 'search_results.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return {'default': list(self.pages)}
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def environ(self):
+        """Environment variables that point vibescraper at these services"""
+        return {
+            'OPENAI_API_KEY': 'sk-fake',
+            'OPENAI_BASE_URL': f'{self.base_url}/v1',
+            'BRAVE_API_KEY': 'fake',
+            'BRAVE_API_HOST': self.base_url,
+        }
+
+    def page_urls(self):
+        return [f'{self.base_url}/pages/{name}' for name in self.pages]
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def sleep(self, latency):
+        if latency <= 0:
+            return
+        if self.jitter:
+            with self._lock:
+                latency *= 1 + self.jitter * (2 * self.rng.random() - 1)
+        time.sleep(latency)
+
+    def start(self):
+        services = self
+
+        class Handler(_Handler):
+            pass
+        Handler.services = services
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    services = None
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        services = self.services
+
+        if parts.path == '/robots.txt':
+            return self._send(200, b'User-agent: *\nAllow: /\n', 'text/plain')
+
+        if parts.path.startswith('/pages/'):
+            services.count('page')
+            body = services.pages.get(parts.path[len('/pages/'):])
+            if body is None:
+                return self._send(404, b'not found', 'text/plain')
+            services.sleep(services.page_latency)
+            etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            return self._send(200, body, 'text/html; charset=utf-8', {'ETag': etag})
+
+        if parts.path == '/res/v1/web/search':
+            services.count('search')
+            services.sleep(services.search_latency)
+            params = parse_qs(parts.query)
+            query = params.get('q', [''])[0]
+            count = int(params.get('count', ['10'])[0])
+            names = services.search_results.get(query) or services.search_results['default']
+            results = []
+            for i in range(count):
+                name = names[i % len(names)]
+                copy = i // len(names)
+                url = f'{services.base_url}/pages/{name}' + (f'?copy={copy}' if copy else '')
+                results.append({'title': name, 'url': url, 'description': ''})
+            return self._send(200, {'type': 'search', 'web': {'type': 'search', 'results': results}})
+
+        if parts.path.startswith('/v1/files/') and parts.path.endswith('/content'):
+            data = services.files.get(parts.path[len('/v1/files/'):-len('/content')])
+            if data is None:
+                return self._send(404, {'error': {'message': 'no such file'}})
+            return self._send(200, data, 'application/octet-stream')
+
+        if parts.path.startswith('/v1/batches/'):
+            batch = self._run_batch(parts.path[len('/v1/batches/'):])
+            if batch is None:
+                return self._send(404, {'error': {'message': 'no such batch'}})
+            return self._send(200, batch)
+
+        return self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        if parts.path == '/v1/embeddings':
+            return self._embeddings(self._json_body())
+        if parts.path == '/v1/chat/completions':
+            return self._chat(self._json_body())
+        if parts.path == '/v1/files':
+            return self._upload()
+        if parts.path == '/v1/batches':
+            return self._create_batch(self._json_body())
+        return self._send(404, {'error': {'message': 'not found'}})
+
+    # --------- Batch API ---------
+
+    def _upload(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        head = f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n".encode('ascii')
+        message = BytesParser(policy=HTTP).parsebytes(head + self.rfile.read(length))
+        fields = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                  for part in message.iter_parts()}
+        file_id = f'file-{uuid.uuid4().hex[:24]}'
+        services = self.services
+        services.count('file_upload')
+        services.files[file_id] = fields['file']
+        return self._send(200, {'id': file_id, 'object': 'file', 'bytes': len(fields['file']),
+                                'created_at': int(time.time()), 'filename': 'batch.jsonl',
+                                'purpose': fields.get('purpose', b'batch').decode('utf-8'), 'status': 'processed'})
+
+    def _create_batch(self, request):
+        services = self.services
+        services.count('batch_create')
+        if request.get('input_file_id') not in services.files:
+            return self._send(400, {'error': {'message': 'unknown input_file_id'}})
+        batch_id = f'batch_{uuid.uuid4().hex[:24]}'
+        batch = {
+            'id': batch_id, 'object': 'batch', 'endpoint': request['endpoint'],
+            'input_file_id': request['input_file_id'], 'completion_window': request.get('completion_window', '24h'),
+            'status': 'in_progress', 'created_at': int(time.time()), 'output_file_id': None, 'error_file_id': None,
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0}, 'metadata': request.get('metadata'),
+        }
+        with services._lock:
+            services.batches[batch_id] = (batch, time.monotonic())
+        return self._send(200, batch)
+
+    def _run_batch(self, batch_id):
+        """The batch, answered once batch_latency has passed since it was created"""
+        services = self.services
+        services.count('batch_retrieve')
+        with services._lock:
+            if batch_id not in services.batches:
+                return None
+            batch, created = services.batches[batch_id]
+            if batch['status'] != 'in_progress' or time.monotonic() - created < services.batch_latency:
+                return batch
+
+            outputs, errors = [], []
+            for line in services.files[batch['input_file_id']].decode('utf-8').splitlines():
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                if request['url'] == '/v1/embeddings':
+                    body = self._embedding_body(request['body'])
+                elif request['url'] == '/v1/chat/completions':
+                    body = self._chat_body(request['body'])
+                else:
+                    errors.append({'id': f'batch_req_{uuid.uuid4().hex[:16]}', 'custom_id': request['custom_id'],
+                                   'response': None, 'error': {'code': 'invalid_url', 'message': request['url']}})
+                    continue
+                outputs.append({'id': f'batch_req_{uuid.uuid4().hex[:16]}', 'custom_id': request['custom_id'],
+                                'response': {'status_code': 200, 'request_id': uuid.uuid4().hex, 'body': body},
+                                'error': None})
+
+            for key, items in (('output_file_id', outputs), ('error_file_id', errors)):
+                if items:
+                    file_id = f'file-{uuid.uuid4().hex[:24]}'
+                    services.files[file_id] = ''.join(json.dumps(item) + '\n' for item in items).encode('utf-8')
+                    batch[key] = file_id
+            batch['request_counts'] = {'total': len(outputs) + len(errors), 'completed': len(outputs),
+                                       'failed': len(errors)}
+            batch['status'] = 'completed'
+            batch['completed_at'] = int(time.time())
+            return batch
+
+    # --------- synchronous endpoints ---------
+
+    def _embeddings(self, request):
+        services = self.services
+        services.count('embeddings')
+        services.sleep(services.embedding_latency)
+        return self._send(200, self._embedding_body(request))
+
+    def _embedding_body(self, request):
+        services = self.services
+        inputs = request['input']
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        dimensions = request.get('dimensions') or 1536
+        data = []
+        tokens = 0
+        for i, text in enumerate(inputs):
+            vector = services.embedder.embed(text, dimensions)
+            tokens += len(text.split())
+            if request.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.astype(np.float32).tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+        return {
+            'object': 'list',
+            'data': data,
+            'model': request.get('model'),
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        }
+
+    def _completion_text(self, request):
+        prompt = request['messages'][-1]['content']
+        words = prompt.split()
+        source = next((w for w in words if w.startswith('http')), 'http://localhost/')
+        excerpt = ' '.join(words[-40:])
+        return f'Summary: {excerpt} (reference: {" ".join(words[-6:])}, source: {source.rstrip(":,")})'
+
+    def _chat_body(self, request):
+        text = self._completion_text(request)
+        prompt_tokens = sum(len(m['content'].split()) for m in request['messages'])
+        completion_tokens = len(text.split())
+        return {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+    def _chat(self, request):
+        services = self.services
+        services.count('chat')
+        services.sleep(services.llm_latency)
+
+        text = self._completion_text(request)
+        prompt_tokens = sum(len(m['content'].split()) for m in request['messages'])
+        completion_tokens = len(text.split())
+        created = int(time.time())
+
+        if not request.get('stream'):
+            return self._send(200, self._chat_body(request))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        words = text.split(' ')
+        step = services.stream_chunk_words
+        for start in range(0, len(words), step):
+            delta = ' '.join(words[start:start + step]) + (' ' if start + step < len(words) else '')
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': created,
+                     'model': request.get('model'),
+                     'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}]}
+            self._write_chunk(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        if (request.get('stream_options') or {}).get('include_usage'):
+            chunk = {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': created,
+                     'model': request.get('model'), 'choices': [],
+                     'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                               'total_tokens': prompt_tokens + completion_tokens}}
+            self._write_chunk(f'data: {json.dumps(chunk)}\n\n'.encode('utf-8'))
+        self._write_chunk(b'data: [DONE]\n\n')
+        self._write_chunk(b'')
+
+    def _write_chunk(self, data):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
@@ -0,0 +1,92 @@
+import heapq
+
+
+class AdaptiveStop:
+    """
+    Decides, as pages finish, whether more pages are worth processing.
+
+    The quality of a search is scored as the mean similarity of the best top_k chunks found so far
+    across all pages (the pool the combined summary is built from). Each finished page either
+    lifts that score or not; once the score is good enough (at least `weak_score`) and `patience`
+    pages in a row improve it by less than `min_improvement` (after at least `min_pages` pages)
+    the remaining pages are cancelled. Pages without results (failed or empty fetches) don't
+    count either way. If every page has finished and the score is still below `weak_score`,
+    more urls are searched for, up to `max_urls` in total.
+    """
+
+    def __init__(self, top_k=5, min_pages=2, patience=2, min_improvement=0.01, weak_score=0.4,
+                 max_urls=20, extend_by=5, max_concurrent_pages=3):
+        """
+        Args:
+            top_k - size of the combined chunk pool the score is computed over
+            min_pages - pages that always finish before stopping early is considered
+            patience - consecutive non-improving pages before the rest are cancelled
+            min_improvement - score gain a page must bring to count as an improvement
+            weak_score - score needed before stopping early; below it, once all urls are done, more urls are fetched
+            max_urls - upper bound on urls processed, including extra ones
+            extend_by - urls added each time results are weak
+            max_concurrent_pages - pages processed at once, so later urls are only started when needed
+        """
+        self.top_k = top_k
+        self.min_pages = min_pages
+        self.patience = patience
+        self.min_improvement = min_improvement
+        self.weak_score = weak_score
+        self.max_urls = max_urls
+        self.extend_by = extend_by
+        self.max_concurrent_pages = max_concurrent_pages
+
+        self._best = []
+        self.score = 0.0
+        self.pages = 0
+        self.empty_pages = 0
+        self.stale_pages = 0
+        self.stopped_early = False
+        self.extensions = 0
+        self.history = []
+
+    def observe(self, similarities):
+        """Record the chunk similarities of a finished page; returns the score improvement it brought"""
+        if not similarities:
+            # A page that failed or had no text says nothing about whether more pages would help
+            self.empty_pages += 1
+            return 0.0
+
+        for similarity in similarities:
+            if len(self._best) < self.top_k:
+                heapq.heappush(self._best, similarity)
+            elif similarity > self._best[0]:
+                heapq.heapreplace(self._best, similarity)
+
+        previous = self.score
+        self.score = sum(self._best) / self.top_k if self._best else 0.0
+        improvement = self.score - previous
+
+        self.pages += 1
+        if improvement < self.min_improvement:
+            self.stale_pages += 1
+        else:
+            self.stale_pages = 0
+        self.history.append(round(self.score, 4))
+        return improvement
+
+    def should_stop(self):
+        if self.pages >= self.min_pages and self.stale_pages >= self.patience and self.score >= self.weak_score:
+            self.stopped_early = True
+        return self.stopped_early
+
+    def extra_urls(self, urls_seen):
+        """How many more urls to search for now that every page finished (0 when results are good enough)"""
+        if self.stopped_early or self.score >= self.weak_score:
+            return 0
+        return max(0, min(self.extend_by, self.max_urls - urls_seen))
+
+    def summary(self):
+        return {
+            'score': round(self.score, 4),
+            'pages': self.pages,
+            'empty_pages': self.empty_pages,
+            'stopped_early': self.stopped_early,
+            'extensions': self.extensions,
+            'history': self.history,
+        }
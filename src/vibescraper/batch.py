@@ -0,0 +1,158 @@
+import asyncio
+import json
+import os
+import time
+from vibescraper.resources import SearchResources
+from vibescraper.vibe_search import vibe_search
+
+
+def load_queries(path):
+    """
+    Read queries from a file: one query per line, or JSON lines with a "query" field.
+    Blank lines and lines starting with # are skipped.
+    """
+    queries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                line = json.loads(line)['query']
+            queries.append(line)
+    return queries
+
+
+async def vibe_search_batch(queries, max_concurrent_queries=4, max_concurrent_pages=8, max_concurrent_requests=16,
+                            resources=None, output_path=None, **search_kwargs):
+    """
+    Run many vibe_search queries concurrently under global limits.
+
+    All queries share one SearchResources: the HTTP pool and per-host politeness state, the DB
+    engine, the OpenAI request limit and the per-url page cache, so a url returned for several
+    queries is fetched and chunked once. Identical queries are only run once.
+
+    Args:
+        queries - iterable of query strings
+        max_concurrent_queries - searches running at the same time
+        max_concurrent_pages - pages embedded/summarized at the same time, across all searches
+        max_concurrent_requests - concurrent OpenAI requests, across all searches
+        resources - existing SearchResources to use instead of creating (and closing) one
+        output_path - optional JSONL file; each result is appended as soon as its query finishes
+        search_kwargs - passed through to vibe_search (text_model, top_k, domain_count, ...)
+
+    Returns a list of {'query', 'summary', 'error', 'seconds'} dicts in input order.
+    """
+    queries = list(queries)
+    owns_resources = resources is None
+    if owns_resources:
+        resources = SearchResources(max_concurrent_pages=max_concurrent_pages,
+                                    max_concurrent_requests=max_concurrent_requests)
+
+    if output_path and os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    semaphore = asyncio.Semaphore(max_concurrent_queries)
+    runs = {}
+
+    async def run_query(query):
+        async with semaphore:
+            start = time.perf_counter()
+            result = {'query': query, 'summary': None, 'error': None}
+            try:
+                result['summary'] = await vibe_search(query, resources=resources, **search_kwargs)
+            except Exception as e:
+                print(f"Query failed: {query}: {e}")
+                result['error'] = repr(e)
+            result['seconds'] = time.perf_counter() - start
+
+            if output_path:
+                with open(output_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(result, ensure_ascii=False) + '\n')
+            return result
+
+    try:
+        for query in queries:
+            if query not in runs:
+                runs[query] = asyncio.ensure_future(run_query(query))
+        await asyncio.gather(*runs.values())
+    finally:
+        if owns_resources:
+            await resources.aclose()
+
+    return [dict(runs[query].result()) for query in queries]
+
+
+def _operation_result(queue, operation_id):
+    """(combined summary, error) of a finished queued operation"""
+    job = queue.find(f'combine:{operation_id}')
+    if job is not None and job.status == 'done':
+        return (queue.result(job) or {}).get('combined_summary'), None
+    failed = job if job is not None and job.status == 'failed' else queue.find(f'search:{operation_id}')
+    return None, (failed.error if failed is not None and failed.error else 'did not finish')
+
+
+async def vibe_search_batch_deferred(queries, resources=None, output_path=None, concurrency=8,
+                                     poll_interval=30.0, collect_seconds=60.0, **search_kwargs):
+    """
+    Run many queries through the worker pipeline with every OpenAI call deferred to the Batch API.
+
+    Each query becomes a deferred operation (worker.submit_search) that an in-process StageWorker
+    processes until every operation has finished, which takes as long as its batches do (up to the
+    24h completion window). All state is in the database: run the same queries again after a restart
+    and their unfinished operations are picked up instead of started over (`vibescraper worker`
+    continues them too).
+
+    Args:
+        queries - iterable of query strings
+        resources - existing SearchResources to use instead of creating (and closing) one; its database holds the queue
+        output_path - optional JSONL file the results are appended to
+        concurrency - stage jobs run at once
+        poll_interval - seconds between Batch API polls
+        collect_seconds - seconds requests are collected before a batch is submitted
+        search_kwargs - passed through to submit_search (text_model, embedding_model, dimensions, top_k, domain_count)
+
+    Returns a list of {'query', 'summary', 'error', 'seconds', 'operation_id'} dicts in input order.
+    """
+    from vibescraper.job_queue import JobQueue
+    from vibescraper.openai_batch import BatchBroker
+    from vibescraper.worker import StageWorker, submit_search
+
+    queries = list(queries)
+    owns_resources = resources is None
+    if owns_resources:
+        resources = SearchResources(max_concurrent_pages=concurrency)
+
+    start = time.perf_counter()
+    queue = JobQueue(resources.db)
+    operation_ids = {}
+    try:
+        for query in queries:
+            if query in operation_ids:
+                continue
+            resumed = next((operation_id for operation_id in resources.db.get_deferred_operation_ids(query.strip('"'))
+                            if queue.unfinished_count(operation_id)), None)
+            operation_ids[query] = resumed or submit_search(queue, query, deferred=True, **search_kwargs)
+            print(f"{'Resuming' if resumed else 'Queued'} deferred operation {operation_ids[query]}: {query}")
+
+        broker = BatchBroker(resources.db, poll_interval=poll_interval, collect_seconds=collect_seconds)
+        worker = StageWorker(queue, resources, concurrency=concurrency, batch_broker=broker)
+        await worker.run(exit_when_idle=True)
+
+        seconds = time.perf_counter() - start
+        results = []
+        for query in queries:
+            summary, error = _operation_result(queue, operation_ids[query])
+            results.append({'query': query, 'summary': summary, 'error': error, 'seconds': seconds,
+                            'operation_id': operation_ids[query]})
+    finally:
+        if owns_resources:
+            await resources.aclose()
+
+    if output_path:
+        if os.path.dirname(output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, 'a', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+    return results
@@ -2,11 +2,11 @@ import os
 import time
 from urllib.parse import urljoin
 import requests
-from vibescraper.config import BRAVE_API_KEY, brave_client
+from vibescraper.config import BRAVE_API_KEY, get_brave_client
 
 API_KEY = BRAVE_API_KEY
 
-API_HOST = "https://api.search.brave.com"
+API_HOST = os.getenv("BRAVE_API_HOST", "https://api.search.brave.com")
 API_PATH = {
     "web": urljoin(API_HOST, "res/v1/web/search"),
 }
@@ -80,7 +80,7 @@ def get_brave_search(
 
 
 async def brave_summary(query: str):
-    completions = brave_client.chat.completions.create(
+    completions = get_brave_client().chat.completions.create(
       messages=[
         {
           "role": "user",
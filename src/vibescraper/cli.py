@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import json
+import sys
+
+
+def _add_search_options(parser):
+    parser.add_argument('--text-model', default='gpt_4_1_mini')
+    for stage in ('expand', 'page', 'reduce', 'report'):
+        parser.add_argument(f'--{stage}-model', metavar='MODEL',
+                            help=f"text model of the '{stage}' stage (default --text-model)")
+    parser.add_argument('--embedding-model', default='small', choices=['small', 'large', 'legacy', 'hashing'],
+                        help="'hashing' embeds locally on the CPU, without network calls")
+    parser.add_argument('--dimensions', type=int, default=1536)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--domain-count', type=int, default=5)
+
+
+def _add_adaptive_option(parser):
+    parser.add_argument('--adaptive', action='store_true',
+                        help='stop early once new pages stop improving the results, fetch more urls when they are weak')
+
+
+def _add_first_pass_option(parser):
+    parser.add_argument('--first-pass', choices=['hashing'],
+                        help='pre-rank chunks with this local model and only embed the best candidates')
+
+
+def _add_coarse_dims_option(parser):
+    parser.add_argument('--coarse-dims', type=int,
+                        help='shortlist chunks on this many leading embedding dimensions before exact scoring')
+
+
+def _add_budget_option(parser):
+    parser.add_argument('--budget', type=int, metavar='TOKENS',
+                        help='cap the OpenAI tokens of each search; fewer chunks, shorter summaries and fewer pages are used to fit')
+
+
+def _add_hedge_option(parser):
+    parser.add_argument('--hedge', nargs='?', type=float, const=5.0, metavar='PERCENT',
+                        help='re-send fetches and OpenAI calls slower than the 95th percentile, and start spare urls for '
+                             'stalled pages, adding at most PERCENT%% extra requests (default 5)')
+
+
+def _hedge(args):
+    return args.hedge / 100 if args.hedge is not None else None
+
+
+def _text_model(args):
+    """--text-model, or a per-stage dict (see openai_utils.route_model) when any --<stage>-model is given"""
+    stages = {stage: getattr(args, f'{stage}_model') for stage in ('expand', 'page', 'reduce', 'report')}
+    stages = {stage: model for stage, model in stages.items() if model}
+    if not stages:
+        return args.text_model
+    return {'default': args.text_model, **stages}
+
+
+def _add_batch_api_options(parser):
+    parser.add_argument('--batch-poll', type=float, default=30.0, metavar='SECONDS',
+                        help='seconds between Batch API polls for deferred searches')
+    parser.add_argument('--batch-collect', type=float, default=60.0, metavar='SECONDS',
+                        help='seconds deferred requests are collected before a batch is submitted')
+
+
+def _search_kwargs(args):
+    return {
+        'text_model': _text_model(args),
+        'embedding_model': args.embedding_model,
+        'dimensions': args.dimensions,
+        'top_k': args.top_k,
+        'domain_count': args.domain_count,
+    }
+
+
+def search_command(args):
+    from vibescraper.vibe_search import vibe_search
+
+    tracer = None
+    if args.trace:
+        from vibescraper.tracing import Tracer
+        tracer = Tracer()
+
+    summary = asyncio.run(vibe_search(args.query, tracer=tracer, adaptive=args.adaptive, first_pass=args.first_pass,
+                                      coarse_dims=args.coarse_dims, profile=args.profile, budget=args.budget,
+                                      hedge=_hedge(args), **_search_kwargs(args)))
+
+    if tracer:
+        tracer.export(args.trace, format=args.trace_format)
+        print(f"Trace written to {args.trace}")
+    print(summary)
+
+
+def batch_command(args):
+    from vibescraper.batch import load_queries, vibe_search_batch, vibe_search_batch_deferred
+
+    queries = load_queries(args.file) if args.file != '-' else [q.strip() for q in sys.stdin if q.strip()]
+    if args.deferred:
+        results = asyncio.run(vibe_search_batch_deferred(
+            queries,
+            output_path=args.output,
+            concurrency=args.max_pages,
+            poll_interval=args.batch_poll,
+            collect_seconds=args.batch_collect,
+            **_search_kwargs(args)
+        ))
+    else:
+        results = asyncio.run(vibe_search_batch(
+            queries,
+            max_concurrent_queries=args.concurrency,
+            max_concurrent_pages=args.max_pages,
+            max_concurrent_requests=args.max_requests,
+            output_path=args.output,
+            adaptive=args.adaptive,
+            first_pass=args.first_pass,
+            coarse_dims=args.coarse_dims,
+            budget=args.budget,
+            hedge=_hedge(args),
+            **_search_kwargs(args)
+        ))
+
+    failed = [r for r in results if r['error']]
+    print(f"Finished {len(results)} queries, {len(failed)} failed")
+    if not args.output:
+        for result in results:
+            print(json.dumps(result, ensure_ascii=False))
+
+
+def refresh_command(args):
+    from vibescraper.refresh import refresh_operation
+
+    summary = asyncio.run(refresh_operation(args.operation_id, force=args.force))
+    if summary is None:
+        sys.exit(f"Operation {args.operation_id} not found")
+    print(summary)
+
+
+def rebuild_command(args):
+    from vibescraper.refresh import rebuild_operation
+
+    counts = asyncio.run(rebuild_operation(args.operation_id, embedding_model=args.embedding_model,
+                                           dimensions=args.dimensions, summarize=args.summarize,
+                                           expand_query=not args.no_expand))
+    if counts is None:
+        sys.exit(f"Operation {args.operation_id} not found")
+
+
+def enqueue_command(args):
+    from vibescraper.db_schema import DBManager
+    from vibescraper.job_queue import JobQueue
+    from vibescraper.worker import submit_search, wait_for_operation
+
+    db = DBManager(args.db) if args.db else DBManager()
+    db.create_tables()
+    queue = JobQueue(db)
+    try:
+        operation_ids = [submit_search(queue, query, deferred=args.deferred, **_search_kwargs(args)) for query in args.query]
+        for query, operation_id in zip(args.query, operation_ids):
+            print(f"Queued operation {operation_id}: {query}")
+
+        if args.wait:
+            for operation_id in operation_ids:
+                job = asyncio.run(wait_for_operation(queue, operation_id))
+                if job.status == 'failed':
+                    print(f"Operation {operation_id} failed: {job.error}")
+                else:
+                    print((JobQueue.result(job) or {}).get('combined_summary'))
+    finally:
+        db.close()
+
+
+def worker_command(args):
+    from vibescraper.worker import STAGES, run_workers
+
+    stages = args.stages.split(',') if args.stages else None
+    unknown = set(stages or ()) - set(STAGES)
+    if unknown:
+        sys.exit(f"Unknown stages: {', '.join(sorted(unknown))} (choose from {', '.join(STAGES)})")
+
+    run_workers(
+        processes=args.processes,
+        db_path=args.db,
+        stages=stages,
+        concurrency=args.concurrency,
+        lease_seconds=args.lease,
+        max_attempts=args.max_attempts,
+        exit_when_idle=args.exit_when_idle,
+        max_concurrent_requests=args.max_requests,
+        batch_poll_interval=args.batch_poll,
+        batch_collect_seconds=args.batch_collect,
+    )
+
+
+def history_command(args):
+    from vibescraper.db_schema import DBManager
+
+    db = DBManager(args.db) if args.db else DBManager()
+    db.create_tables()
+    try:
+        if args.query or args.url:
+            operations = db.search_operations(text=args.query, url=args.url, limit=args.limit)
+        else:
+            operations = db.list_operations(limit=args.limit)
+        for operation in operations:
+            usage = ''
+            if operation.cost is not None:
+                tokens = (operation.prompt_tokens or 0) + (operation.completion_tokens or 0) + (operation.embedding_tokens or 0)
+                usage = f"  [{tokens} tokens, ${operation.cost:.4f}]"
+            print(f"{operation.id:>6}  {operation.timestamp:%Y-%m-%d %H:%M}  {operation.search_query}{usage}")
+            if args.chunks:
+                for chunk in db.get_top_chunks(operation.id, limit=args.chunks):
+                    print(f"        {chunk.similarity:.3f}  {chunk.page.url}")
+    finally:
+        db.close()
+
+
+def serve_command(args):
+    from vibescraper.server import serve
+
+    serve(
+        host=args.host,
+        port=args.port,
+        max_concurrent_searches=args.concurrency,
+        max_queued=args.max_queued,
+        workers=args.workers,
+        max_concurrent_pages=args.max_pages,
+        max_concurrent_requests=args.max_requests,
+        search_timeout=args.timeout,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='vibescraper', description='Semantic web scraping and summarization')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    search_parser = subparsers.add_parser('search', help='run a single vibe_search query')
+    search_parser.add_argument('query')
+    _add_search_options(search_parser)
+    _add_adaptive_option(search_parser)
+    _add_first_pass_option(search_parser)
+    _add_coarse_dims_option(search_parser)
+    _add_budget_option(search_parser)
+    _add_hedge_option(search_parser)
+    search_parser.add_argument('--trace', help='write a trace of the run to this file')
+    search_parser.add_argument('--trace-format', default='chrome', choices=['chrome', 'otel', 'timings'])
+    search_parser.add_argument('--profile', nargs='?', const=True, metavar='DIR',
+                               help='write a CPU, asyncio wait and memory profile of the run to DIR (default ./profiles/...)')
+    search_parser.set_defaults(func=search_command)
+
+    batch_parser = subparsers.add_parser('batch', help='run many queries with shared resources')
+    batch_parser.add_argument('file', help="file with one query per line (or JSON lines with a 'query' field), '-' for stdin")
+    _add_search_options(batch_parser)
+    _add_adaptive_option(batch_parser)
+    _add_first_pass_option(batch_parser)
+    _add_coarse_dims_option(batch_parser)
+    _add_budget_option(batch_parser)
+    _add_hedge_option(batch_parser)
+    batch_parser.add_argument('--concurrency', type=int, default=4, help='queries running at once')
+    batch_parser.add_argument('--max-pages', type=int, default=8, help='pages processed at once across all queries')
+    batch_parser.add_argument('--max-requests', type=int, default=16, help='concurrent OpenAI requests across all queries')
+    batch_parser.add_argument('--output', help='append results to this JSONL file as queries finish')
+    batch_parser.add_argument('--deferred', action='store_true',
+                              help='queue the searches and run their OpenAI calls through the Batch API (cheaper, results within 24h, resumable)')
+    _add_batch_api_options(batch_parser)
+    batch_parser.set_defaults(func=batch_command)
+
+    refresh_parser = subparsers.add_parser('refresh', help='re-run a stored search, re-processing only new or changed pages')
+    refresh_parser.add_argument('operation_id', type=int)
+    refresh_parser.add_argument('--force', action='store_true', help='re-process every page even if unchanged')
+    refresh_parser.set_defaults(func=refresh_command)
+
+    rebuild_parser = subparsers.add_parser('rebuild', help='re-chunk and re-embed a stored search from its html snapshots, offline')
+    rebuild_parser.add_argument('operation_id', type=int)
+    rebuild_parser.add_argument('--embedding-model', choices=['small', 'large', 'legacy', 'hashing'],
+                                help='switch the operation to this embedding model')
+    rebuild_parser.add_argument('--dimensions', type=int)
+    rebuild_parser.add_argument('--summarize', action='store_true', help='also regenerate page and combined summaries')
+    rebuild_parser.add_argument('--no-expand', action='store_true',
+                                help='embed the query as is instead of expanding it with the text model')
+    rebuild_parser.set_defaults(func=rebuild_command)
+
+    enqueue_parser = subparsers.add_parser('enqueue', help='queue searches for worker processes')
+    enqueue_parser.add_argument('query', nargs='+')
+    _add_search_options(enqueue_parser)
+    enqueue_parser.add_argument('--db', help='SQLAlchemy database url shared with the workers')
+    enqueue_parser.add_argument('--wait', action='store_true', help='wait for the combined summaries and print them')
+    enqueue_parser.add_argument('--deferred', action='store_true',
+                                help='run the OpenAI calls of these searches through the Batch API')
+    enqueue_parser.set_defaults(func=enqueue_command)
+
+    worker_parser = subparsers.add_parser('worker', help='run pipeline stage workers against the job queue')
+    worker_parser.add_argument('--db', help='SQLAlchemy database url shared with the other workers')
+    worker_parser.add_argument('--processes', type=int, default=1, help='worker processes to start')
+    worker_parser.add_argument('--concurrency', type=int, default=4, help='jobs each process runs at once')
+    worker_parser.add_argument('--stages', help='comma separated stages to run (default: all)')
+    worker_parser.add_argument('--lease', type=float, default=300, help='seconds a job stays leased without a heartbeat')
+    worker_parser.add_argument('--max-attempts', type=int, default=3)
+    worker_parser.add_argument('--max-requests', type=int, default=None, help='concurrent OpenAI requests per process')
+    worker_parser.add_argument('--exit-when-idle', action='store_true', help='stop once no jobs are pending or running')
+    _add_batch_api_options(worker_parser)
+    worker_parser.set_defaults(func=worker_command)
+
+    history_parser = subparsers.add_parser('history', help='list or search stored operations')
+    history_parser.add_argument('--query', help='only operations whose query contains this text')
+    history_parser.add_argument('--url', help="only operations that visited this url (end with '*' for a prefix)")
+    history_parser.add_argument('--limit', type=int, default=20)
+    history_parser.add_argument('--chunks', type=int, default=0, help='also show the top N chunks of each operation')
+    history_parser.add_argument('--db', help='SQLAlchemy database url')
+    history_parser.set_defaults(func=history_command)
+
+    serve_parser = subparsers.add_parser('serve', help='run a local HTTP/JSON service with warm pools and caches')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    serve_parser.add_argument('--concurrency', type=int, default=4, help='searches running at once')
+    serve_parser.add_argument('--max-queued', type=int, default=32, help='searches waiting before new ones get 503')
+    serve_parser.add_argument('--workers', type=int, default=None, help='HTML chunking worker processes')
+    serve_parser.add_argument('--max-pages', type=int, default=8, help='pages processed at once across all searches')
+    serve_parser.add_argument('--max-requests', type=int, default=16, help='concurrent OpenAI requests')
+    serve_parser.add_argument('--timeout', type=float, default=600, help='seconds before a search is abandoned')
+    serve_parser.set_defaults(func=serve_command)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,156 @@
 import os
-from openai import OpenAI
+import re
+from functools import lru_cache
 
-client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY")
-)
 
-brave_client = OpenAI(
-    api_key=os.getenv("BRAVE_API_KEY"),
-    base_url="https://api.search.brave.com/res/v1",
-)
+# API clients are built on first use, so importing vibescraper doesn't pay for importing openai
+@lru_cache(maxsize=None)
+def get_client():
+    from openai import OpenAI
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY")
+    )
+
+
+@lru_cache(maxsize=None)
+def get_brave_client():
+    from openai import OpenAI
+    return OpenAI(
+        api_key=os.getenv("BRAVE_API_KEY"),
+        base_url="https://api.search.brave.com/res/v1",
+    )
+
+
+def __getattr__(name):
+    # Keeps `from vibescraper.config import client` working without building clients at import time
+    if name == "client":
+        return get_client()
+    if name == "brave_client":
+        return get_brave_client()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 #search_engine = "google"
 search_engine = "brave"
+
+# LLM response cache used by openai_utils.generate (temperature=0 responses are deterministic enough to reuse)
+llm_cache_enabled = os.getenv("VIBESCRAPER_LLM_CACHE_DISABLED") is None
+llm_cache_path = os.getenv("VIBESCRAPER_LLM_CACHE", "llm_cache.db")
+llm_cache_ttl = 7 * 24 * 3600
+llm_cache_max_bytes = 256 * 1024 * 1024
+
+# Result export: "json" writes one file per page and per search, "jsonl" appends everything to one
+# stream per operation (results/operation_<id>.jsonl), "both" does both
+results_format = os.getenv("VIBESCRAPER_RESULTS_FORMAT", "json")
+
+# Compressed, content-addressed copies of fetched HTML (see snapshots.SnapshotStore), so stored
+# operations can be re-chunked and re-embedded without fetching again
+snapshots_enabled = os.getenv("VIBESCRAPER_SNAPSHOTS_DISABLED") is None
+snapshot_dir = os.getenv("VIBESCRAPER_SNAPSHOT_DIR", "snapshots")
+
+# Per-domain extraction templates learned from earlier pages (see domain_templates.TemplateCache)
+templates_enabled = os.getenv("VIBESCRAPER_TEMPLATES_DISABLED") is None
+templates_path = os.getenv("VIBESCRAPER_TEMPLATES", "domain_templates.db")
+
+# Compress chunk text stored in the database (rows written either way stay readable)
+compress_chunk_text = os.getenv("VIBESCRAPER_COMPRESS_CHUNKS") is not None
+
+
+
+class DatabaseSettings:
+    """
+    Where results are stored and how db_schema.DBManager connects. Defaults come from the
+    VIBESCRAPER_DB_* environment variables (see from_env).
+
+    Any SQLAlchemy url works: SQLite files are opened in WAL mode with a busy timeout so readers
+    don't block the writer, server databases (PostgreSQL, MySQL, ...) get a connection pool. With
+    async_writes, writes made while a search runs are queued and committed in batches by a
+    background task (see db_writer.DBWriter), on SQLAlchemy's async engine when the async driver
+    is installed (pip install vibescraper[async-db]) and in a worker thread otherwise.
+    """
+    # Async driver used for urls that name none or a synchronous one, and the async drivers known
+    ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg', 'mysql': 'aiomysql'}
+    ASYNC_DRIVER_NAMES = ('aiosqlite', 'asyncpg', 'aiomysql', 'asyncmy', 'psycopg')
+
+    def __init__(self, url='sqlite:///embeddings.db', pool_size=5, max_overflow=10, pool_timeout=30.0,
+                 pool_recycle=1800, busy_timeout=30.0, sqlite_wal=True, async_writes=True, write_queue=1000, write_batch=200,
+                 flush_interval=0.05, echo=False):
+        """
+        Args:
+            url - SQLAlchemy database url
+            pool_size, max_overflow, pool_timeout, pool_recycle - connection pool of server databases
+            busy_timeout - seconds a SQLite connection waits for a lock before failing
+            sqlite_wal - put SQLite databases in WAL mode, so reads go on while a batch is written
+            async_writes - queue writes to the background writer while an event loop is running
+            write_queue - queued writes before writers wait for the queue to drain
+            write_batch - writes committed in one transaction
+            flush_interval - seconds the writer waits for more writes before committing a batch
+            echo - log SQL statements
+        """
+        self.url = url
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_timeout = pool_timeout
+        self.pool_recycle = pool_recycle
+        self.busy_timeout = busy_timeout
+        self.sqlite_wal = sqlite_wal
+        self.async_writes = async_writes
+        self.write_queue = write_queue
+        self.write_batch = write_batch
+        self.flush_interval = flush_interval
+        self.echo = echo
+
+    @classmethod
+    def from_env(cls, **overrides):
+        """Settings from VIBESCRAPER_DB_URL, _POOL_SIZE, _MAX_OVERFLOW, _WRITE_QUEUE, _WRITE_BATCH and _SYNC_WRITES"""
+        settings = {}
+        if os.getenv("VIBESCRAPER_DB_URL"):
+            settings['url'] = os.getenv("VIBESCRAPER_DB_URL")
+        for name in ('pool_size', 'max_overflow', 'write_queue', 'write_batch'):
+            value = os.getenv(f"VIBESCRAPER_DB_{name.upper()}")
+            if value:
+                settings[name] = int(value)
+        if os.getenv("VIBESCRAPER_DB_SYNC_WRITES") is not None:
+            settings['async_writes'] = False
+        settings.update({name: value for name, value in overrides.items() if value is not None})
+        return cls(**settings)
+
+    @property
+    def is_sqlite(self):
+        return self.url.startswith('sqlite')
+
+    @property
+    def in_memory(self):
+        """An in-memory SQLite database, which only the connection that created it can see"""
+        return self.is_sqlite and (self.url.partition('://')[2] in ('', '/') or ':memory:' in self.url)
+
+    def engine_options(self):
+        """Keyword arguments of create_engine / create_async_engine"""
+        options = {'echo': self.echo}
+        if self.is_sqlite:
+            options['connect_args'] = {'timeout': self.busy_timeout}
+        else:
+            options.update(pool_size=self.pool_size, max_overflow=self.max_overflow, pool_timeout=self.pool_timeout,
+                           pool_recycle=self.pool_recycle, pool_pre_ping=True)
+        return options
+
+    def async_url(self):
+        """The url with the dialect's async driver, or None when there is no known one"""
+        scheme, sep, rest = self.url.partition('://')
+        dialect, _, driver = scheme.partition('+')
+        if driver not in self.ASYNC_DRIVER_NAMES:
+            driver = self.ASYNC_DRIVERS.get(dialect)
+        if not sep or driver is None:
+            return None
+        return f"{dialect}+{driver}://{rest}"
+
+    def __repr__(self):
+        # Credentials are left out
+        url = re.sub(r'://[^/@]*@', '://***@', self.url)
+        return f"<DatabaseSettings(url='{url}', async_writes={self.async_writes})>"
+
+
+database = DatabaseSettings.from_env()
+
 #NOTE: After installing you must run 'check-api-keys' in the terminal to import your api keys from your environment correctly.
 
 # --- API key environment variable accessors appended by installer ---
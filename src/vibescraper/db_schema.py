@@ -1,21 +1,76 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, Text, PickleType
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, String, Float, ForeignKey, DateTime, Text, PickleType, LargeBinary, Index, Boolean
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.orm import relationship, sessionmaker, selectinload, joinedload, defer, raiseload
+import asyncio
+import copy
 import datetime
+import json
+from vibescraper.snapshots import compress_text, decompress_text
+from vibescraper.tracing import traced
 
 Base = declarative_base()
 
+
+class CompressedText(TypeDecorator):
+    """
+    Text that is compressed on write when config.compress_chunk_text is set (see snapshots.compress_text)
+    and decompressed on read. Plain values, e.g. from older rows, are read as they are.
+    """
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        from vibescraper import config
+        return compress_text(value) if config.compress_chunk_text else value
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+def encode_text_model(text_model):
+    """Per-stage text models (a dict, see openai_utils.route_model) are stored as JSON in the text_model column"""
+    return json.dumps(text_model, sort_keys=True) if isinstance(text_model, dict) else text_model
+
+
+def decode_text_model(value):
+    return json.loads(value) if value and value.startswith('{') else value
+
+
 class Operation(Base):
     __tablename__ = 'operations'
 
     id = Column(Integer, primary_key=True)
-    search_query = Column(String, nullable=False)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
+    search_query = Column(String, nullable=False, index=True)
+    timestamp = Column(DateTime, default=datetime.datetime.utcnow, index=True)
     combined_summary = Column(Text, nullable=True)
+    # Settings the operation ran with, so it can be refreshed later
+    text_model = Column(String, nullable=True)
+    embedding_model = Column(String, nullable=True)
+    dimensions = Column(Integer, nullable=True)
+    top_k = Column(Integer, nullable=True)
+    domain_count = Column(Integer, nullable=True)
+    refreshed_at = Column(DateTime, nullable=True)
+    # OpenAI usage of the run (see usage.UsageMeter); cost is an estimate in USD
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    embedding_tokens = Column(Integer, nullable=True)
+    cost = Column(Float, nullable=True)
+    token_budget = Column(Integer, nullable=True)
+    # Its OpenAI calls go through the Batch API (see openai_batch.BatchBroker)
+    deferred = Column(Boolean, nullable=True)
 
     pages = relationship("Page", back_populates="operation",
                          cascade="all, delete-orphan")
 
+    def settings(self):
+        """The vibe_search settings this operation ran with, defaults filled in for older rows"""
+        return {
+            'text_model': decode_text_model(self.text_model) or 'gpt_4_1_mini',
+            'embedding_model': self.embedding_model or 'small',
+            'dimensions': self.dimensions or 1536,
+            'top_k': self.top_k or 5,
+        }
+
     def __repr__(self):
         return f"<Operation(id={self.id}, search_query='{self.search_query}')>"
 
@@ -24,9 +79,19 @@ class Page(Base):
     __tablename__ = 'pages'
 
     id = Column(Integer, primary_key=True)
-    operation_id = Column(Integer, ForeignKey('operations.id'), nullable=False)
-    url = Column(String, nullable=False)
+    operation_id = Column(Integer, ForeignKey('operations.id'), nullable=False, index=True)
+    url = Column(String, nullable=False, index=True)
     page_summary = Column(Text, nullable=True)
+    # What was fetched, for change detection on refresh
+    content_hash = Column(String, nullable=True)
+    etag = Column(String, nullable=True)
+    last_modified = Column(String, nullable=True)
+    fetched_at = Column(DateTime, nullable=True)
+    # OpenAI usage of processing this page
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    embedding_tokens = Column(Integer, nullable=True)
+    cost = Column(Float, nullable=True)
 
     operation = relationship("Operation", back_populates="pages")
     chunks = relationship("Chunk", back_populates="page",
@@ -40,117 +105,532 @@ class Chunk(Base):
     __tablename__ = 'chunks'
 
     id = Column(Integer, primary_key=True)
-    page_id = Column(Integer, ForeignKey('pages.id'), nullable=False)
+    page_id = Column(Integer, ForeignKey('pages.id'), nullable=False, index=True)
     operation_id = Column(Integer, ForeignKey('operations.id'), nullable=False)
     rank = Column(Integer, nullable=True)
-    chunk_text = Column(Text, nullable=False)
+    chunk_text = Column(CompressedText, nullable=False)
     # Store embedding as pickled data, not JSON
     embedding = Column(PickleType, nullable=True)
     similarity = Column(Float, nullable=True)
+    # Truncated, renormalized and quantized copy of the embedding for coarse first-pass scoring
+    coarse_embedding = Column(LargeBinary, nullable=True)
+    # How coarse_embedding is encoded, e.g. 'int8:256' (see page_embedder.coarse_vectors)
+    coarse_format = Column(String, nullable=True)
+    # Tokens in chunk_text (cl100k_base), reused when building prompts from stored chunks
+    token_count = Column(Integer, nullable=True)
 
     page = relationship("Page", back_populates="chunks")
 
+    __table_args__ = (
+        # Top chunks of an operation, best first
+        Index('ix_chunks_operation_id_similarity', 'operation_id', 'similarity'),
+    )
+
     def __repr__(self):
         return f"<Chunk(id={self.id}, rank={self.rank}, similarity={self.similarity})>"
 
 
+class Job(Base):
+    """A unit of pipeline work in the durable job queue (see job_queue.JobQueue)"""
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    # Enqueueing the same key twice returns the existing job instead of adding another
+    idempotency_key = Column(String, nullable=True, unique=True)
+    operation_id = Column(Integer, ForeignKey('operations.id'), nullable=True)
+    payload = Column(Text, nullable=True)
+    # pending -> running -> done, or back to pending for a retry, or failed once out of attempts
+    status = Column(String, nullable=False, default='pending')
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    available_at = Column(DateTime, default=datetime.datetime.utcnow)
+    lease_owner = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_jobs_status_available_at', 'status', 'available_at'),
+        Index('ix_jobs_operation_id', 'operation_id'),
+    )
+
+    def __repr__(self):
+        return f"<Job(id={self.id}, kind='{self.kind}', status='{self.status}', attempts={self.attempts})>"
+
+
+class BatchRequest(Base):
+    """An OpenAI request deferred to the Batch API (see openai_batch.BatchBroker)"""
+    __tablename__ = 'batch_requests'
+
+    id = Column(Integer, primary_key=True)
+    # Hash of endpoint and body, so the same request made again finds its row
+    custom_id = Column(String, nullable=False, unique=True)
+    endpoint = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    # pending -> submitting -> submitted -> done or failed; back to pending when its batch ends without it
+    status = Column(String, nullable=False, default='pending')
+    batch_id = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    response = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_batch_requests_status_endpoint', 'status', 'endpoint'),
+        Index('ix_batch_requests_batch_id', 'batch_id'),
+    )
+
+    def __repr__(self):
+        return f"<BatchRequest(id={self.id}, endpoint='{self.endpoint}', status='{self.status}')>"
+
+
+class OpenAIBatch(Base):
+    """A Batch API job submitted by openai_batch.BatchBroker"""
+    __tablename__ = 'openai_batches'
+
+    id = Column(Integer, primary_key=True)
+    batch_id = Column(String, nullable=False, unique=True)
+    endpoint = Column(String, nullable=False)
+    input_file_id = Column(String, nullable=True)
+    output_file_id = Column(String, nullable=True)
+    error_file_id = Column(String, nullable=True)
+    status = Column(String, nullable=False)
+    request_count = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index('ix_openai_batches_status', 'status'),
+    )
+
+    def __repr__(self):
+        return f"<OpenAIBatch(batch_id='{self.batch_id}', status='{self.status}', requests={self.request_count})>"
+
+
+def configure_sqlite(engine, settings):
+    """WAL mode (when settings.sqlite_wal) and relaxed fsyncs on every new connection of a SQLite engine"""
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if settings.sqlite_wal and not settings.in_memory:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(settings.busy_timeout * 1000)}')
+        cursor.close()
+
+
 class DBManager:
-    def __init__(self, db_path='sqlite:///embeddings.db'):
-        self.engine = create_engine(db_path, echo=False)
+    """
+    Reads and writes of operations, pages and chunks.
+
+    Each method runs in its own session. Writes that hand back nothing the caller needs (chunks,
+    summaries, page and operation updates, deletes) can instead be queued with `await db.write(name, ...)`:
+    with settings.async_writes and a running event loop they are committed in batches by a
+    background db_writer.DBWriter, so the pipeline never waits on the database; `await db.flush()`
+    waits for what was queued so far. Without a writer they run right away, as the methods do.
+    """
+
+    def __init__(self, db_path=None, settings=None):
+        """
+        Args:
+            db_path - SQLAlchemy database url, overriding settings.url
+            settings - config.DatabaseSettings; config.database (from the environment) by default
+        """
+        from vibescraper import config
+        settings = settings or config.database
+        if db_path:
+            settings = copy.copy(settings)
+            settings.url = db_path
+        self.settings = settings
+        self.engine = create_engine(settings.url, **settings.engine_options())
+        if settings.is_sqlite:
+            configure_sqlite(self.engine, settings)
         self.Session = sessionmaker(bind=self.engine)
+        self.writer = None
 
     def create_tables(self):
         Base.metadata.create_all(self.engine)
+        self._add_missing_columns()
+        self._add_missing_indexes()
+
+    def _add_missing_columns(self):
+        """Bring databases created by older versions up to date by adding new nullable columns"""
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                existing = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name in existing:
+                        continue
+                    column_type = column.type.compile(dialect=self.engine.dialect)
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
+    def _add_missing_indexes(self):
+        """create_all skips tables that already exist, so indexes added since are created here"""
+        inspector = inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=self.engine)
 
     def get_session(self):
         return self.Session()
 
     def close(self):
+        if self.writer is not None and self.writer.pending:
+            print(f"Closing the database with {self.writer.pending} queued writes not committed")
+        self.writer = None
         self.engine.dispose()
 
-    def create_operation(self, search_query):
+    # --------- queued writes (see db_writer) ---------
+
+    # Writes that can be queued; each runs as _<name>(session, ...) inside the writer's transaction
+    QUEUED_WRITES = ('create_chunk', 'update_page', 'update_page_summary', 'update_operation',
+                     'update_operation_summary', 'delete_page', 'delete_page_chunks')
+    # Inserts queued the same way, but awaited for the id of the new row (see create)
+    QUEUED_CREATES = ('create_operation', 'create_page')
+
+    def _get_writer(self):
+        """The background writer of the running event loop, started on first use; None for direct writes"""
+        if not self.settings.async_writes or self.settings.in_memory:
+            return None
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+        if self.writer is None or self.writer.loop is not loop:
+            from vibescraper.db_writer import DBWriter
+            if self.writer is not None and self.writer.pending:
+                print(f"{self.writer.pending} queued writes were lost with the event loop they were queued on")
+            self.writer = DBWriter(self, max_pending=self.settings.write_queue, batch_size=self.settings.write_batch,
+                                   flush_interval=self.settings.flush_interval)
+            self.writer.start()
+        return self.writer
+
+    async def write(self, name, *args, **kwargs):
+        """Queue one of QUEUED_WRITES for the background writer; waits only while the queue is full"""
+        writer = self._get_writer()
+        if writer is None:
+            getattr(self, name)(*args, **kwargs)
+            return
+        await writer.put(name, args, kwargs)
+
+    async def create(self, name, *args, **kwargs):
+        """Run one of QUEUED_CREATES through the background writer and return the id of the new row"""
+        writer = self._get_writer()
+        if writer is None:
+            return getattr(self, name)(*args, **kwargs)
+        return await (await writer.put(name, args, kwargs, result=True))
+
+    def write_nowait(self, name, *args, **kwargs):
+        """Queue a write without waiting, even past the queue limit (for cleanup while a task is cancelled)"""
+        writer = self._get_writer()
+        if writer is None:
+            getattr(self, name)(*args, **kwargs)
+            return
+        writer.put_nowait(name, args, kwargs)
+
+    async def flush(self):
+        """Wait until every queued write is committed"""
+        if self.writer is not None and self.writer.loop is asyncio.get_running_loop():
+            await self.writer.flush()
+
+    async def stop_writer(self):
+        """Commit queued writes and stop the background writer"""
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            await writer.stop()
+
+    def apply_writes(self, session, writes):
+        """Run queued (name, args, kwargs, ...) writes in session, without committing; returns their results"""
+        return [getattr(self, f'_{name}')(session, *args, **kwargs) for name, args, kwargs, *_ in writes]
+
+    def _commit(self, write, *args, **kwargs):
+        """Run write(session, ...) in a new session and commit it"""
         session = self.get_session()
         try:
-            operation = Operation(search_query=search_query)
-            session.add(operation)
+            result = write(session, *args, **kwargs)
             session.commit()
-            operation_id = operation.id
-            return operation_id
+            return result
         except Exception as e:
             session.rollback()
             raise e
         finally:
             session.close()
 
+    @traced('db.write', operation='create_operation')
+    def create_operation(self, search_query, **settings):
+        return self._commit(self._create_operation, search_query, **settings)
+
+    @staticmethod
+    def _create_operation(session, search_query, **settings):
+        if 'text_model' in settings:
+            settings['text_model'] = encode_text_model(settings['text_model'])
+        operation = Operation(search_query=search_query, **settings)
+        session.add(operation)
+        session.flush()
+        return operation.id
+
+    @traced('db.write', operation='update_operation_summary')
     def update_operation_summary(self, operation_id, summary):
+        return self._commit(self._update_operation_summary, operation_id, summary)
+
+    @staticmethod
+    def _update_operation_summary(session, operation_id, summary):
+        operation = session.get(Operation, operation_id)
+        if operation:
+            operation.combined_summary = summary
+            return True
+        return False
+
+    @traced('db.write', operation='update_operation')
+    def update_operation(self, operation_id, **fields):
+        return self._commit(self._update_operation, operation_id, **fields)
+
+    @staticmethod
+    def _update_operation(session, operation_id, **fields):
+        operation = session.get(Operation, operation_id)
+        if operation:
+            for name, value in fields.items():
+                setattr(operation, name, value)
+            return True
+        return False
+
+    def get_operation_pages(self, operation_id):
+        """Pages of an operation with their chunks loaded, usable after the session closes"""
         session = self.get_session()
         try:
-            operation = session.query(Operation).get(operation_id)
-            if operation:
-                operation.combined_summary = summary
-                session.commit()
-                return True
-            return False
-        except Exception as e:
-            session.rollback()
-            raise e
+            return (session.query(Page)
+                    .options(selectinload(Page.chunks))
+                    .filter(Page.operation_id == operation_id)
+                    .order_by(Page.id)
+                    .all())
         finally:
             session.close()
 
-    def get_operation(self, operation_id):
+    def get_page(self, page_id):
+        """A page with its chunks loaded, usable after the session closes"""
         session = self.get_session()
         try:
-            return session.query(Operation).get(operation_id)
+            return (session.query(Page)
+                    .options(selectinload(Page.chunks))
+                    .filter(Page.id == page_id)
+                    .first())
         finally:
             session.close()
 
-    def create_page(self, operation_id, url, page_summary=None):
+    def find_page_id(self, operation_id, url):
         session = self.get_session()
         try:
-            page = Page(operation_id=operation_id,
-                        url=url, page_summary=page_summary)
-            session.add(page)
-            session.commit()
-            page_id = page.id
-            return page_id
-        except Exception as e:
-            session.rollback()
-            raise e
+            row = (session.query(Page.id)
+                   .filter(Page.operation_id == operation_id, Page.url == url)
+                   .order_by(Page.id)
+                   .first())
+            return row[0] if row else None
         finally:
             session.close()
 
-    def update_page_summary(self, page_id, summary):
+    def get_operation(self, operation_id, with_pages=False):
+        """
+        An operation, usable after the session closes. With with_pages=True its pages and their
+        chunks are eagerly loaded too; otherwise operation.pages raises instead of lazy loading.
+        """
         session = self.get_session()
         try:
-            page = session.query(Page).get(page_id)
-            if page:
-                page.page_summary = summary
-                session.commit()
-                return True
-            return False
-        except Exception as e:
-            session.rollback()
-            raise e
+            query = session.query(Operation)
+            if with_pages:
+                query = query.options(selectinload(Operation.pages).selectinload(Page.chunks))
+            else:
+                query = query.options(raiseload(Operation.pages))
+            return query.filter(Operation.id == operation_id).first()
         finally:
             session.close()
 
-    def create_chunk(self, page_id, operation_id, chunk_text, embedding=None, similarity=None, rank=None):
+    # --------- read side: listing and searching stored runs ---------
+
+    def list_operations(self, limit=50, offset=0, since=None):
+        """Most recent operations first, optionally only those run after the `since` datetime"""
         session = self.get_session()
         try:
-            chunk = Chunk(
-                page_id=page_id,
-                operation_id=operation_id,
-                chunk_text=chunk_text,
-                embedding=embedding,
-                similarity=similarity,
-                rank=rank
-            )
-            session.add(chunk)
-            session.commit()
-            chunk_id = chunk.id
-            return chunk_id
-        except Exception as e:
-            session.rollback()
-            raise e
+            query = session.query(Operation).options(raiseload(Operation.pages))
+            if since is not None:
+                query = query.filter(Operation.timestamp >= since)
+            return query.order_by(Operation.timestamp.desc(), Operation.id.desc()).offset(offset).limit(limit).all()
+        finally:
+            session.close()
+
+    def search_operations(self, text=None, url=None, limit=50):
+        """
+        Operations whose query contains `text` (case-insensitive) and/or that visited `url`.
+        A url ending in '*' matches as a prefix, e.g. 'https://example.com/*'.
+        The text match is a substring scan; the search_query index only serves exact lookups.
+        """
+        session = self.get_session()
+        try:
+            query = session.query(Operation).options(raiseload(Operation.pages))
+            if text:
+                escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                query = query.filter(Operation.search_query.ilike(f'%{escaped}%', escape='\\'))
+            if url:
+                query = query.filter(Operation.id.in_(
+                    session.query(Page.operation_id).filter(self._url_filter(url))))
+            return query.order_by(Operation.timestamp.desc(), Operation.id.desc()).limit(limit).all()
+        finally:
+            session.close()
+
+    def get_deferred_operation_ids(self, search_query):
+        """Ids of the deferred operations for exactly this query, newest first"""
+        session = self.get_session()
+        try:
+            return [operation_id for operation_id, in session.query(Operation.id)
+                    .filter(Operation.search_query == search_query, Operation.deferred.is_(True))
+                    .order_by(Operation.id.desc())]
+        finally:
+            session.close()
+
+    @staticmethod
+    def _url_filter(url):
+        if url.endswith('*'):
+            # A range instead of LIKE so the url index is used on every backend
+            prefix = url[:-1]
+            return (Page.url >= prefix) & (Page.url < prefix + '\uffff')
+        return Page.url == url
+
+    def find_pages(self, url, limit=100):
+        """Stored pages for a url (or url prefix ending in '*'), newest first, with their operation loaded"""
+        session = self.get_session()
+        try:
+            return (session.query(Page)
+                    .options(joinedload(Page.operation))
+                    .filter(self._url_filter(url))
+                    .order_by(Page.id.desc())
+                    .limit(limit)
+                    .all())
         finally:
             session.close()
+
+    def get_top_chunks(self, operation_id, limit=10, with_embeddings=False):
+        """
+        The most similar chunks of an operation across all its pages, best first, each with its page loaded.
+        Embeddings are only loaded with with_embeddings=True.
+        """
+        session = self.get_session()
+        try:
+            query = session.query(Chunk).options(joinedload(Chunk.page))
+            if not with_embeddings:
+                query = query.options(defer(Chunk.embedding))
+            return (query.filter(Chunk.operation_id == operation_id)
+                    .order_by(Chunk.similarity.desc())
+                    .limit(limit)
+                    .all())
+        finally:
+            session.close()
+
+    def get_coarse_embeddings(self, coarse_format, operation_ids=None):
+        """(chunk id, coarse_embedding bytes) of every stored chunk with the given coarse format, without loading full embeddings"""
+        session = self.get_session()
+        try:
+            query = session.query(Chunk.id, Chunk.coarse_embedding).filter(Chunk.coarse_format == coarse_format)
+            if operation_ids is not None:
+                query = query.filter(Chunk.operation_id.in_(operation_ids))
+            return query.order_by(Chunk.id).all()
+        finally:
+            session.close()
+
+    def get_chunks(self, chunk_ids):
+        """Chunks by id, with their pages and full embeddings loaded"""
+        session = self.get_session()
+        try:
+            return (session.query(Chunk)
+                    .options(joinedload(Chunk.page))
+                    .filter(Chunk.id.in_(list(chunk_ids)))
+                    .all())
+        finally:
+            session.close()
+
+    @traced('db.write', operation='create_page')
+    def create_page(self, operation_id, url, page_summary=None):
+        return self._commit(self._create_page, operation_id, url, page_summary)
+
+    @staticmethod
+    def _create_page(session, operation_id, url, page_summary=None):
+        page = Page(operation_id=operation_id, url=url, page_summary=page_summary)
+        session.add(page)
+        session.flush()
+        return page.id
+
+    @traced('db.write', operation='update_page')
+    def update_page(self, page_id, **fields):
+        return self._commit(self._update_page, page_id, **fields)
+
+    @staticmethod
+    def _update_page(session, page_id, **fields):
+        page = session.get(Page, page_id)
+        if page:
+            for name, value in fields.items():
+                setattr(page, name, value)
+            return True
+        return False
+
+    @traced('db.write', operation='delete_page')
+    def delete_page(self, page_id):
+        """Delete a page and its chunks"""
+        return self._commit(self._delete_page, page_id)
+
+    @staticmethod
+    def _delete_page(session, page_id):
+        page = session.get(Page, page_id)
+        if page:
+            session.delete(page)
+            return True
+        return False
+
+    @traced('db.write', operation='delete_page_chunks')
+    def delete_page_chunks(self, page_id):
+        return self._commit(self._delete_page_chunks, page_id)
+
+    @staticmethod
+    def _delete_page_chunks(session, page_id):
+        return session.query(Chunk).filter(Chunk.page_id == page_id).delete()
+
+    @traced('db.write', operation='update_page_summary')
+    def update_page_summary(self, page_id, summary):
+        return self._commit(self._update_page_summary, page_id, summary)
+
+    @staticmethod
+    def _update_page_summary(session, page_id, summary):
+        page = session.get(Page, page_id)
+        if page:
+            page.page_summary = summary
+            return True
+        return False
+
+    @traced('db.write', operation='create_chunk')
+    def create_chunk(self, page_id, operation_id, chunk_text, embedding=None, similarity=None, rank=None,
+                     coarse_embedding=None, coarse_format=None, token_count=None):
+        return self._commit(self._create_chunk, page_id, operation_id, chunk_text, embedding, similarity, rank,
+                            coarse_embedding, coarse_format, token_count)
+
+    @staticmethod
+    def _create_chunk(session, page_id, operation_id, chunk_text, embedding=None, similarity=None, rank=None,
+                      coarse_embedding=None, coarse_format=None, token_count=None):
+        chunk = Chunk(
+            page_id=page_id,
+            operation_id=operation_id,
+            chunk_text=chunk_text,
+            embedding=embedding,
+            similarity=similarity,
+            rank=rank,
+            coarse_embedding=coarse_embedding,
+            coarse_format=coarse_format,
+            token_count=token_count
+        )
+        session.add(chunk)
+        session.flush()
+        return chunk.id
@@ -0,0 +1,179 @@
+"""
+Background database writer.
+
+A DBWriter is the asyncio task that commits the writes queued with `await db.write(...)` (see
+db_schema.DBManager). Writes are taken off a bounded queue in order and committed in batches of
+up to batch_size per transaction, so a page's chunks cost one commit instead of one each and
+concurrent pages don't take turns on SQLite's write lock. Producers only wait when the queue is
+full, i.e. when the database has fallen far behind. Inserts whose new row id is needed right away
+(db.create(...)) go through the same queue and are committed without waiting for a batch to fill.
+
+Batches run on SQLAlchemy's async engine when its driver is installed (aiosqlite for SQLite,
+asyncpg or aiomysql for server databases; pip install vibescraper[async-db]), and on the
+synchronous engine in a worker thread otherwise. Either way the event loop never blocks on a commit.
+"""
+import asyncio
+import collections
+import contextvars
+import importlib.util
+from vibescraper.tracing import get_tracer
+
+
+def async_engine_available(settings):
+    """Whether settings.url can be used with SQLAlchemy's async engine here"""
+    url = settings.async_url()
+    if url is None or importlib.util.find_spec('greenlet') is None:
+        return False
+    driver = url.partition('://')[0].partition('+')[2]
+    return importlib.util.find_spec(driver) is not None
+
+
+class DBWriter:
+    """Commits queued DBManager writes in batches from a background task on one event loop"""
+
+    def __init__(self, db_manager, max_pending=1000, batch_size=200, flush_interval=0.05):
+        """
+        Args:
+            db_manager - DBManager whose _<name>(session, ...) write functions are applied
+            max_pending - queued writes before put() waits
+            batch_size - writes committed in one transaction
+            flush_interval - seconds to wait for more writes before committing a partial batch
+        """
+        self.db = db_manager
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.loop = None
+        self.async_engine = None
+        self.batches = 0
+        self.writes = 0
+        self.failed = 0
+        self._queue = collections.deque()
+        self._queued = 0
+        self._committed = 0
+        self._has_writes = asyncio.Event()
+        self._space = asyncio.Event()
+        self._progress = asyncio.Event()
+        self._urgent = False
+        self._task = None
+
+    @property
+    def pending(self):
+        """Writes queued or being committed"""
+        return self._queued - self._committed
+
+    def start(self):
+        """Start the writer task on the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        settings = self.db.settings
+        if async_engine_available(settings):
+            from sqlalchemy.ext.asyncio import create_async_engine
+            from vibescraper.db_schema import configure_sqlite
+            self.async_engine = create_async_engine(settings.async_url(), **settings.engine_options())
+            if settings.is_sqlite:
+                configure_sqlite(self.async_engine.sync_engine, settings)
+        # A fresh context, so the writer doesn't run under the tracer or usage meters of whichever search started it
+        self._task = self.loop.create_task(self._run(), context=contextvars.Context())
+        return self
+
+    async def put(self, name, args=(), kwargs=None, result=False):
+        """
+        Queue a write, waiting while max_pending writes are queued. With result=True a future is
+        returned, set to what the write returns once it is committed.
+        """
+        while len(self._queue) >= self.max_pending:
+            self._space.clear()
+            await self._space.wait()
+        return self.put_nowait(name, args, kwargs, result)
+
+    def put_nowait(self, name, args=(), kwargs=None, result=False):
+        """Queue a write right away, past max_pending if need be"""
+        queueable = self.db.QUEUED_WRITES + self.db.QUEUED_CREATES
+        if name not in queueable:
+            raise ValueError(f"'{name}' cannot be queued; queued writes are {', '.join(queueable)}")
+        future = self.loop.create_future() if result else None
+        # The tracer of the search queuing the write, so its batch shows up in that search's trace
+        self._queue.append((name, tuple(args), kwargs or {}, future, get_tracer()))
+        self._queued += 1
+        if future is not None:
+            # Someone is waiting on this one: don't hold it back to fill a batch
+            self._urgent = True
+        self._has_writes.set()
+        return future
+
+    async def flush(self):
+        """Wait until every write queued so far is committed (or has failed)"""
+        target = self._queued
+        while self._committed < target and not self._task.done():
+            self._progress.clear()
+            await self._progress.wait()
+
+    async def stop(self):
+        """Commit what is queued, then stop the task and release the async engine"""
+        await self.flush()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+
+    async def _run(self):
+        while True:
+            await self._has_writes.wait()
+            if len(self._queue) < self.batch_size and not self._urgent:
+                # Let the writes of pages finishing at about the same time join this batch
+                await asyncio.sleep(self.flush_interval)
+            self._urgent = False
+            batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+            if not self._queue:
+                self._has_writes.clear()
+            self._space.set()
+            try:
+                results = await self._commit(batch)
+            except Exception as e:
+                # One bad write must not lose the others: retry them one by one
+                print(f"Error writing a batch of {len(batch)} to the database, retrying one by one: {e}")
+                results = []
+                for write in batch:
+                    try:
+                        results.extend(await self._commit([write]))
+                    except Exception as e:
+                        self.failed += 1
+                        print(f"Error writing to database ({write[0]}): {e}")
+                        results.append(e)
+            for (_, _, _, future, _), result in zip(batch, results):
+                if future is not None and not future.done():
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            self.batches += 1
+            self.writes += len(batch)
+            self._committed += len(batch)
+            self._progress.set()
+
+    async def _commit(self, batch):
+        """Commit a batch in one transaction, timed as a db.write span in the trace of each search with writes in it"""
+        tracers = collections.Counter(write[4] for write in batch if write[4] is not None)
+        engine = 'async' if self.async_engine is not None else 'thread'
+        spans = [(tracer, tracer.start_span('db.write', {'operation': 'batch', 'writes': count, 'batch': len(batch),
+                                                         'engine': engine}))
+                 for tracer, count in tracers.items()]
+        error = None
+        try:
+            if self.async_engine is not None:
+                from sqlalchemy.ext.asyncio import AsyncSession
+                async with AsyncSession(self.async_engine) as session:
+                    results = await session.run_sync(self.db.apply_writes, batch)
+                    await session.commit()
+                return results
+            return await asyncio.to_thread(self.db._commit, self.db.apply_writes, batch)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            for tracer, batch_span in spans:
+                tracer.end_span(batch_span, error=error)
+
+    def stats(self):
+        return {'pending': self.pending, 'writes': self.writes, 'batches': self.batches, 'failed': self.failed,
+                'engine': 'async' if self.async_engine is not None else 'thread'}
@@ -0,0 +1,321 @@
+"""
+Per-domain extraction templates.
+
+Most pages come from a few hundred domains whose pages share one layout. After min_pages
+distinct pages of a domain have been chunked generically, their DOM paths are compared: paths
+whose text is the same on every page are boilerplate (navigation, footers, sidebars), and the
+deepest path that holds most of the text that does change is the main content. Later pages of
+the domain are chunked from that content element only, with the boilerplate inside it removed,
+so the chunker skips the rest of the tree and boilerplate stops turning up in chunks.
+
+A page the template does not fit (content element missing or nearly empty) is chunked
+generically; after max_misses such pages in a row the template is dropped and learned again.
+Templates live in a small SQLite file (config.templates_path) so they carry over between runs.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from urllib.parse import urlsplit
+from bs4 import Tag
+from vibescraper.html_parser import default_chunker
+
+PATH_SEPARATOR = ' > '
+# Ids and classes with digits are usually generated per page, so they are left out of paths
+_GENERATED = re.compile(r'\d')
+
+
+def _step(tag):
+    """A tag's path step: its name, id and first two classes (sorted), e.g. 'div#main.content'"""
+    step = tag.name
+    tag_id = tag.get('id')
+    if isinstance(tag_id, str) and tag_id and not _GENERATED.search(tag_id):
+        step += '#' + tag_id
+    classes = sorted(c for c in tag.get('class') or () if not _GENERATED.search(c))[:2]
+    if classes:
+        step += '.' + '.'.join(classes)
+    return step
+
+
+def _is_under(path, ancestor):
+    return path.startswith(ancestor + PATH_SEPARATOR)
+
+
+def _root(soup):
+    return soup.body or soup
+
+
+def page_profile(soup, max_depth=8, max_paths=400):
+    """
+    The text of a parsed page by DOM path, down to max_depth: {path: [text hash, text length, elements]}.
+    Siblings with the same path are counted together. '' holds the whole page.
+    """
+    texts = {}
+
+    def visit(tag, path, depth):
+        for child in tag.children:
+            if not isinstance(child, Tag):
+                continue
+            text = child.get_text(' ', strip=True)
+            if not text:
+                continue
+            child_path = f"{path}{PATH_SEPARATOR}{_step(child)}" if path else _step(child)
+            texts.setdefault(child_path, []).append(text)
+            if depth < max_depth:
+                visit(child, child_path, depth + 1)
+
+    root = _root(soup)
+    visit(root, '', 1)
+    # Shallow paths first, so the cap drops the deepest ones
+    paths = sorted(texts, key=lambda path: path.count(PATH_SEPARATOR))[:max_paths]
+    profile = {path: [hashlib.sha256('\n'.join(texts[path]).encode('utf-8')).hexdigest()[:16],
+                      sum(len(text) for text in texts[path]), len(texts[path])] for path in paths}
+    whole = root.get_text(' ', strip=True)
+    profile[''] = [hashlib.sha256(whole.encode('utf-8')).hexdigest()[:16], len(whole), 1]
+    return profile
+
+
+def learn_template(profiles, content_share=0.6):
+    """
+    A template from the profiles of several pages of one domain: {'content': [path] or [],
+    'boilerplate': [paths], 'min_chars': int}. content is empty when no element holds at
+    least content_share of the changing text on every page. The content element must be a single
+    element, so the chunker still sees the headers between its paragraphs.
+    """
+    common = set.intersection(*(set(profile) for profile in profiles)) - {''}
+    repeated = {path for path in common if len({profile[path][0] for profile in profiles}) == 1}
+    # Only the outermost repeated elements; what is inside them goes with them
+    boilerplate = sorted(path for path in repeated if not any(_is_under(path, other) for other in repeated))
+
+    def content_length(profile, path):
+        return profile[path][1] - sum(profile[b][1] for b in boilerplate if _is_under(b, path))
+
+    def changing_length(profile):
+        return profile[''][1] - sum(profile[b][1] for b in boilerplate)
+
+    candidates = [
+        path for path in common
+        if path not in repeated and not any(_is_under(path, b) for b in boilerplate)
+        and all(profile[path][2] == 1 for profile in profiles)
+        and all(content_length(profile, path) >= content_share * changing_length(profile) > 0 for profile in profiles)
+    ]
+    if not candidates:
+        return {'content': [], 'boilerplate': boilerplate, 'min_chars': 0}
+
+    content = max(candidates, key=lambda path: (path.count(PATH_SEPARATOR), len(path)))
+    min_chars = min(content_length(profile, content) for profile in profiles)
+    # Repeated parts of tables, lists and code (e.g. a table's header row) are content the chunker keeps whole
+    preserved = set(default_chunker().elements_to_preserve)
+
+    def inside_preserved(path):
+        steps = path[len(content) + len(PATH_SEPARATOR):].split(PATH_SEPARATOR)[:-1]
+        return any(re.match(r'[^#.]+', step).group() in preserved for step in steps)
+
+    return {
+        'content': [content],
+        'boilerplate': [b for b in boilerplate if _is_under(b, content) and not inside_preserved(b)],
+        # A page whose content element holds much less text than any sample is not laid out like them
+        'min_chars': max(1, min_chars // 4),
+    }
+
+
+def select(soup, path):
+    """The elements at a DOM path, walking down only along the path"""
+    elements = [_root(soup)]
+    for step in path.split(PATH_SEPARATOR):
+        elements = [child for element in elements for child in element.children
+                    if isinstance(child, Tag) and _step(child) == step]
+        if not elements:
+            break
+    return elements
+
+
+def apply_template(chunker, soup, template):
+    """
+    Chunks (dicts, as chunker.chunk_soup) of the template's content elements, with their
+    boilerplate removed; None when the page doesn't fit the template.
+    """
+    roots = [element for path in template['content'] for element in select(soup, path)]
+    if not roots:
+        return None
+    for path in template['boilerplate']:
+        for element in select(soup, path):
+            element.decompose()
+    if sum(len(root.get_text(' ', strip=True)) for root in roots) < template['min_chars']:
+        return None
+    chunks = []
+    for root in roots:
+        chunks.extend(chunker.process_tag(root))
+    return chunks or None
+
+
+def chunk_page(html, template=None, learn=False):
+    """
+    Chunk a page with a domain template when one is given, generically otherwise (or when the page
+    doesn't fit it). Returns (text chunks, profile for learning when learn=True, matched) where
+    matched is None without a template. Runs in worker threads and processes, so it keeps no state.
+    """
+    chunker = default_chunker()
+    soup = chunker.parse(html)
+    if template:
+        chunks = apply_template(chunker, soup, template)
+        if chunks:
+            return chunker.split_chunks(chunks), None, True
+        # The template removed parts of the tree before it turned out not to fit
+        soup = chunker.parse(html)
+    profile = page_profile(soup) if learn else None
+    return chunker.split_chunks(chunker.chunk_soup(soup)), profile, False if template else None
+
+
+def domain_of(url):
+    host = (urlsplit(url).hostname or '').lower()
+    return host[4:] if host.startswith('www.') else host
+
+
+class TemplateCache:
+    """
+    Learned templates by domain, stored in a small SQLite file.
+
+    lookup(url) gives the template to chunk a page with, and whether to profile the page for
+    learning; record(url, ...) takes the outcome. Both may read and write the SQLite file, so
+    SearchResources.chunk_html calls them from a worker thread.
+    """
+
+    def __init__(self, path='domain_templates.db', min_pages=3, max_samples=5, max_misses=3, ttl=30 * 24 * 3600):
+        """
+        Args:
+            path - SQLite file
+            min_pages - distinct pages of a domain profiled before its template is learned
+            max_samples - profiles kept per domain while learning
+            max_misses - pages in a row the template doesn't fit before it is learned again
+            ttl - seconds after which a template is learned again
+        """
+        self.path = path
+        self.min_pages = min_pages
+        self.max_samples = max_samples
+        self.max_misses = max_misses
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS domain_templates ("
+            "domain TEXT PRIMARY KEY, template TEXT, samples TEXT NOT NULL, hits INTEGER NOT NULL, "
+            "misses INTEGER NOT NULL, consecutive_misses INTEGER NOT NULL, learned_at REAL, updated_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _entry(self, domain):
+        entry = self._entries.get(domain)
+        if entry is None:
+            row = self._conn.execute(
+                "SELECT template, samples, hits, misses, consecutive_misses, learned_at FROM domain_templates "
+                "WHERE domain = ?", (domain,)).fetchone()
+            if row is None:
+                entry = {'template': None, 'samples': [], 'hits': 0, 'misses': 0, 'consecutive_misses': 0,
+                         'learned_at': None}
+            else:
+                entry = {'template': json.loads(row[0]) if row[0] else None, 'samples': json.loads(row[1]),
+                         'hits': row[2], 'misses': row[3], 'consecutive_misses': row[4], 'learned_at': row[5]}
+            self._entries[domain] = entry
+        return entry
+
+    def _store(self, domain, entry):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO domain_templates "
+            "(domain, template, samples, hits, misses, consecutive_misses, learned_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (domain, json.dumps(entry['template']) if entry['template'] is not None else None,
+             json.dumps(entry['samples']), entry['hits'], entry['misses'], entry['consecutive_misses'],
+             entry['learned_at'], time.time()))
+        self._conn.commit()
+
+    def lookup(self, url):
+        """(template or None, learn) for a page: learn is True while the domain's template is being learned"""
+        domain = domain_of(url)
+        if not domain:
+            return None, False
+        with self._lock:
+            entry = self._entry(domain)
+            template = entry['template']
+            if template is None:
+                return None, True
+            if self.ttl is not None and time.time() - entry['learned_at'] > self.ttl:
+                entry['template'] = None
+                return None, True
+            # A domain without a stable content element is chunked generically until the template expires
+            return (template if template['content'] else None), False
+
+    def record(self, url, template, matched, profile=None):
+        """Take the outcome of chunk_page for a page looked up with lookup(url)"""
+        domain = domain_of(url)
+        if not domain:
+            return
+        with self._lock:
+            entry = self._entry(domain)
+            changed = False
+            if template is not None and entry['template'] is template:
+                # Counters are written now and then; template changes right away
+                changed = (entry['hits'] + entry['misses']) % 20 == 0
+                if matched:
+                    self.hits += 1
+                    entry['hits'] += 1
+                    entry['consecutive_misses'] = 0
+                else:
+                    self.misses += 1
+                    entry['misses'] += 1
+                    entry['consecutive_misses'] += 1
+                    if entry['consecutive_misses'] >= self.max_misses:
+                        print(f"Template for {domain} stopped matching, learning it again")
+                        entry['template'] = None
+                        entry['samples'] = []
+                        entry['consecutive_misses'] = 0
+                        changed = True
+
+            if profile is not None and entry['template'] is None:
+                key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+                # The same page twice (or identical pages) would make everything look like boilerplate
+                if all(sample['url'] != key and sample['profile'][''][0] != profile[''][0]
+                       for sample in entry['samples']):
+                    entry['samples'] = (entry['samples'] + [{'url': key, 'profile': profile}])[-self.max_samples:]
+                    changed = True
+                if len(entry['samples']) >= self.min_pages:
+                    entry['template'] = learn_template([sample['profile'] for sample in entry['samples']])
+                    entry['learned_at'] = time.time()
+                    entry['samples'] = []
+                    content = entry['template']['content']
+                    print(f"Learned template for {domain}: "
+                          f"{'content at ' + content[0] if content else 'no stable content element'}, "
+                          f"{len(entry['template']['boilerplate'])} boilerplate elements removed")
+            if changed:
+                self._store(domain, entry)
+
+    def stats(self):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*), COUNT(template), COALESCE(SUM(hits), 0), COALESCE(SUM(misses), 0) "
+                "FROM domain_templates").fetchone()
+        return {'domains': row[0], 'templates': row[1], 'hits': row[2], 'misses': row[3],
+                'session_hits': self.hits, 'session_misses': self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@lru_cache(maxsize=None)
+def get_template_cache():
+    """The process-wide TemplateCache at config.templates_path, or None when templates are disabled"""
+    from vibescraper.config import templates_enabled, templates_path
+    return TemplateCache(templates_path) if templates_enabled else None
@@ -0,0 +1,116 @@
+"""
+Embedding providers.
+
+Everything that turns text into vectors goes through an EmbeddingProvider, so the hosted
+OpenAI models and local CPU models are interchangeable wherever an embedding_model is taken.
+"""
+import asyncio
+import re
+import zlib
+import numpy as np
+from vibescraper.tracing import span
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+class EmbeddingProvider:
+    """Base class: embed(texts) returns a float32 matrix with one row per text"""
+
+    name = None
+
+    async def embed(self, texts):
+        raise NotImplementedError
+
+    async def embed_one(self, text):
+        return (await self.embed([text]))[0]
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """Hosted OpenAI embedding models, batched into one request per batch_size texts"""
+
+    def __init__(self, model='small', dimensions=1536, batch_size=128):
+        self.name = model
+        self.model = model
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+
+    async def embed(self, texts):
+        from vibescraper.openai_utils import get_embeddings
+
+        if not texts:
+            return np.empty((0, self.dimensions), dtype=np.float32)
+        embeddings = await get_embeddings(list(texts), model=self.model, dimensions=self.dimensions,
+                                          batch_size=self.batch_size)
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """
+    Local CPU embeddings from a signed hashing vectorizer over word unigrams and bigrams.
+
+    No model download and no network: texts are tokenized, each term is hashed into one of
+    `dimensions` buckets with a hash-derived sign, counts are log-scaled and rows are
+    L2-normalized, so cosine similarity behaves like a TF-IDF-less bag-of-words match.
+    The whole batch is built with one vectorized scatter-add. Good enough as a first-pass
+    ranker, or as a full offline replacement for the hosted models.
+    """
+
+    name = 'hashing'
+
+    def __init__(self, dimensions=1536, ngrams=2, offload_above=64):
+        """
+        Args:
+            dimensions - vector size (hash buckets)
+            ngrams - longest word n-gram used as a feature
+            offload_above - batches larger than this are vectorized in a worker thread
+        """
+        self.dimensions = dimensions
+        self.ngrams = ngrams
+        self.offload_above = offload_above
+
+    def _terms(self, text):
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        terms = list(tokens)
+        for n in range(2, self.ngrams + 1):
+            terms.extend(' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return terms
+
+    def embed_sync(self, texts):
+        rows, hashes = [], []
+        for row, text in enumerate(texts):
+            for term in self._terms(text):
+                rows.append(row)
+                hashes.append(zlib.crc32(term.encode('utf-8')))
+
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        if hashes:
+            hashes = np.asarray(hashes, dtype=np.uint32)
+            columns = (hashes % self.dimensions).astype(np.intp)
+            # The top hash bit picks the sign so colliding terms tend to cancel instead of pile up
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            np.add.at(matrix, (np.asarray(rows, dtype=np.intp), columns), signs)
+
+        np.copysign(np.log1p(np.abs(matrix)), matrix, out=matrix)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        return matrix
+
+    async def embed(self, texts):
+        texts = list(texts)
+        with span('embed', model=self.name, dimensions=self.dimensions, texts=len(texts)):
+            if len(texts) > self.offload_above:
+                return await asyncio.to_thread(self.embed_sync, texts)
+            return self.embed_sync(texts)
+
+
+def get_embedding_provider(model='small', dimensions=1536):
+    """
+    Return the provider for an embedding_model setting: an EmbeddingProvider instance is used as is,
+    'hashing' is the local CPU backend and anything else is an OpenAI model name (small, large, legacy).
+    """
+    if isinstance(model, EmbeddingProvider):
+        return model
+    if model == 'hashing':
+        return HashingEmbeddingProvider(dimensions=dimensions)
+    return OpenAIEmbeddingProvider(model=model, dimensions=dimensions)
@@ -0,0 +1,289 @@
+import asyncio
+import hashlib
+import random
+import time
+import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+import requests
+from vibescraper.hedging import get_hedging
+from vibescraper.tracing import span
+
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15"
+ROBOTS_AGENT = "vibescraper"
+
+
+def parse_retry_after(value):
+    """Convert a Retry-After header (seconds or HTTP date) into a delay in seconds"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+class RobotsCache:
+    """
+    Fetch, parse and cache robots.txt per host with a TTL.
+    A missing or unreachable robots.txt allows everything, a 401/403 disallows everything.
+    """
+
+    def __init__(self, session, ttl=3600, user_agent=ROBOTS_AGENT, timeout=5):
+        self.session = session
+        self.ttl = ttl
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self._parsers = {}
+        self._locks = {}
+
+    def _download(self, robots_url):
+        parser = RobotFileParser(robots_url)
+        try:
+            resp = self.session.get(robots_url, timeout=self.timeout, headers={"User-Agent": USER_AGENT})
+        except Exception as e:
+            print(f"Failed to fetch {robots_url}: {e}")
+            parser.allow_all = True
+            return parser
+
+        if resp.status_code in (401, 403):
+            parser.disallow_all = True
+        elif resp.status_code >= 400:
+            parser.allow_all = True
+        else:
+            parser.parse(resp.text.splitlines())
+        return parser
+
+    async def get_parser(self, url):
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+
+        cached = self._parsers.get(origin)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+
+        lock = self._locks.setdefault(origin, asyncio.Lock())
+        async with lock:
+            cached = self._parsers.get(origin)
+            if cached and time.monotonic() - cached[0] < self.ttl:
+                return cached[1]
+            parser = await asyncio.to_thread(self._download, f"{origin}/robots.txt")
+            self._parsers[origin] = (time.monotonic(), parser)
+            return parser
+
+    async def can_fetch(self, url):
+        parser = await self.get_parser(url)
+        return parser.can_fetch(self.user_agent, url)
+
+    async def crawl_delay(self, url):
+        parser = await self.get_parser(url)
+        return parser.crawl_delay(self.user_agent)
+
+
+class FetchResult:
+    """Outcome of a fetch: status is None when no response was received, text is empty on failure"""
+
+    def __init__(self, url, status=None, text="", etag=None, last_modified=None):
+        self.url = url
+        self.status = status
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def not_modified(self):
+        return self.status == 304
+
+    @property
+    def content_hash(self):
+        if not self.text:
+            return None
+        return hashlib.sha256(self.text.encode("utf-8")).hexdigest()
+
+
+class HostState:
+    """Politeness bookkeeping for a single host"""
+
+    def __init__(self, concurrency):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.lock = asyncio.Lock()
+        self.next_request_at = 0.0
+        self.failures = 0
+        self.backoff_until = 0.0
+
+
+class FetchScheduler:
+    """
+    Polite HTML fetcher for the scraping path.
+
+    Enforces per-host concurrency and a minimum delay between requests to the same host,
+    honours Retry-After and robots.txt (including Crawl-delay), and backs off hosts that keep failing.
+    Requests to different hosts run concurrently, and are hedged while a hedging.Hedging is active.
+    """
+
+    def __init__(self, per_host_concurrency=2, min_delay=1.0, timeout=10, max_retries=2,
+                 respect_robots=True, robots_ttl=3600, failure_threshold=3, backoff_base=30,
+                 max_backoff=600, max_retry_after=60, pool_size=32, session=None):
+        self.per_host_concurrency = per_host_concurrency
+        self.min_delay = min_delay
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.respect_robots = respect_robots
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        self.robots = RobotsCache(self.session, ttl=robots_ttl)
+        self.hosts = {}
+
+    def _host_state(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = HostState(self.per_host_concurrency)
+        return self.hosts[host]
+
+    async def _wait_turn(self, state, delay):
+        """Reserve the next request slot for a host and sleep until it opens"""
+        async with state.lock:
+            now = time.monotonic()
+            start_at = max(now, state.next_request_at)
+            state.next_request_at = start_at + delay
+        if start_at > now:
+            await asyncio.sleep(start_at - now)
+
+    def _record_failure(self, host, state):
+        state.failures += 1
+        if state.failures >= self.failure_threshold:
+            exponent = state.failures - self.failure_threshold
+            backoff = min(self.max_backoff, self.backoff_base * (2 ** exponent))
+            state.backoff_until = time.monotonic() + backoff * random.uniform(0.8, 1.2)
+            print(f"Backing off {host} for {backoff:.0f}s after {state.failures} failures")
+
+    def _record_success(self, state):
+        state.failures = 0
+        state.backoff_until = 0.0
+
+    def _get(self, url, headers=None):
+        request_headers = {"User-Agent": USER_AGENT}
+        request_headers.update(headers or {})
+        return self.session.get(url, timeout=self.timeout, headers=request_headers)
+
+    async def _request(self, host, url, headers=None):
+        """
+        One GET off the event loop. With hedging active (see hedging) a request slower than the host's
+        usual latency is sent again and the first answer below 500 wins; the duplicate skips the per-host
+        delay, which the hedging load limit keeps rare.
+        """
+        hedging = get_hedging()
+        if hedging is None:
+            return await asyncio.to_thread(self._get, url, headers)
+        return await hedging.fetch.run(lambda: asyncio.to_thread(self._get, url, headers), key=host,
+                                       accept=lambda resp: resp.status_code < 500)
+
+    async def fetch(self, url):
+        """Fetch a url politely. Returns the page text, or an empty string on failure (like fetch_html)"""
+        result = await self.fetch_page(url)
+        return result.text
+
+    async def fetch_page(self, url, etag=None, last_modified=None):
+        """
+        Fetch a url politely and return a FetchResult with the response validators.
+        Passing the etag/last_modified of a previous fetch makes it a conditional GET;
+        result.not_modified is True when the server answers 304.
+        """
+        conditional_headers = {}
+        if etag:
+            conditional_headers["If-None-Match"] = etag
+        if last_modified:
+            conditional_headers["If-Modified-Since"] = last_modified
+
+        with span('fetch', url=url, host=urlsplit(url).netloc.lower(), conditional=bool(conditional_headers)) as fetch_span:
+            result = await self._fetch(url, conditional_headers)
+            if fetch_span:
+                fetch_span.set_attribute('status', result.status)
+                fetch_span.set_attribute('bytes', len(result.text))
+            return result
+
+    async def _fetch(self, url, conditional_headers=None):
+        host = urlsplit(url).netloc.lower()
+        state = self._host_state(host)
+
+        if time.monotonic() < state.backoff_until:
+            print(f"Skipping {url}: {host} is backed off")
+            return FetchResult(url)
+
+        delay = self.min_delay
+        if self.respect_robots:
+            if not await self.robots.can_fetch(url):
+                print(f"Skipping {url}: disallowed by robots.txt")
+                return FetchResult(url)
+            crawl_delay = await self.robots.crawl_delay(url)
+            if crawl_delay:
+                delay = max(delay, float(crawl_delay))
+
+        async with state.semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._wait_turn(state, delay)
+                try:
+                    resp = await self._request(host, url, conditional_headers)
+                except Exception as e:
+                    print(f"Failed to fetch {url}: {e}")
+                    self._record_failure(host, state)
+                    return FetchResult(url)
+
+                if resp.status_code in (429, 503):
+                    retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                    if retry_after is None:
+                        retry_after = delay * (2 ** attempt)
+                    if attempt < self.max_retries and retry_after <= self.max_retry_after:
+                        print(f"{host} asked us to wait {retry_after:.1f}s ({resp.status_code})")
+                        async with state.lock:
+                            state.next_request_at = max(state.next_request_at, time.monotonic() + retry_after)
+                        continue
+                    self._record_failure(host, state)
+                    return FetchResult(url, resp.status_code)
+
+                if resp.status_code >= 500:
+                    if attempt < self.max_retries:
+                        continue
+                    # One failure per url, not per attempt, so retries don't back the host off early
+                    self._record_failure(host, state)
+                    print(f"Failed to fetch {url}: HTTP {resp.status_code}")
+                    return FetchResult(url, resp.status_code)
+
+                if resp.status_code == 304:
+                    self._record_success(state)
+                    return FetchResult(url, 304, etag=resp.headers.get("ETag"),
+                                       last_modified=resp.headers.get("Last-Modified"))
+
+                if resp.status_code >= 400:
+                    # The host answered, it just doesn't have this page
+                    print(f"Failed to fetch {url}: HTTP {resp.status_code}")
+                    return FetchResult(url, resp.status_code)
+
+                self._record_success(state)
+                return FetchResult(url, resp.status_code, resp.text, etag=resp.headers.get("ETag"),
+                                   last_modified=resp.headers.get("Last-Modified"))
+        return FetchResult(url)
+
+    async def fetch_all(self, urls):
+        """Fetch many urls concurrently, preserving order"""
+        return await asyncio.gather(*(self.fetch(url) for url in urls))
+
+    def close(self):
+        self.session.close()
@@ -1,8 +1,10 @@
-from googleapiclient.discovery import build
 from vibescraper.config import GOOGLE_API_KEY, GOOGLE_CSE_ID
 
 
 def google_search(query, num_results=20):
+    # googleapiclient is slow to import, only load it when google is the chosen engine
+    from googleapiclient.discovery import build
+
     service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY)
     results = []
     start = 1
@@ -0,0 +1,188 @@
+"""
+Hedged requests to cut tail latency.
+
+A request that has taken longer than a high percentile of recent latencies gets a duplicate, and
+whichever reply comes back first (and is usable) wins; the other one is cancelled. A cancelled
+call running in a worker thread still finishes in the background and its reply is dropped; the
+usage of a dropped OpenAI reply is still recorded, since it is billed. Each HedgePolicy only
+sends a duplicate while its duplicates stay within `max_extra` of all its calls, so hedging
+never adds more than that share of extra load.
+
+Hedging is activated like tracers and usage meters, with `with hedging.activate():`
+(vibe_search(..., hedge=True) does this). FetchScheduler and openai_utils then hedge their
+requests, and vibe_search starts spare search urls speculatively in place of pages whose fetch stalls.
+"""
+import asyncio
+import collections
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from vibescraper.tracing import span
+
+_active_hedging = contextvars.ContextVar('vibescraper_hedging', default=None)
+
+
+class HedgePolicy:
+    """
+    When to send a duplicate of one kind of request, and how many duplicates may be sent.
+
+    Latencies are tracked per key (a host, a model) over the last `window` successful calls, with the
+    policy-wide window as a fallback for keys with fewer than min_samples; until there are min_samples
+    overall, initial_delay is used (None: no hedging until then).
+    """
+
+    def __init__(self, name, percentile=95, max_extra=0.05, min_samples=10, window=256, min_delay=0.05,
+                 initial_delay=None):
+        """
+        Args:
+            name - layer name, used in traces and summaries
+            percentile - a request is hedged once it is slower than this percentile of recent latencies
+            max_extra - duplicates allowed, as a fraction of all calls (0.05: at most 5% extra requests)
+            min_samples - latencies needed before the percentile is used
+            window - latencies kept per key
+            min_delay - lower bound on the hedge delay in seconds
+            initial_delay - hedge delay in seconds before min_samples latencies are known
+        """
+        self.name = name
+        self.percentile = percentile
+        self.max_extra = max_extra
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies = {}
+        self._all = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds):
+        with self._lock:
+            self._all.append(seconds)
+            if key is not None:
+                if key not in self._latencies:
+                    self._latencies[key] = collections.deque(maxlen=self.window)
+                self._latencies[key].append(seconds)
+
+    def delay(self, key=None):
+        """Seconds after which a call with this key is hedged, or None when it should not be"""
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None or len(samples) < self.min_samples:
+                samples = self._all
+            if len(samples) < self.min_samples:
+                return self.initial_delay
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    def add_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def try_hedge(self):
+        """Count one duplicate request if it keeps duplicates within max_extra of all calls; False otherwise"""
+        with self._lock:
+            if self.hedges + 1 > self.max_extra * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    async def run(self, call, key=None, accept=None):
+        """
+        Await call() (a coroutine function), hedged: once it has run for delay(key) seconds, call() is
+        started again if the extra load limit allows, and the first result that passes accept(result)
+        is returned. When no result is accepted the first one to finish is returned (or raised).
+        """
+        self.add_call()
+        delay = self.delay(key)
+
+        async def timed():
+            start = time.perf_counter()
+            result = await call()
+            self.observe(key, time.perf_counter() - start)
+            return result
+
+        primary = asyncio.ensure_future(timed())
+        hedge = None
+        try:
+            if delay is None:
+                return await primary
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self.try_hedge():
+                return await primary
+
+            with span('hedge', layer=self.name, key=key, delay=round(delay, 3)) as hedge_span:
+                hedge = asyncio.ensure_future(timed())
+                pending = {primary, hedge}
+                first = None
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    # The primary is checked first when both finish together
+                    for task in sorted(done, key=lambda task: task is hedge):
+                        if task.exception() is None and (accept is None or accept(task.result())):
+                            if task is hedge:
+                                with self._lock:
+                                    self.hedge_wins += 1
+                            if hedge_span:
+                                hedge_span.set_attribute('winner', 'hedge' if task is hedge else 'primary')
+                            return task.result()
+                        first = first or task
+                return first.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def summary(self):
+        return {'calls': self.calls, 'hedges': self.hedges, 'hedge_wins': self.hedge_wins, 'delay': self.delay()}
+
+
+class Hedging:
+    """
+    Hedging for a run: a HedgePolicy for page fetches, one for OpenAI calls, and the number of spare
+    search urls vibe_search keeps to start in place of pages whose fetch stalls (those count as fetch
+    duplicates). Keep one instance across searches (SearchResources does) so latencies carry over.
+    """
+
+    def __init__(self, max_extra=0.05, percentile=95, spare_urls=2, fetch_initial_delay=5.0, llm_initial_delay=30.0):
+        """
+        Args:
+            max_extra - extra requests allowed per layer, as a fraction of its calls
+            percentile - latency percentile after which requests are hedged
+            spare_urls - extra search results kept for speculative page fetches
+            fetch_initial_delay, llm_initial_delay - hedge delays used until enough latencies are known
+        """
+        self.max_extra = max_extra
+        self.spare_urls = spare_urls
+        self.fetch = HedgePolicy('fetch', percentile, max_extra, initial_delay=fetch_initial_delay)
+        self.llm = HedgePolicy('llm', percentile, max_extra, initial_delay=llm_initial_delay)
+
+    @classmethod
+    def from_option(cls, hedge, resources):
+        """Hedging for vibe_search's hedge= option: True, a max_extra fraction, or a Hedging"""
+        if hedge is None or hedge is False or isinstance(hedge, Hedging):
+            return hedge or None
+        max_extra = 0.05 if hedge is True else float(hedge)
+        if resources.hedging is None or resources.hedging.max_extra != max_extra:
+            resources.hedging = cls(max_extra=max_extra)
+        return resources.hedging
+
+    @contextmanager
+    def activate(self):
+        token = _active_hedging.set(self)
+        try:
+            yield self
+        finally:
+            _active_hedging.reset(token)
+
+    def summary(self):
+        return {'fetch': self.fetch.summary(), 'llm': self.llm.summary()}
+
+
+def get_hedging():
+    """The Hedging active in the current context, or None"""
+    return _active_hedging.get()
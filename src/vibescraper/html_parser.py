@@ -104,15 +104,15 @@ class HTMLSemanticChunker:
 
         return []
 
-    def chunk_html(self, html):
+    def parse(self, html):
         """
-        Split HTML content into semantic chunks
+        Parse HTML and remove the junk tags
 
         Args:
             html: Raw HTML content as string
 
         Returns:
-            List of chunks with header context
+            BeautifulSoup of the cleaned document
         """
         soup = BeautifulSoup(html, 'html.parser')
 
@@ -120,7 +120,30 @@ class HTMLSemanticChunker:
         for tag_name in self.minimal_junk_tags:
             for tag in soup.find_all(tag_name):
                 tag.decompose()
+        return soup
+
+    def chunk_html(self, html):
+        """
+        Split HTML content into semantic chunks
+
+        Args:
+            html: Raw HTML content as string
+
+        Returns:
+            List of chunks with header context
+        """
+        return self.chunk_soup(self.parse(html))
+
+    def chunk_soup(self, soup):
+        """
+        Split a document parsed with parse() into semantic chunks
+
+        Args:
+            soup: BeautifulSoup from parse()
 
+        Returns:
+            List of chunks with header context
+        """
         chunks = []
         for tag in soup.body.children if soup.body else soup.children:
             if isinstance(tag, Tag):
@@ -216,19 +239,36 @@ class HTMLSemanticChunker:
         Returns:
             List of text chunks split by semantic structure
         """
-        chunks = self.chunk_html(html)
+        return self.split_chunks(self.chunk_html(html), merge_small, include_headers)
 
+    def split_chunks(self, chunks, merge_small=True, include_headers=True):
+        """
+        Merge and format chunks from chunk_html or chunk_soup into text chunks
+
+        Args:
+            chunks: List of chunk dictionaries
+            merge_small: Whether to merge small chunks with the same context
+            include_headers: Whether to include headers in the output text
+
+        Returns:
+            List of text chunks
+        """
         if merge_small:
             chunks = self.merge_small_chunks(chunks)
 
         return self.format_chunks(chunks, include_headers)
 
 
-def process_html_with_semantic_chunker(html_content):
-    chunker = HTMLSemanticChunker(
+def default_chunker():
+    """The chunker configuration the pipeline uses"""
+    return HTMLSemanticChunker(
         headers_to_split_on=['h1', 'h2', 'h3', 'h4'],
         elements_to_preserve=['table', 'ul', 'ol', 'pre', 'code']
     )
 
+
+def process_html_with_semantic_chunker(html_content):
+    chunker = default_chunker()
+
     chunks = chunker.split_html_by_semantics(html_content)
     return chunks
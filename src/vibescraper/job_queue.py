@@ -0,0 +1,241 @@
+import datetime
+import json
+from sqlalchemy import and_, or_, func
+from sqlalchemy.exc import IntegrityError
+from vibescraper.db_schema import Job
+
+
+class RetryLater(Exception):
+    """Raised by a job handler that cannot run yet; the job goes back to the queue without using an attempt"""
+
+    def __init__(self, delay=5.0):
+        super().__init__(f"retry in {delay}s")
+        self.delay = delay
+
+
+class JobQueue:
+    """
+    Durable job queue stored in the `jobs` table next to operations, pages and chunks.
+
+    Any number of worker processes (on any machine that can reach the database) claim jobs with
+    claim(). A claimed job is leased to its worker for lease_seconds; a worker that dies simply
+    stops extending its lease and the job is handed to another worker once the lease expires.
+    Failed jobs are retried with exponential backoff until max_attempts is reached.
+
+    Claims are a compare-and-set UPDATE on the job row, so they are safe with several processes
+    on SQLite as well as on a server database.
+    """
+
+    def __init__(self, db_manager, lease_seconds=300, max_attempts=3, retry_backoff=10.0, max_retry_backoff=600.0):
+        """
+        Args:
+            db_manager - DBManager whose database holds the jobs table (create_tables() must have run)
+            lease_seconds - how long a claimed job stays with its worker without a heartbeat
+            max_attempts - default number of tries before a job is marked failed
+            retry_backoff - seconds before the first retry, doubled on each further attempt
+            max_retry_backoff - upper bound on the retry delay
+        """
+        self.db = db_manager
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.utcnow()
+
+    def enqueue(self, kind, payload=None, idempotency_key=None, operation_id=None, delay=0, max_attempts=None):
+        """
+        Add a job and return its id. With an idempotency_key, enqueueing the same key again
+        (e.g. from a retried job) returns the id of the existing job instead of adding another.
+        """
+        session = self.db.get_session()
+        try:
+            if idempotency_key:
+                existing = session.query(Job.id).filter(Job.idempotency_key == idempotency_key).first()
+                if existing:
+                    return existing[0]
+
+            now = self._now()
+            job = Job(
+                kind=kind,
+                idempotency_key=idempotency_key,
+                operation_id=operation_id,
+                payload=json.dumps(payload) if payload is not None else None,
+                status='pending',
+                attempts=0,
+                max_attempts=max_attempts or self.max_attempts,
+                available_at=now + datetime.timedelta(seconds=delay),
+                created_at=now,
+                updated_at=now
+            )
+            session.add(job)
+            session.commit()
+            return job.id
+        except IntegrityError:
+            # Another process enqueued the same key between our check and insert
+            session.rollback()
+            return session.query(Job.id).filter(Job.idempotency_key == idempotency_key).first()[0]
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _claimable(self, now):
+        return or_(
+            and_(Job.status == 'pending', Job.available_at <= now),
+            and_(Job.status == 'running', Job.lease_expires_at < now, Job.attempts < Job.max_attempts)
+        )
+
+    def claim(self, worker_id, kinds=None):
+        """Lease the oldest runnable job (optionally only of the given kinds) to worker_id; None if there is none"""
+        session = self.db.get_session()
+        try:
+            self._fail_expired(session)
+            for _ in range(10):
+                now = self._now()
+                query = session.query(Job.id).filter(self._claimable(now))
+                if kinds:
+                    query = query.filter(Job.kind.in_(kinds))
+                candidate = query.order_by(Job.available_at, Job.id).first()
+                if candidate is None:
+                    return None
+
+                # Only one worker's UPDATE can match while the job is still claimable
+                claimed = (session.query(Job)
+                           .filter(Job.id == candidate[0], self._claimable(now))
+                           .update({
+                               Job.status: 'running',
+                               Job.lease_owner: worker_id,
+                               Job.lease_expires_at: now + datetime.timedelta(seconds=self.lease_seconds),
+                               Job.attempts: Job.attempts + 1,
+                               Job.updated_at: now
+                           }, synchronize_session=False))
+                session.commit()
+                if claimed:
+                    return session.get(Job, candidate[0])
+            return None
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _fail_expired(self, session):
+        """Mark jobs whose worker died on their last attempt as failed"""
+        now = self._now()
+        expired = (session.query(Job)
+                   .filter(Job.status == 'running', Job.lease_expires_at < now, Job.attempts >= Job.max_attempts)
+                   .update({Job.status: 'failed', Job.error: 'lease expired', Job.lease_owner: None,
+                            Job.updated_at: now}, synchronize_session=False))
+        if expired:
+            session.commit()
+
+    def _update_leased(self, job_id, worker_id, fields):
+        """Update a job only while worker_id still holds its lease; returns False if the lease was lost"""
+        session = self.db.get_session()
+        try:
+            fields[Job.updated_at] = self._now()
+            updated = (session.query(Job)
+                       .filter(Job.id == job_id, Job.status == 'running', Job.lease_owner == worker_id)
+                       .update(fields, synchronize_session=False))
+            session.commit()
+            return bool(updated)
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def heartbeat(self, job_id, worker_id):
+        """Extend the lease of a running job"""
+        return self._update_leased(job_id, worker_id, {
+            Job.lease_expires_at: self._now() + datetime.timedelta(seconds=self.lease_seconds)
+        })
+
+    def complete(self, job_id, worker_id, result=None):
+        return self._update_leased(job_id, worker_id, {
+            Job.status: 'done',
+            Job.result: json.dumps(result) if result is not None else None,
+            Job.error: None,
+            Job.lease_owner: None,
+            Job.lease_expires_at: None
+        })
+
+    def fail(self, job, worker_id, error):
+        """Record a failed attempt of a claimed job: it is retried after a backoff, or marked failed when out of attempts"""
+        if job.attempts >= job.max_attempts:
+            return self._update_leased(job.id, worker_id, {
+                Job.status: 'failed',
+                Job.error: error,
+                Job.lease_owner: None,
+                Job.lease_expires_at: None
+            })
+
+        delay = min(self.retry_backoff * 2 ** (job.attempts - 1), self.max_retry_backoff)
+        return self._update_leased(job.id, worker_id, {
+            Job.status: 'pending',
+            Job.error: error,
+            Job.available_at: self._now() + datetime.timedelta(seconds=delay),
+            Job.lease_owner: None,
+            Job.lease_expires_at: None
+        })
+
+    def release(self, job_id, worker_id, delay=0):
+        """Put a running job back in the queue without counting the attempt"""
+        return self._update_leased(job_id, worker_id, {
+            Job.status: 'pending',
+            Job.attempts: Job.attempts - 1,
+            Job.available_at: self._now() + datetime.timedelta(seconds=delay),
+            Job.lease_owner: None,
+            Job.lease_expires_at: None
+        })
+
+    def get(self, job_id):
+        session = self.db.get_session()
+        try:
+            return session.get(Job, job_id)
+        finally:
+            session.close()
+
+    def find(self, idempotency_key):
+        session = self.db.get_session()
+        try:
+            return session.query(Job).filter(Job.idempotency_key == idempotency_key).first()
+        finally:
+            session.close()
+
+    def unfinished_count(self, operation_id=None, exclude_kinds=()):
+        """Number of pending or running jobs, optionally for one operation and ignoring some kinds"""
+        session = self.db.get_session()
+        try:
+            query = session.query(Job).filter(Job.status.in_(('pending', 'running')))
+            if operation_id is not None:
+                query = query.filter(Job.operation_id == operation_id)
+            if exclude_kinds:
+                query = query.filter(Job.kind.notin_(exclude_kinds))
+            return query.count()
+        finally:
+            session.close()
+
+    def stats(self):
+        """Job counts by kind and status, e.g. {'fetch': {'done': 10, 'pending': 2}}"""
+        session = self.db.get_session()
+        try:
+            counts = {}
+            rows = session.query(Job.kind, Job.status, func.count(Job.id)).group_by(Job.kind, Job.status)
+            for kind, status, count in rows:
+                counts.setdefault(kind, {})[status] = count
+            return counts
+        finally:
+            session.close()
+
+    @staticmethod
+    def payload(job):
+        return json.loads(job.payload) if job.payload else {}
+
+    @staticmethod
+    def result(job):
+        return json.loads(job.result) if job.result else None
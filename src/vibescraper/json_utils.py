@@ -1,57 +1,203 @@
+import atexit
+import hashlib
 import json
 import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from vibescraper.tracing import traced
 
 
-def save_page_json(page_url, page_summary, top_results, output_dir='./results'):
-    """Save page results to a JSON file"""
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+@lru_cache(maxsize=None)
+def _orjson():
+    """orjson is an optional dependency (pip install vibescraper[fast]); the stdlib json module is used without it"""
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
 
-    # Create filename from URL
-    filename = page_url.replace('://', '_').replace('/', '_').replace('.', '_')
-    filepath = os.path.join(output_dir, f"{filename}.json")
 
-    # Create JSON data
+def dumps(data, indent=False):
+    """Serialize to UTF-8 bytes, with orjson when it is installed"""
+    orjson = _orjson()
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(data, indent=4 if indent else None, ensure_ascii=False).encode('utf-8')
+
+
+def result_filename(text, suffix='', max_length=50):
+    """
+    A readable, collision-free file name for a url or query: a sanitized prefix plus a hash of the full text,
+    so different urls that sanitize to the same prefix never overwrite each other.
+    """
+    readable = re.sub(r'[^A-Za-z0-9]+', '_', text).strip('_')[:max_length]
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+    return f"{readable}_{digest}{suffix}"
+
+
+def _write_atomic(filepath, data):
+    """Write to a temporary file next to filepath and rename it into place, so readers never see a partial file"""
+    directory = os.path.dirname(filepath) or '.'
+    os.makedirs(directory, exist_ok=True)
+    while True:
+        # Not mkstemp, which makes the file private (0600): opened like open() would, the umask applies
+        temp_path = os.path.join(directory, f'.tmp-{uuid.uuid4().hex}.json')
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, filepath)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _append(filepath, data):
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filepath, 'ab') as f:
+        f.write(data + b'\n')
+
+
+class ResultWriter:
+    """
+    Writes result files on a background thread so serialization and disk IO stay off the event loop.
+
+    Writes run one at a time in submission order, so appends to a JSONL stream never interleave
+    even when many pages finish at once. flush() waits for everything submitted so far; pending
+    writes are also flushed when the interpreter exits.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='vibescraper-results')
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def _submit(self, fn, *args):
+        future = self._executor.submit(self._run, fn, *args)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    @staticmethod
+    def _run(fn, *args):
+        try:
+            return fn(*args)
+        except Exception as e:
+            print(f"Error writing results to {args[0]}: {e}")
+
+    def _done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def write_json(self, filepath, data):
+        """Serialize data and atomically replace filepath with it"""
+        return self._submit(lambda path, value: _write_atomic(path, dumps(value, indent=True)), filepath, data)
+
+    def append_jsonl(self, filepath, record):
+        """Append one JSON record as a line to filepath"""
+        return self._submit(lambda path, value: _append(path, dumps(value)), filepath, record)
+
+    def flush(self, timeout=None):
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.result(timeout)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_result_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = ResultWriter()
+            atexit.register(_writer.flush)
+        return _writer
+
+
+def flush_results(timeout=None):
+    """Wait until every result file submitted so far has been written"""
+    if _writer is not None:
+        _writer.flush(timeout)
+
+
+def _results_format():
+    from vibescraper.config import results_format
+    return results_format
+
+
+def operation_jsonl_path(operation_id, search_query, output_dir='./results'):
+    """The append-only JSONL stream holding every page and the combined result of one operation"""
+    name = f"operation_{operation_id}" if operation_id else result_filename(search_query)
+    return os.path.join(output_dir, f"{name}.jsonl")
+
+
+@traced('json.write', kind='page')
+def save_page_json(page_url, page_summary, top_results, output_dir='./results', operation_id=None, search_query=None):
+    """
+    Queue the page results for writing and return the path they go to.
+    Writes {url}_{hash}.json, and/or appends to the operation's JSONL stream, depending on config.results_format.
+    """
+    if not top_results:
+        return None
+
     data = {
         'url': page_url,
         'page_summary': page_summary,
         'chunks': []
     }
+    for i, result in enumerate(top_results):
+        data['chunks'].append({
+            'rank': i+1,
+            'chunk_text': result['chunk_text'],
+            'similarity': float(result['similarity']),
+        })
 
-    if top_results:
-        for i, result in enumerate(top_results):
-            data['chunks'].append({
-                'rank': i+1,
-                'chunk_text': result['chunk_text'],
-                'similarity': float(result['similarity']),
-            })
-
-        # Write to JSON file
-        with open(filepath, 'w') as f:
-            json.dump(data, f, indent=4)
-        return filepath
-    return None
-
-
-def save_combined_json(search_query, combined_summary, pages_data, filepath=None):
-    """Save combined results to a JSON file"""
-    # Generate filepath if not provided
-    if not filepath:
-        output_dir = './results'
-        os.makedirs(output_dir, exist_ok=True)
-        filename = search_query.replace(' ', '_').replace(
-            '?', '').replace('/', '_')[:50]
-        filepath = os.path.join(output_dir, f"{filename}_combined.json")
-    else:
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-
-    # Create data structure
+    results_format = _results_format()
+    writer = get_result_writer()
+    filepath = None
+    if results_format in ('jsonl', 'both'):
+        filepath = operation_jsonl_path(operation_id, search_query or page_url, output_dir)
+        writer.append_jsonl(filepath, {'type': 'page', 'operation_id': operation_id, **data})
+    if results_format in ('json', 'both'):
+        filepath = os.path.join(output_dir, result_filename(page_url, '.json'))
+        writer.write_json(filepath, data)
+    return filepath
+
+
+@traced('json.write', kind='combined')
+def save_combined_json(search_query, combined_summary, pages_data, filepath=None, operation_id=None):
+    """
+    Queue the combined results for writing and return the path they go to.
+    Writes {query}_{hash}_combined.json (or filepath), and/or appends to the operation's JSONL stream.
+    """
     data = {
         'combined_summary': combined_summary,
         'pages': pages_data
     }
 
-    # Write to JSON file
-    with open(filepath, 'w') as f:
-        json.dump(data, f, indent=4)
-    return filepath
+    results_format = _results_format()
+    writer = get_result_writer()
+    jsonl_path = None
+    if results_format in ('jsonl', 'both'):
+        jsonl_path = operation_jsonl_path(operation_id, search_query)
+        writer.append_jsonl(jsonl_path, {'type': 'combined', 'operation_id': operation_id,
+                                         'search_query': search_query, **data})
+    if results_format in ('json', 'both') or filepath:
+        if not filepath:
+            filepath = os.path.join('./results', result_filename(search_query, '_combined.json'))
+        writer.write_json(filepath, data)
+    return filepath or jsonl_path
@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class ResponseCache:
+    """
+    Persistent cache of LLM responses, stored in a small SQLite file.
+
+    Entries are keyed by a hash of the model, messages and request parameters,
+    expire after ttl seconds, and the least recently used entries are evicted
+    once the stored responses exceed max_bytes. A running total of the stored size
+    is kept, so eviction only scans the table when it is needed.
+
+    get() and set() block on SQLite; from async code use aget() and aset(), which
+    run them in a worker thread.
+    """
+
+    def __init__(self, path='llm_cache.db', ttl=7 * 24 * 3600, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed_at ON responses (accessed_at)")
+        self._conn.commit()
+        self._total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, messages, **params):
+        payload = json.dumps({'model': model, 'messages': messages, 'params': params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at, size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            response, created_at, size = row
+            if self.ttl is not None and now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self._total -= size
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return response
+
+    def set(self, key, model, response):
+        if response is None:
+            return
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            replaced = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, now, now))
+            self._total += size - (replaced[0] if replaced else 0)
+            if self.max_bytes is not None and self._total > self.max_bytes:
+                self._evict(now)
+            self._conn.commit()
+
+    async def aget(self, key):
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key, model, response):
+        await asyncio.to_thread(self.set, key, model, response)
+
+    def _evict(self, now):
+        """Drop expired entries, then the least recently used ones until the cache is back under 90% of max_bytes"""
+        if self.ttl is not None:
+            expired = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses WHERE created_at < ?", (now - self.ttl,)).fetchone()[0]
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+            self._total -= expired
+
+        # Some headroom, so a full cache doesn't evict on every write
+        target = int(self.max_bytes * 0.9)
+        stale_keys = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC"):
+            if self._total <= target:
+                break
+            stale_keys.append((key,))
+            self._total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._total = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache = None
+
+
+def get_response_cache():
+    """Return the process-wide response cache configured in config.py, or None when disabled"""
+    global _default_cache
+    from vibescraper import config
+
+    if not getattr(config, 'llm_cache_enabled', True):
+        return None
+    if _default_cache is None:
+        _default_cache = ResponseCache(
+            path=config.llm_cache_path,
+            ttl=config.llm_cache_ttl,
+            max_bytes=config.llm_cache_max_bytes,
+        )
+    return _default_cache
@@ -0,0 +1,314 @@
+"""
+Deferred OpenAI requests through the Batch API, for queued searches that don't need low latency.
+
+The worker stage jobs of an operation submitted with deferred=True make their OpenAI calls with a
+BatchBroker active. A call whose response is not known yet is stored as a pending row in the
+`batch_requests` table and the job is put back on the queue (DeferredRequest). The broker gathers
+pending requests into JSONL files, submits them as Batch API jobs (billed at half the synchronous
+price), polls them and stores each response on its row; when the job runs again the same call
+finds its response and the pipeline moves on to the next stage. All state is in the database, so
+workers can be stopped and restarted at any point.
+"""
+import contextvars
+import datetime
+import hashlib
+import json
+import uuid
+from contextlib import contextmanager
+from vibescraper.config import get_client
+
+BATCH_ENDPOINTS = ('/v1/embeddings', '/v1/chat/completions')
+# Batch statuses after which a batch is not polled again
+FINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+_active_broker = contextvars.ContextVar('vibescraper_batch_broker', default=None)
+
+
+class DeferredRequest(Exception):
+    """Raised by an OpenAI call whose response is waiting on a batch; the stage job is retried after `delay` seconds"""
+
+    def __init__(self, pending, delay):
+        super().__init__(f"{pending} OpenAI request(s) waiting on the Batch API")
+        self.pending = pending
+        self.delay = delay
+
+
+class BatchRequestError(RuntimeError):
+    """A deferred request the Batch API answered with an error"""
+
+
+def request_id(endpoint, body):
+    """Stable custom_id of a request, so the same call made again maps to the same row"""
+    payload = json.dumps({'endpoint': endpoint, 'body': body}, sort_keys=True, separators=(',', ':'))
+    return 'vz-' + hashlib.sha256(payload.encode('utf-8')).hexdigest()[:40]
+
+
+def get_batch_broker():
+    """The broker active in the current context, or None for synchronous calls"""
+    return _active_broker.get()
+
+
+class BatchBroker:
+    """
+    Collects deferred OpenAI requests, submits them as Batch API jobs and stores their responses.
+
+    Calls are deferred while `with broker.activate():` is in effect (StageWorker does this for jobs of
+    deferred operations). step() submits and polls; run it every poll_interval (StageWorker does).
+    Several workers can share the database: pending requests are claimed with a compare-and-set
+    UPDATE before they are submitted, as job_queue.JobQueue claims jobs.
+    """
+
+    def __init__(self, db_manager, poll_interval=30.0, collect_seconds=60.0, max_requests=10000,
+                 max_attempts=3, completion_window='24h', claim_timeout=600.0, keep_days=7):
+        """
+        Args:
+            db_manager - DBManager whose database holds the batch tables (create_tables() must have run)
+            poll_interval - seconds between polls, and before a deferred job is retried
+            collect_seconds - pending requests are submitted once the oldest has waited this long
+            max_requests - requests per submitted batch; a full batch is submitted right away
+            max_attempts - batches a request may be submitted in before it is marked failed
+            completion_window - Batch API completion window
+            claim_timeout - seconds after which requests claimed by a submitter that died are pending again
+            keep_days - answered requests are deleted after this many days
+        """
+        self.db = db_manager
+        self.poll_interval = poll_interval
+        self.collect_seconds = collect_seconds
+        self.max_requests = max_requests
+        self.max_attempts = max_attempts
+        self.completion_window = completion_window
+        self.claim_timeout = claim_timeout
+        self.keep_days = keep_days
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.utcnow()
+
+    @contextmanager
+    def activate(self):
+        token = _active_broker.set(self)
+        try:
+            yield self
+        finally:
+            _active_broker.reset(token)
+
+    def results(self, endpoint, bodies):
+        """
+        Response bodies of requests, in order. Requests not answered yet are stored (once) and
+        DeferredRequest is raised after all of them are, so one batch can carry every request of a call.
+        Raises BatchRequestError for a request the Batch API answered with an error.
+        """
+        from sqlalchemy.exc import IntegrityError
+        from vibescraper.db_schema import BatchRequest
+
+        ids = [request_id(endpoint, body) for body in bodies]
+        session = self.db.get_session()
+        try:
+            rows = {row.custom_id: row for row in
+                    session.query(BatchRequest).filter(BatchRequest.custom_id.in_(set(ids)))}
+            now = self._now()
+            for custom_id, body in zip(ids, bodies):
+                if custom_id not in rows:
+                    rows[custom_id] = BatchRequest(custom_id=custom_id, endpoint=endpoint, body=json.dumps(body),
+                                                   status='pending', attempts=0, created_at=now, updated_at=now)
+                    session.add(rows[custom_id])
+            session.commit()
+
+            pending = sum(1 for row in rows.values() if row.status not in ('done', 'failed'))
+            if pending:
+                raise DeferredRequest(pending, self.poll_interval)
+            responses = []
+            for custom_id in ids:
+                row = rows[custom_id]
+                if row.status == 'failed':
+                    raise BatchRequestError(f"Batch request {custom_id} failed: {row.error}")
+                responses.append(json.loads(row.response))
+            return responses
+        except IntegrityError:
+            # Another worker stored the same request first; it is pending either way
+            session.rollback()
+            raise DeferredRequest(len(ids), self.poll_interval)
+        finally:
+            session.close()
+
+    def step(self):
+        """
+        Poll submitted batches, then submit what is ready. Returns what happened, for the caller to report:
+        {'answered': requests answered, 'finished': poll()'s batches, 'submitted': submit()'s batches}
+        """
+        finished = self.poll()
+        submitted = self.submit()
+        answered = sum(batch['answered'] for batch in finished)
+        if answered or submitted:
+            self.prune()
+        return {'answered': answered, 'finished': finished, 'submitted': submitted}
+
+    def submit(self, force=False):
+        """
+        Submit pending requests, one batch per endpoint, once the oldest has waited collect_seconds
+        or max_requests are pending (or right away with force=True).
+        Returns the submitted batches as {'batch_id', 'endpoint', 'requests'} dicts.
+        """
+        from vibescraper.db_schema import BatchRequest, OpenAIBatch
+
+        session = self.db.get_session()
+        try:
+            now = self._now()
+            # Requests claimed by a submitter that died before its batch was created
+            stale = now - datetime.timedelta(seconds=self.claim_timeout)
+            session.query(BatchRequest).filter(
+                BatchRequest.status == 'submitting', BatchRequest.updated_at < stale
+            ).update({BatchRequest.status: 'pending', BatchRequest.batch_id: None}, synchronize_session=False)
+            session.commit()
+
+            submitted = []
+            for endpoint in BATCH_ENDPOINTS:
+                pending = (session.query(BatchRequest.id, BatchRequest.created_at)
+                           .filter(BatchRequest.status == 'pending', BatchRequest.endpoint == endpoint)
+                           .order_by(BatchRequest.id)
+                           .limit(self.max_requests)
+                           .all())
+                if not pending:
+                    continue
+                waited = (now - min(created_at for _, created_at in pending)).total_seconds()
+                if not force and len(pending) < self.max_requests and waited < self.collect_seconds:
+                    continue
+
+                # Only one submitter's UPDATE can match while the requests are still pending
+                token = f'submitting:{uuid.uuid4().hex}'
+                claimed = session.query(BatchRequest).filter(
+                    BatchRequest.id.in_([row_id for row_id, _ in pending]), BatchRequest.status == 'pending'
+                ).update({BatchRequest.status: 'submitting', BatchRequest.batch_id: token,
+                          BatchRequest.updated_at: now}, synchronize_session=False)
+                session.commit()
+                if not claimed:
+                    continue
+
+                claimed_rows = BatchRequest.batch_id == token
+                rows = session.query(BatchRequest).filter(claimed_rows).order_by(BatchRequest.id).all()
+                try:
+                    batch = self._create_batch(endpoint, rows)
+                except Exception:
+                    session.query(BatchRequest).filter(claimed_rows).update(
+                        {BatchRequest.status: 'pending', BatchRequest.batch_id: None}, synchronize_session=False)
+                    session.commit()
+                    raise
+
+                session.add(OpenAIBatch(batch_id=batch.id, endpoint=endpoint, input_file_id=batch.input_file_id,
+                                        status=batch.status, request_count=len(rows), created_at=now, updated_at=now))
+                session.query(BatchRequest).filter(claimed_rows).update({
+                    BatchRequest.status: 'submitted',
+                    BatchRequest.batch_id: batch.id,
+                    BatchRequest.attempts: BatchRequest.attempts + 1,
+                    BatchRequest.updated_at: now
+                }, synchronize_session=False)
+                session.commit()
+                submitted.append({'batch_id': batch.id, 'endpoint': endpoint, 'requests': len(rows)})
+            return submitted
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _create_batch(self, endpoint, rows):
+        lines = ''.join(json.dumps({'custom_id': row.custom_id, 'method': 'POST', 'url': endpoint,
+                                    'body': json.loads(row.body)}) + '\n' for row in rows)
+        client = get_client()
+        input_file = client.files.create(file=('vibescraper_batch.jsonl', lines.encode('utf-8')), purpose='batch')
+        return client.batches.create(input_file_id=input_file.id, endpoint=endpoint,
+                                     completion_window=self.completion_window, metadata={'source': 'vibescraper'})
+
+    def poll(self):
+        """
+        Check every unfinished batch and store the responses of those that ended.
+        Returns the batches that ended as {'batch_id', 'status', 'answered'} dicts.
+        """
+        from vibescraper.db_schema import OpenAIBatch
+
+        session = self.db.get_session()
+        try:
+            finished = []
+            client = get_client()
+            for record in session.query(OpenAIBatch).filter(OpenAIBatch.status.notin_(FINAL_STATUSES)).all():
+                batch = client.batches.retrieve(record.batch_id)
+                now = self._now()
+                record.status = batch.status
+                record.updated_at = now
+                if batch.status in FINAL_STATUSES:
+                    record.output_file_id = batch.output_file_id
+                    record.error_file_id = batch.error_file_id
+                    record.completed_at = now
+                    answered = self._store_results(session, record, now)
+                    finished.append({'batch_id': record.batch_id, 'status': batch.status, 'answered': answered})
+                session.commit()
+            return finished
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _store_results(self, session, record, now):
+        from vibescraper.db_schema import BatchRequest
+
+        items = {}
+        for file_id in (record.output_file_id, record.error_file_id):
+            if file_id:
+                for line in get_client().files.content(file_id).text.splitlines():
+                    if line.strip():
+                        item = json.loads(line)
+                        items[item['custom_id']] = item
+
+        answered = 0
+        for row in session.query(BatchRequest).filter(BatchRequest.batch_id == record.batch_id,
+                                                      BatchRequest.status == 'submitted'):
+            item = items.get(row.custom_id)
+            response = (item or {}).get('response') or {}
+            if item is not None and response.get('status_code') == 200:
+                row.status = 'done'
+                row.response = json.dumps(response['body'])
+                answered += 1
+            elif item is not None:
+                row.status = 'failed'
+                row.error = json.dumps(item.get('error') or response.get('body'))
+                answered += 1
+            elif row.attempts >= self.max_attempts:
+                row.status = 'failed'
+                row.error = f"not answered in {row.attempts} batches (last {record.batch_id}: {record.status})"
+                answered += 1
+            else:
+                # Not run before the batch expired, failed or was cancelled: it goes into the next batch
+                row.status = 'pending'
+                row.batch_id = None
+            row.updated_at = now
+        return answered
+
+    def prune(self):
+        """Delete requests answered more than keep_days ago"""
+        from vibescraper.db_schema import BatchRequest
+
+        session = self.db.get_session()
+        try:
+            cutoff = self._now() - datetime.timedelta(days=self.keep_days)
+            deleted = session.query(BatchRequest).filter(
+                BatchRequest.status.in_(('done', 'failed')), BatchRequest.updated_at < cutoff
+            ).delete(synchronize_session=False)
+            session.commit()
+            return deleted
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def stats(self):
+        """Number of batch requests by status"""
+        from sqlalchemy import func
+        from vibescraper.db_schema import BatchRequest
+
+        session = self.db.get_session()
+        try:
+            return dict(session.query(BatchRequest.status, func.count(BatchRequest.id)).group_by(BatchRequest.status).all())
+        finally:
+            session.close()
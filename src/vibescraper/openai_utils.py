@@ -1,6 +1,59 @@
-from openai import OpenAI
-from vibescraper.config import client
-import tiktoken
+import asyncio
+import contextvars
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
+from vibescraper.config import get_client
+from vibescraper.hedging import get_hedging
+from vibescraper.llm_cache import ResponseCache, get_response_cache
+from vibescraper.openai_batch import BatchRequestError, get_batch_broker
+from vibescraper.tracing import span
+from vibescraper.usage import record_usage
+
+
+_request_limit = contextvars.ContextVar('vibescraper_request_limit', default=None)
+
+
+@contextmanager
+def request_limit(semaphore):
+    """Cap the concurrent OpenAI requests made in this context with an asyncio.Semaphore (None: no cap)"""
+    token = _request_limit.set(semaphore)
+    try:
+        yield semaphore
+    finally:
+        _request_limit.reset(token)
+
+
+def _request_slot():
+    semaphore = _request_limit.get()
+    return semaphore if semaphore is not None else nullcontext()
+
+
+async def _create(kind, create, **kwargs):
+    """Run a client call off the event loop, hedged per model while hedging is active (see hedging)"""
+    hedging = get_hedging()
+    if hedging is None:
+        return await asyncio.to_thread(create, **kwargs)
+    attempts = []
+
+    def attempt():
+        task = asyncio.ensure_future(asyncio.to_thread(create, **kwargs))
+        attempts.append(task)
+        # Shielded: a call the hedge race cancels keeps running in its thread, and its reply is still billed
+        return asyncio.shield(task)
+
+    response = None
+    try:
+        response = await hedging.llm.run(attempt, key=f"{kind}:{kwargs.get('model')}")
+        return response
+    finally:
+        for task in attempts:
+            task.add_done_callback(partial(_record_dropped, kind, kwargs.get('model'), response))
+
+
+def _record_dropped(kind, model, kept, task):
+    """Report the usage of a hedged call whose reply was not the one used (the caller reports that one)"""
+    if not task.cancelled() and task.exception() is None and task.result() is not kept:
+        record_usage(kind, model, getattr(task.result(), 'usage', None))
 
 
 ### Embeddings
@@ -10,15 +63,43 @@ import tiktoken
 
 """
 encoding_name = 'cl100k_base'
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name=encoding_name):
+    """tiktoken is imported and its encodings loaded on first use, then kept warm"""
+    import tiktoken
+    return tiktoken.get_encoding(name)
+
+
+@lru_cache(maxsize=None)
+def get_model_encoding(model):
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
 class EmbeddingModels:
     large = "text-embedding-3-large"
     small = "text-embedding-3-small"
     legacy = "text-embedding-ada-002"
 
+def count_tokens(text):
+    """Approximate token count of a text using the shared cl100k_base encoding"""
+    return len(get_encoding().encode(text))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Truncate a text to at most max_tokens cl100k_base tokens"""
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
 def truncate_to_token_limit(text, model):
 
     max_tokens = 8191
-    encoding = tiktoken.encoding_for_model(model)
+    encoding = get_model_encoding(model)
     tokens = encoding.encode(text)
     length = len(tokens)
 
@@ -31,8 +112,8 @@ def truncate_to_token_limit(text, model):
     return truncated_text
 
 
-async def get_embedding(text, model='small', dimensions=3072, encoding_format="float"):
-
+def resolve_embedding_model(model, dimensions):
+    """Map a short model name (small, large, legacy) to the OpenAI model and the dimensions it supports"""
     if model == 'small':
         model = EmbeddingModels.small
         if dimensions > 1536:
@@ -45,18 +126,77 @@ async def get_embedding(text, model='small', dimensions=3072, encoding_format="f
         model = EmbeddingModels.legacy
         if dimensions > 1536:
             dimensions = 1536
+    return model, dimensions
+
+
+async def get_embedding(text, model='small', dimensions=3072, encoding_format="float"):
+
+    model, dimensions = resolve_embedding_model(model, dimensions)
 
     truncated_text = truncate_to_token_limit(text, model)
 
-    response = client.embeddings.create(
-        input=truncated_text,
-        model=model,
-        encoding_format=encoding_format,
-        dimensions=dimensions
-    )
+    broker = get_batch_broker()
+    if broker is not None:
+        response = broker.results('/v1/embeddings', [{'input': truncated_text, 'model': model, 'encoding_format': encoding_format, 'dimensions': dimensions}])[0]
+        record_usage('embedding', model, response.get('usage'), batch=True)
+        return response['data'][0]['embedding']
+
+    async with _request_slot():
+        with span('embed', model=model, dimensions=dimensions, chars=len(truncated_text)):
+            response = await _create(
+                'embedding',
+                get_client().embeddings.create,
+                input=truncated_text,
+                model=model,
+                encoding_format=encoding_format,
+                dimensions=dimensions
+            )
+    record_usage('embedding', model, getattr(response, 'usage', None))
     return response.data[0].embedding
 
 
+async def get_embeddings(texts, model='small', dimensions=3072, encoding_format="float", batch_size=128):
+    """Embed many texts with one request per batch_size texts; returns embeddings in input order"""
+    model, dimensions = resolve_embedding_model(model, dimensions)
+
+    broker = get_batch_broker()
+    if broker is not None:
+        return _batch_embeddings(broker, texts, model, dimensions, encoding_format, batch_size)
+
+    embeddings = []
+    for start in range(0, len(texts), batch_size):
+        batch = [truncate_to_token_limit(text, model) for text in texts[start:start + batch_size]]
+        async with _request_slot():
+            with span('embed', model=model, dimensions=dimensions, texts=len(batch), chars=sum(len(t) for t in batch)):
+                response = await _create(
+                    'embedding',
+                    get_client().embeddings.create,
+                    input=batch,
+                    model=model,
+                    encoding_format=encoding_format,
+                    dimensions=dimensions
+                )
+        record_usage('embedding', model, getattr(response, 'usage', None))
+        embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+    return embeddings
+
+
+def _batch_embeddings(broker, texts, model, dimensions, encoding_format, batch_size):
+    """get_embeddings through the Batch API: every request of the call is deferred together"""
+    bodies = [{
+        'input': [truncate_to_token_limit(text, model) for text in texts[start:start + batch_size]],
+        'model': model,
+        'encoding_format': encoding_format,
+        'dimensions': dimensions
+    } for start in range(0, len(texts), batch_size)]
+
+    embeddings = []
+    for response in broker.results('/v1/embeddings', bodies):
+        record_usage('embedding', model, response.get('usage'), batch=True)
+        embeddings.extend(item['embedding'] for item in sorted(response['data'], key=lambda item: item['index']))
+    return embeddings
+
+
 
 ### Text Generator
 """
@@ -90,19 +230,146 @@ class TextModels:
     nano41 = "gpt-4.1-nano"
 
 
-async def generate(system_message, prompt, model=TextModels.latest):
+# Stages that can each use their own text model
+TEXT_MODEL_STAGES = ('expand', 'page', 'reduce', 'report')
+# A stage without its own model falls back to these stages, then to 'default'
+_STAGE_FALLBACKS = {'reduce': ('report',)}
+
+
+def route_model(text_model, stage):
+    """
+    The model for one pipeline stage. text_model is either one model name for every stage, or a dict
+    of stage -> model ('expand', 'page', 'reduce', 'report') with an optional 'default' for the rest,
+    e.g. {'default': 'gpt-4.1-mini', 'report': 'gpt-4.1'}.
+    """
+    if not isinstance(text_model, dict):
+        return text_model
+    for name in (stage, *_STAGE_FALLBACKS.get(stage, ()), 'default'):
+        if text_model.get(name):
+            return text_model[name]
+    return TextModels.latest
+
+
+def _next_chunk(stream):
+    return next(stream, None)
+
+
+def _completion_options(max_tokens):
+    return {'max_tokens': max_tokens} if max_tokens else {}
+
+
+async def _stream_generate(messages, model, cache, cache_key, max_tokens=None):
+    """Yield text deltas of a streamed completion, replaying or filling the response cache"""
+    if cache is not None:
+        cached = await cache.aget(cache_key)
+        if cached is not None:
+            record_usage('chat', model, cached=True)
+            yield cached
+            return
+
+    try:
+        async with _request_slot():
+            stream = await asyncio.to_thread(
+                get_client().chat.completions.create,
+                model=model,
+                temperature=0,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True},
+                **_completion_options(max_tokens)
+            )
+    except Exception as e:
+        print(e)
+        return
+
+    parts = []
+    while True:
+        chunk = await asyncio.to_thread(_next_chunk, stream)
+        if chunk is None:
+            break
+        if getattr(chunk, 'usage', None) is not None:
+            record_usage('chat', model, chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            yield delta
+
+    if cache is not None and parts:
+        await cache.aset(cache_key, model, ''.join(parts))
+
+
+def _batch_generate(broker, model, messages, options):
+    """The completion of a chat request answered through the Batch API; raises DeferredRequest until it is"""
+    try:
+        response = broker.results('/v1/chat/completions', [{'model': model, 'temperature': 0, 'messages': messages, **options}])[0]
+    except BatchRequestError as e:
+        print(e)
+        return None
+    record_usage('chat', model, response.get('usage'), batch=True)
+    return response['choices'][0]['message']['content']
+
+
+async def _replay(text):
+    if text:
+        yield text
+
+
+async def generate(system_message, prompt, model=TextModels.latest, use_cache=True, stream=False, max_tokens=None):
+    """
+    Generate a completion for a system message and prompt.
+
+    Responses are cached (see config.llm_cache_*) keyed by model and messages; pass use_cache=False to bypass.
+    With stream=True an async iterator of text deltas is returned instead of the full text.
+    max_tokens caps the length of the completion. Token usage is reported to the active usage meters.
+    With a BatchBroker active (openai_batch) the request goes through the Batch API instead.
+    """
     messages = []
     messages.append({"role": "system", "content": system_message})
     messages.append({"role": "user", "content": prompt})
 
+    cache = get_response_cache() if use_cache else None
+    options = _completion_options(max_tokens)
+    cache_key = ResponseCache.make_key(model, messages, temperature=0, **options) if cache is not None else None
+
+    broker = get_batch_broker()
+    if stream:
+        if broker is not None:
+            # Batch API responses arrive whole
+            return _replay(await generate(system_message, prompt, model, use_cache, max_tokens=max_tokens))
+        return _stream_generate(messages, model, cache, cache_key, max_tokens)
+
+    if cache is not None:
+        cached = await cache.aget(cache_key)
+        if cached is not None:
+            record_usage('chat', model, cached=True)
+            with span('llm.generate', model=model, cached=True):
+                return cached
+
+    if broker is not None:
+        content = _batch_generate(broker, model, messages, options)
+        if cache is not None and content is not None:
+            await cache.aset(cache_key, model, content)
+        return content
+
     try:
-        response = client.chat.completions.create(
-            model=model,
-            temperature=0,
-            messages=messages
-        )
+        async with _request_slot():
+            with span('llm.generate', model=model, cached=False, prompt_chars=len(prompt)):
+                response = await _create(
+                    'chat',
+                    get_client().chat.completions.create,
+                    model=model,
+                    temperature=0,
+                    messages=messages,
+                    **options
+                )
+        record_usage('chat', model, getattr(response, 'usage', None))
 
-        return response.choices[0].message.content
+        content = response.choices[0].message.content
+        if cache is not None:
+            await cache.aset(cache_key, model, content)
+        return content
 
 
     except Exception as e:
@@ -1,16 +1,191 @@
 from typing import Dict, List, Optional, Union
 import numpy as np
 import asyncio
-from vibescraper.openai_utils import get_embedding, generate
+from vibescraper.embeddings import get_embedding_provider
+from vibescraper.openai_utils import generate, count_tokens, truncate_to_tokens, route_model
 from vibescraper.json_utils import save_page_json, save_combined_json
-import re
-import ast
-import json
-import os
-import inspect
-import sys
-import subprocess
+from vibescraper.summarizer import MapReduceSummarizer
 from vibescraper.timer_decorator import timer
+from vibescraper.tracing import span
+
+
+QUERY_TRANSFORM_SYSTEM_MSG = "You are an expert research assistant. Given a short search engine query, expand it into a detailed, context-rich statement that clearly explains the user's information need. Restate the query as a full sentence or paragraph. Add synonyms and related concepts to broaden the scope. Clarify any ambiguous terms or phrases. Include any relevant background or context that might help a search engine or AI system find the most relevant information."
+
+
+async def embed_expanded_query(search_query, text_model='gpt-4o', embedding_model='small', dimensions=1536, page_url=None):
+    """Expand a short search query with the text model (its 'expand' stage model) and return the embedding of the expansion"""
+    query_transform_prompt = f"Original Query: '{search_query}'. Expanded, Detailed Version:"
+
+    with span('expand_query', url=page_url):
+        expanded_query = await generate(QUERY_TRANSFORM_SYSTEM_MSG, query_transform_prompt, model=route_model(text_model, 'expand'))
+    print('Expanded query: ', expanded_query)
+
+    return await get_embedding_provider(embedding_model, dimensions).embed_one(expanded_query)
+
+
+def embedding_matrix(embeddings):
+    """Pack embeddings (lists of floats or arrays) into one contiguous float32 matrix, one row per embedding"""
+    if len(embeddings) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def cosine_similarities(matrix, query_embedding):
+    """Cosine similarity of every row of matrix with query_embedding"""
+    query = np.asarray(query_embedding, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+    norms[norms == 0] = np.finfo(np.float32).tiny
+    return (matrix @ query) / norms
+
+
+def rank_indices(similarities, k=None):
+    """Indices of the k highest similarities, best first (all of them when k is None)"""
+    if k is not None and k < len(similarities):
+        candidates = np.argpartition(-similarities, k)[:k]
+        return candidates[np.argsort(-similarities[candidates], kind='stable')]
+    return np.argsort(-similarities, kind='stable')
+
+
+# Default token budget of a page summary prompt (header plus chunks)
+PAGE_PROMPT_TOKENS = 3000
+
+
+def build_chunk_prompt(header, chunk_texts, token_counts, max_tokens, separator=', '):
+    """
+    header followed by the chunks, in the given (best first) order, that fit in max_tokens, using
+    precomputed chunk token counts. Chunks that do not fit are left out whole; only a first chunk
+    that is larger than the whole budget is truncated. Returns (prompt, number of chunks used).
+    """
+    remaining = max_tokens - count_tokens(header)
+    parts = [header]
+    used = 0
+    for text, tokens in zip(chunk_texts, token_counts):
+        # Each separator costs about one token
+        if tokens + 1 <= remaining:
+            parts.append(separator + text)
+            remaining -= tokens + 1
+            used += 1
+        elif used == 0 and remaining > 1:
+            parts.append(separator + truncate_to_tokens(text, remaining - 1))
+            used += 1
+            break
+    return ''.join(parts), used
+
+
+COARSE_DIMS = 256
+COARSE_DTYPES = ('int8', 'float16')
+# Rows upcast to float32 at a time in the coarse pass, so large pools never get a full float32 copy
+COARSE_BLOCK_ROWS = 8192
+
+
+def coarse_vectors(matrix, dims=COARSE_DIMS, dtype='int8'):
+    """
+    Reduced-dimension copies of embeddings (a matrix, or a single vector): the first `dims` components,
+    renormalized to unit length and stored as float16, or as int8 scaled by 127.
+    text-embedding-3 vectors are trained so that a truncated prefix is itself a usable embedding.
+    """
+    if dtype not in COARSE_DTYPES:
+        raise ValueError(f"Unknown coarse dtype: {dtype} (expected one of {', '.join(COARSE_DTYPES)})")
+    coarse = np.asarray(matrix, dtype=np.float32)[..., :dims]
+    norms = np.linalg.norm(coarse, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    coarse = coarse / norms
+    if dtype == 'int8':
+        return np.round(coarse * 127.0).astype(np.int8)
+    return coarse.astype(np.float16)
+
+
+def coarse_similarities(coarse, query_coarse):
+    """Approximate cosine similarity of every coarse row with a coarse query vector"""
+    scale = 127.0 * 127.0 if coarse.dtype == np.int8 else 1.0
+    query = np.asarray(query_coarse, dtype=np.float32) / scale
+    similarities = np.empty(len(coarse), dtype=np.float32)
+    for start in range(0, len(coarse), COARSE_BLOCK_ROWS):
+        block = coarse[start:start + COARSE_BLOCK_ROWS]
+        similarities[start:start + len(block)] = block.astype(np.float32) @ query
+    return similarities
+
+
+def two_stage_rank(matrix, query_embedding, k=None, coarse_dims=None, coarse_dtype='int8', shortlist=None, coarse=None):
+    """
+    Rank the rows of matrix against query_embedding; returns (indices best first, similarities).
+
+    Without coarse_dims every row is scored exactly. With it, every row is first scored on its
+    coarse vector (see coarse_vectors; pass `coarse` to reuse precomputed ones), and only the
+    `shortlist` best (default max(4k, 32)) are re-scored at full dimension. Shortlisted rows come
+    first in exact order, the rest follow in coarse order; similarities holds the exact score for
+    shortlisted rows and the coarse estimate for the others.
+    """
+    query = np.asarray(query_embedding, dtype=np.float32)
+    shortlist = shortlist or max(4 * (k or 0), 32)
+    if not coarse_dims or coarse_dims >= matrix.shape[1] or len(matrix) <= shortlist:
+        similarities = cosine_similarities(matrix, query)
+        return rank_indices(similarities, k), similarities
+
+    if coarse is None:
+        coarse = coarse_vectors(matrix, coarse_dims, coarse_dtype)
+    similarities = coarse_similarities(coarse, coarse_vectors(query, coarse_dims, coarse.dtype.name))
+    candidates = rank_indices(similarities, shortlist)
+
+    exact = cosine_similarities(matrix[candidates], query)
+    exact_order = np.argsort(-exact, kind='stable')
+    candidates = candidates[exact_order]
+    similarities[candidates] = exact[exact_order]
+    if k is not None and k <= shortlist:
+        return candidates[:k], similarities
+
+    rest = np.ones(len(matrix), dtype=bool)
+    rest[candidates] = False
+    rest = np.flatnonzero(rest)
+    order = np.concatenate([candidates, rest[rank_indices(similarities[rest])]])
+    return order[:k] if k is not None else order, similarities
+
+
+def coarse_format(dims=COARSE_DIMS, dtype='int8'):
+    """The label stored next to persisted coarse vectors, e.g. 'int8:256'"""
+    return f"{dtype}:{dims}"
+
+
+def parse_coarse_format(label):
+    dtype, dims = label.split(':')
+    return dtype, int(dims)
+
+
+class ChunkResult:
+    """
+    A ranked chunk. The embedding is not copied into the record: it is row `row` of a float32
+    matrix shared by all results of the same page (or of the combined ranking).
+    Supports result['chunk_text'] style access for code written against the old dict results.
+    """
+    __slots__ = ('chunk_text', 'matrix', 'row', 'similarity', 'rank', 'page_url', 'tokens')
+
+    def __init__(self, chunk_text, matrix, row, similarity, rank=None, page_url=None, tokens=None):
+        self.chunk_text = chunk_text
+        self.matrix = matrix
+        self.row = row
+        self.similarity = float(similarity)
+        self.rank = rank
+        self.page_url = page_url
+        # Token count of chunk_text, counted once and reused for prompt budgets
+        self.tokens = tokens
+
+    @property
+    def embedding(self):
+        return self.matrix[self.row]
+
+    def __getitem__(self, key):
+        if key not in self.__slots__ and key != 'embedding':
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return f"<ChunkResult(rank={self.rank}, similarity={self.similarity:.4f}, url={self.page_url})>"
 
 
 class PageEmbeddingProcessor:
@@ -19,123 +194,235 @@ class PageEmbeddingProcessor:
     and find top K most similar chunks to a search query.
     """
 
-    def __init__(self, page_url, search_query=None, db_manager=None, operation_id=None, text_model='gpt-4o', embedding_model='small', dimensions=1536, top_k=5):
+    def __init__(self, page_url, search_query=None, db_manager=None, operation_id=None, text_model='gpt-4o', embedding_model='small', dimensions=1536, top_k=5, page_id=None, first_pass=None, first_pass_candidates=None, coarse_dims=None, token_allowance=None, prompt_tokens=PAGE_PROMPT_TOKENS):
         self.page_url = page_url
         self.search_query = search_query
         self.chunks = []
-        self.embeddings = []
+        # float32 matrix, one row per chunk; released with the chunks once top_results are picked
+        self.embeddings = None
         self.query_embedding = None
         self.top_results = None
         self.page_summary = ""
         self.db_manager = db_manager
         self.operation_id = operation_id
-        self.page_id = None
+        self.page_id = page_id
         self.model = embedding_model
+        self.provider = get_embedding_provider(embedding_model, dimensions)
         self.text_model = text_model
         self.dimensions = dimensions
         self.top_k = top_k
-
-        if db_manager and operation_id:
+        # Optional cheap model (e.g. 'hashing') that pre-ranks chunks so only the best candidates get the main embedding
+        self.first_pass = first_pass
+        self.first_pass_candidates = first_pass_candidates or 4 * top_k
+        # With coarse_dims, chunks are shortlisted on truncated low-dimension vectors before exact scoring
+        self.coarse_dims = coarse_dims
+        # Optional token cap for this page (see usage.TokenBudget); bounds the chunks embedded and the summary length
+        self.token_allowance = token_allowance
+        self.summary_max_tokens = None
+        # Token budget of the page summary prompt
+        self.prompt_tokens = prompt_tokens
+        self._token_counts = {}
+
+    async def create_record(self):
+        """Create the page's database record through the database writer, unless page_id was given"""
+        # A given page_id means an existing page record is being re-processed
+        if self.db_manager and self.operation_id and self.page_id is None:
             try:
-                self.page_id = db_manager.create_page(operation_id, page_url)
+                self.page_id = await self.db_manager.create('create_page', self.operation_id, self.page_url)
                 print(f"Created page record with ID: {self.page_id}")
             except Exception as e:
                 print(f"Error creating page record: {e}")
 
-    async def process_chunks(self, chunks):
-        """Process semantic chunks from a single page"""
-        self.chunks = chunks
+    async def process_chunks(self, chunks, query_embedding=None):
+        """
+        Process semantic chunks from a single page.
+        Pass query_embedding to reuse an already expanded and embedded query.
 
-        self.embeddings = []
-        for chunk in chunks:
-            embedding = await get_embedding(chunk, model=self.model, dimensions=self.dimensions)
-            self.embeddings.append(embedding)
+        Once the top k chunks are selected the per-chunk state (chunk texts and the embedding
+        matrix) is released; only top_results and their small embedding matrix are kept.
+        """
+        if self.first_pass and self.search_query:
+            chunks = await self.first_pass_filter(chunks)
+        if self.token_allowance is not None:
+            chunks = await self.fit_to_allowance(chunks)
 
+        await self.embed_chunks(chunks)
 
         if self.search_query:
+            if query_embedding is None:
+                query_embedding = await embed_expanded_query(
+                    self.search_query, self.text_model, self.model, self.dimensions, page_url=self.page_url)
 
-            query_transform_system_msg = "You are an expert research assistant. Given a short search engine query, expand it into a detailed, context-rich statement that clearly explains the user's information need. Restate the query as a full sentence or paragraph. Add synonyms and related concepts to broaden the scope. Clarify any ambiguous terms or phrases. Include any relevant background or context that might help a search engine or AI system find the most relevant information."
-
-            query_transform_prompt = f"Original Query: '{self.search_query}'. Expanded, Detailed Version:"
-
-            expanded_query = await generate(query_transform_system_msg, query_transform_prompt, model=self.text_model)
-            print('Expanded query: ', expanded_query)
-
-            self.query_embedding = await get_embedding(expanded_query, model=self.model, dimensions=self.dimensions)
+            self.query_embedding = query_embedding
             self.top_results = await self._find_top_similar(self.query_embedding, k=self.top_k)
+            self.release_chunks()
+
+        return self.top_results
+
+    @classmethod
+    def from_stored(cls, page, search_query=None, db_manager=None, query_embedding=None, **settings):
+        """
+        Rebuild a processor from a stored Page (with its chunks loaded) without calling any API.
+        Similarities are recomputed against query_embedding when given, the stored ones are kept otherwise.
+        """
+        processor = cls(page.url, search_query, db_manager, page.operation_id, page_id=page.id, **settings)
+        processor.page_summary = page.page_summary or ""
+        processor.query_embedding = query_embedding
+
+        stored = sorted((c for c in page.chunks if c.embedding is not None), key=lambda c: c.rank or 0)
+        matrix = embedding_matrix([chunk.embedding for chunk in stored])
+        if query_embedding is not None and stored:
+            similarities = cosine_similarities(matrix, query_embedding)
+        else:
+            similarities = [chunk.similarity or 0.0 for chunk in stored]
+        processor.top_results = [
+            ChunkResult(chunk.chunk_text, matrix, row, similarities[row], rank=chunk.rank, page_url=page.url,
+                        tokens=chunk.token_count)
+            for row, chunk in enumerate(stored)
+        ]
+        return processor
+
+    async def first_pass_filter(self, chunks, candidates=None):
+        """Keep the first_pass_candidates (or candidates) chunks the first-pass model ranks highest for the search query, in page order"""
+        candidates = candidates or self.first_pass_candidates
+        if len(chunks) <= candidates:
+            return chunks
+
+        first_pass = get_embedding_provider(self.first_pass or 'hashing', self.dimensions)
+        with span('first_pass', url=self.page_url, model=first_pass.name, chunks=len(chunks), candidates=candidates):
+            matrix = await first_pass.embed(chunks)
+            query = await first_pass.embed_one(self.search_query)
+            keep = np.sort(rank_indices(cosine_similarities(matrix, query), candidates))
+        return [chunks[i] for i in keep]
+
+    async def fit_to_allowance(self, chunks):
+        """
+        Keep the page within token_allowance: half of it goes to embedding chunks, a quarter to the summary
+        prompt and a quarter to the summary itself. When the chunks don't fit, the ones the local first-pass
+        model ranks highest are kept.
+        """
+        self.summary_max_tokens = max(64, min(1024, self.token_allowance // 4))
+        if not chunks:
+            return chunks
+
+        tokens = sum(self.token_counts(chunks))
+        embed_tokens = self.token_allowance // 2
+        if tokens <= embed_tokens:
+            return chunks
+        keep = max(1, int(embed_tokens * len(chunks) / tokens))
+        print(f"Token budget: embedding {keep} of {len(chunks)} chunks for {self.page_url}")
+        if self.search_query:
+            return await self.first_pass_filter(chunks, candidates=keep)
+        return chunks[:keep]
 
+    def token_counts(self, chunks):
+        """Token counts of chunk texts, each counted once per page"""
+        counts = self._token_counts
+        for chunk in chunks:
+            if chunk not in counts:
+                counts[chunk] = count_tokens(chunk)
+        return [counts[chunk] for chunk in chunks]
+
+    async def embed_chunks(self, chunks):
+        """Embed every chunk of the page, in batches, into the float32 matrix self.embeddings"""
+        self.chunks = chunks
+        self.embeddings = await self.provider.embed(chunks)
         return self.embeddings
 
+    def release_chunks(self):
+        """Drop the per-chunk texts and embeddings, keeping only top_results"""
+        self.chunks = []
+        self.embeddings = None
+        self._token_counts = {}
+
     async def _find_top_similar(self, query_embedding, k=5):
-        """Find top k chunks most similar to query embedding"""
-        if not self.embeddings:
+        """Find top k chunks most similar to query embedding, summarize them and store the results"""
+        results = self.rank_chunks(query_embedding, k)
+        if not results:
             return []
 
-        similarities = []
-        for i, emb in enumerate(self.embeddings):
-            similarity = self._cosine_similarity(query_embedding, emb)
-            similarities.append((i, similarity))
+        await self.summarize(results)
+        await self.store_results(results)
+        return results
 
-        similarities.sort(key=lambda x: x[1], reverse=True)
+    def rank_chunks(self, query_embedding, k=5):
+        """Return the top k chunks most similar to query embedding as ChunkResults"""
+        if self.embeddings is None or len(self.embeddings) == 0:
+            return []
+        if not isinstance(self.embeddings, np.ndarray):
+            self.embeddings = embedding_matrix(self.embeddings)
 
-        top_k = similarities[:k]
-        results = []
+        with span('similarity', url=self.page_url, chunks=len(self.embeddings)):
+            top_indices, similarities = two_stage_rank(self.embeddings, query_embedding, k, self.coarse_dims)
 
-        for i, (idx, sim) in enumerate(top_k):
-            results.append({
-                'chunk_text': self.chunks[idx],
-                'embedding': self.embeddings[idx],
-                'similarity': float(sim),
-                'rank': i + 1
-            })
+        # Copy just the top rows so the full page matrix can be freed
+        top_embeddings = self.embeddings[top_indices]
+        top_chunks = [self.chunks[idx] for idx in top_indices]
+        results = []
 
+        for i, (idx, tokens) in enumerate(zip(top_indices, self.token_counts(top_chunks))):
+            results.append(ChunkResult(
+                self.chunks[idx],
+                top_embeddings,
+                i,
+                similarities[idx],
+                rank=i + 1,
+                page_url=self.page_url,
+                tokens=tokens
+            ))
+        return results
 
+    async def summarize(self, results):
+        """Generate the referenced page summary from the given top chunks"""
         summary_str = f'Given the following query: {
             self.search_query}, please summarize the following information scraped from {self.page_url}: '
 
-        chunk_string = ''
-        for result in results:
-            chunk_string += f', {result["chunk_text"]}'
-
-        summary_str += chunk_string
+        # Best chunks first, as many as fit the prompt budget (tighter when a token budget applies)
+        prompt_tokens = self.prompt_tokens
+        if self.token_allowance is not None:
+            prompt_tokens = min(prompt_tokens, max(256, self.token_allowance // 4))
+        counts = [result.tokens if result.tokens is not None else count_tokens(result.chunk_text) for result in results]
+        summary_str, used = build_chunk_prompt(summary_str, [result.chunk_text for result in results], counts, prompt_tokens)
 
         system_message = 'You goal is to summarize a given set of scraped web data into a summary, based on a query. Create a fully referenced summary such that any information contained in the summary has a sourced reference in brackets as follows: (reference: <quote>, source: <url>). Note, the <quote> MUST be an actual snippet from the given source material, and the source <url> must be the exact given source url that snippet was taken from.'
 
-        self.page_summary = await generate(system_message, summary_str, model=self.text_model)
+        model = route_model(self.text_model, 'page')
+        with span('summarize.page', url=self.page_url, chunks=used, model=model):
+            self.page_summary = await generate(system_message, summary_str, model=model,
+                                               max_tokens=self.summary_max_tokens)
         print('Generated page summary for: ', self.page_url)
         print('\n')
         print(self.page_summary)
+        return self.page_summary
 
+    async def store_results(self, results, summary=True):
+        """Queue the top chunks, and the page summary unless summary=False, for the database (see DBManager.write)"""
         if self.db_manager and self.page_id and self.operation_id:
             try:
                 # Update page summary
-                self.db_manager.update_page_summary(
-                    self.page_id, self.page_summary)
+                if summary:
+                    await self.db_manager.write('update_page_summary', self.page_id, self.page_summary)
 
-                # Store chunks
+                # Store chunks, each with its coarse vector for two-stage retrieval over stored runs
+                dims = self.coarse_dims or COARSE_DIMS
                 for result in results:
-                    self.db_manager.create_chunk(
+                    coarse_vector = coarse_vectors(result.embedding, dims)
+                    await self.db_manager.write(
+                        'create_chunk',
                         self.page_id,
                         self.operation_id,
-                        result['chunk_text'],
-                        result['embedding'],
-                        result['similarity'],
-                        result['rank']
+                        result.chunk_text,
+                        result.embedding.tolist(),
+                        result.similarity,
+                        result.rank,
+                        coarse_embedding=coarse_vector.tobytes(),
+                        coarse_format=coarse_format(len(coarse_vector)),
+                        token_count=result.tokens
                     )
             except Exception as e:
                 print(f"Error storing data in database: {e}")
 
-        return results
-
-
 
-    def _cosine_similarity(self, a, b):
-        """Calculate cosine similarity between two vectors"""
-        if not isinstance(a, np.ndarray):
-            a = np.array(a)
-        if not isinstance(b, np.ndarray):
-            b = np.array(b)
-        return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
 
     def save_to_json(self, output_dir='./results'):
         """Save page results to JSON file (completely separate from DB operations)"""
@@ -144,7 +431,9 @@ class PageEmbeddingProcessor:
                 self.page_url,
                 self.page_summary,
                 self.top_results,
-                output_dir
+                output_dir,
+                operation_id=self.operation_id,
+                search_query=self.search_query
             )
             if filepath:
                 print(f"Saved page results to: {filepath}")
@@ -157,28 +446,44 @@ class CombinedResultsProcessor:
     Process the top results from all pages and perform a final similarity search.
     """
 
-    def __init__(self, search_query, db_manager=None, text_model='gpt-4o', embedding_model='small', dimensions=1536, top_k=5):
+    def __init__(self, search_query, db_manager=None, text_model='gpt-4o', embedding_model='small', dimensions=1536, top_k=5, summary_batch_tokens=6000, operation_id=None, coarse_dims=None, summary_max_tokens=None):
         self.search_query = search_query
         self.query_embedding = None
         self.page_results = []
         self.combined_results = None
         self.combined_summary = ''
         self.top_results = []
-        self.all_embeddings = []
-        self.all_chunks = []
-        self.page_urls = []
+        # Every page's top results, and their embeddings stacked into one float32 matrix
+        self.candidates = []
+        self.all_embeddings = None
 
         # Database related attributes
         self.db_manager = db_manager
-        self.operation_id = None
+        self.operation_id = operation_id
         self.model = embedding_model
         self.text_model = text_model
         self.dimensions = dimensions
         self.top_k = top_k
-
-        if db_manager:
+        self.summary_batch_tokens = summary_batch_tokens
+        self.coarse_dims = coarse_dims
+        # Completion cap for the combined summary, set when a token budget applies
+        self.summary_max_tokens = summary_max_tokens
+        # Optional usage.TokenBudget the combined summary's LLM calls are planned against
+        self.token_budget = None
+
+    async def create_record(self):
+        """Create the operation's database record through the database writer, unless operation_id was given"""
+        # A given operation_id means an existing operation is being refreshed
+        if self.db_manager and self.operation_id is None:
             try:
-                self.operation_id = db_manager.create_operation(search_query)
+                self.operation_id = await self.db_manager.create(
+                    'create_operation',
+                    self.search_query,
+                    text_model=self.text_model,
+                    embedding_model=getattr(self.model, 'name', self.model),
+                    dimensions=self.dimensions,
+                    top_k=self.top_k
+                )
                 print(f"Created operation with ID: {self.operation_id}")
             except Exception as e:
                 print(f"Error creating operation record: {e}")
@@ -187,77 +492,81 @@ class CombinedResultsProcessor:
         self.page_results.append(page_processor)
 
     async def process_combined_results(self):
-        if not self.query_embedding:
+        if self.query_embedding is None:
 
             self.query_embedding = self.page_results[0].query_embedding #await get_embedding(self.search_query, model=self.model, dimensions=self.dimensions)
 
+        self.candidates = []
         for page in self.page_results:
             if not page.top_results:
                 continue
+            self.candidates.extend((page.page_url, result) for result in page.top_results)
 
-            for result in page.top_results:
-                self.all_chunks.append(result['chunk_text'])
-                self.all_embeddings.append(result['embedding'])
-                self.page_urls.append(page.page_url)
+        self.all_embeddings = embedding_matrix([result['embedding'] for _, result in self.candidates])
+        self.candidates = [
+            ChunkResult(result['chunk_text'], self.all_embeddings, row, result['similarity'], result['rank'], page_url=url,
+                        tokens=result.get('tokens'))
+            for row, (url, result) in enumerate(self.candidates)
+        ]
 
         self.top_results = await self._find_top_similar(self.query_embedding, k=self.top_k)
 
 
     async def _find_top_similar(self, query_embedding, k=7):
-        if not self.all_embeddings:
+        if not self.candidates:
             return []
 
-        similarities = []
-        for i, emb in enumerate(self.all_embeddings):
-            similarity = self._cosine_similarity(query_embedding, emb)
-            similarities.append((i, similarity))
+        with span('similarity', scope='combined', chunks=len(self.candidates)):
+            order, similarities = two_stage_rank(self.all_embeddings, query_embedding, coarse_dims=self.coarse_dims,
+                                                 shortlist=max(4 * k, 32))
 
-        similarities.sort(key=lambda x: x[1], reverse=True)
-
-        top_k = similarities[:k]
         results = []
-
-        for idx, sim in top_k:
-            results.append({
-                'chunk_text': self.all_chunks[idx],
-                'embedding': self.all_embeddings[idx],
-                'similarity': float(sim)
-            })
-
-        summary_str = f'Given the following query: {
-            self.search_query}, please rewrite the following page summaries into a well documented and fully referenced report, no more than 1000 words long: '
-
-        page_summary = next(
-            (p.page_summary for p in self.page_results if p.page_url == self.page_urls[idx]), "")
-
-        summary_str += page_summary
-
-        system_message = 'You goal is to write a report no more than 1000 words long about a topic, given a query string and a set of summaries from source material. The summaries contain references. Please use these references to create a fully referenced report such that any information contained in the report has a sourced reference in brackets as follows: (reference: <quote>, source: <url>). Note, the <quote> MUST be an actual snippet from the given source material, and the source <url> must be the exact given source url that snippet was taken from.'
-
-
-        self.combined_summary = await generate(system_message, summary_str, model=self.text_model)
+        for i, idx in enumerate(order[:k]):
+            candidate = self.candidates[idx]
+            results.append(ChunkResult(
+                candidate.chunk_text, self.all_embeddings, int(idx), similarities[idx], rank=i + 1,
+                page_url=candidate.page_url, tokens=candidate.tokens))
+
+        summaries_by_url = {p.page_url: p.page_summary for p in self.page_results}
+
+        # Feed every page summary to the map-reduce summarizer, most relevant pages first
+        ordered_urls = []
+        for idx in order:
+            if self.candidates[idx].page_url not in ordered_urls:
+                ordered_urls.append(self.candidates[idx].page_url)
+        for page in self.page_results:
+            if page.page_url not in ordered_urls:
+                ordered_urls.append(page.page_url)
+
+        page_summaries = []
+        for url in ordered_urls:
+            page_summary = summaries_by_url.get(url, "")
+            if page_summary:
+                page_summaries.append(f'Source: {url}\n{page_summary}')
+
+        summarizer = MapReduceSummarizer(
+            self.search_query, text_model=self.text_model, batch_tokens=self.summary_batch_tokens,
+            max_tokens=self.summary_max_tokens, budget=self.token_budget)
+        with span('summarize.combined', pages=len(page_summaries)):
+            self.combined_summary = await summarizer.summarize(page_summaries)
         print('Generated combined summary: ')
         print('\n')
         print(self.combined_summary)
 
         if self.db_manager and self.operation_id:
             try:
-                self.db_manager.update_operation_summary(
-                    self.operation_id, self.combined_summary)
+                await self.db_manager.write('update_operation_summary', self.operation_id, self.combined_summary)
             except Exception as e:
                 print(f"Error updating operation summary in database: {e}")
 
         pages_data = []
-        for i, (idx, sim) in enumerate(similarities[:k]):
-            page_summary = next(
-                (p.page_summary for p in self.page_results if p.page_url == self.page_urls[idx]), "")
-
+        for result in results:
             pages_data.append({
-                'rank': i+1,
-                'url': self.page_urls[idx],
-                'chunk_text': self.all_chunks[idx],
-                'similarity': float(sim),
-                'page_summary': page_summary,
+                'rank': result.rank,
+                'url': result.page_url,
+                'chunk_text': result.chunk_text,
+                'similarity': result.similarity,
+                'page_summary': summaries_by_url.get(result.page_url, ""),
             })
 
         self.combined_results = {
@@ -267,14 +576,6 @@ class CombinedResultsProcessor:
 
         return results
 
-    def _cosine_similarity(self, a, b):
-        """Calculate cosine similarity between two vectors"""
-        if not isinstance(a, np.ndarray):
-            a = np.array(a)
-        if not isinstance(b, np.ndarray):
-            b = np.array(b)
-        return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
-
     def save_to_json(self, filepath=None):
         """Save combined results to JSON file (completely separate from DB operations)"""
         if self.combined_results:
@@ -282,7 +583,8 @@ class CombinedResultsProcessor:
                 self.search_query,
                 self.combined_summary,
                 self.combined_results['pages'],
-                filepath
+                filepath,
+                operation_id=self.operation_id
             )
             if filepath:
                 print(f"Saved combined results to: {filepath}")
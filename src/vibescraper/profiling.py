@@ -0,0 +1,279 @@
+"""
+Profiling mode for a vibe_search run (vibe_search(..., profile=True) or `vibescraper search --profile`).
+
+A RunProfiler captures, for the duration of one run:
+    - a cProfile CPU profile of the event loop thread, merged with the worker threads HTML is chunked in
+    - per coroutine, how long its asyncio tasks lived, ran on the loop and waited (on IO, locks, executors)
+    - tracemalloc's top allocations of each pipeline stage (search, pages, combine)
+and writes them to a report directory next to a short summary of the hottest functions in the
+modules that matter most for performance.
+"""
+import asyncio
+import collections.abc
+import contextvars
+import cProfile
+import datetime
+import functools
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Modules whose hottest functions are listed in summary.txt
+HOT_MODULES = ('html_parser', 'page_embedder', 'openai_utils')
+
+_current_profiler = contextvars.ContextVar('vibescraper_profiler', default=None)
+
+
+class _TimedCoroutine(collections.abc.Coroutine):
+    """Wraps a task's coroutine to add up the time spent running each of its steps on the loop"""
+
+    __slots__ = ('_coro', 'running')
+
+    def __init__(self, coro):
+        self._coro = coro
+        self.running = 0.0
+
+    def send(self, value):
+        start = time.perf_counter()
+        try:
+            return self._coro.send(value)
+        finally:
+            self.running += time.perf_counter() - start
+
+    def throw(self, *args):
+        start = time.perf_counter()
+        try:
+            return self._coro.throw(*args)
+        finally:
+            self.running += time.perf_counter() - start
+
+    def close(self):
+        return self._coro.close()
+
+    def __await__(self):
+        return self._coro.__await__()
+
+
+def _coroutine_name(coro):
+    return getattr(coro, '__qualname__', None) or type(coro).__name__
+
+
+class RunProfiler:
+    """
+    Collects a CPU profile, asyncio task wait times and per-stage allocations for one run.
+
+    Use `with profiler.activate():` from inside the event loop (vibe_search does this when given
+    profile=); the report is written to report_dir when the block exits. The CPU profile covers
+    everything on the loop thread, so with concurrent searches (batch, service) it includes them too.
+    """
+
+    def __init__(self, report_dir, top=25, memory_frames=1):
+        """
+        Args:
+            report_dir - directory the report files are written to (created if needed)
+            top - number of functions / allocations listed per section
+            memory_frames - frames kept per tracemalloc allocation traceback
+        """
+        self.report_dir = report_dir
+        self.top = top
+        self.memory_frames = memory_frames
+
+        self._profile = cProfile.Profile()
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._stages = []
+        self._loop = None
+        self._previous_factory = None
+        self._started_tracemalloc = False
+        self._start = None
+        self.elapsed = None
+
+    @classmethod
+    def from_option(cls, profile, query):
+        """A profiler for vibe_search's profile= option: a directory path, or True for ./profiles/<query>_<time>"""
+        if isinstance(profile, RunProfiler):
+            return profile
+        if isinstance(profile, (str, os.PathLike)):
+            return cls(os.fspath(profile))
+        from vibescraper.json_utils import result_filename
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        return cls(os.path.join('./profiles', result_filename(query, f'_{stamp}')))
+
+    @contextmanager
+    def activate(self):
+        self._loop = asyncio.get_running_loop()
+        self._previous_factory = self._loop.get_task_factory()
+        self._loop.set_task_factory(self._task_factory)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.memory_frames)
+            self._started_tracemalloc = True
+
+        token = _current_profiler.set(self)
+        self._start = time.perf_counter()
+        self._profile.enable()
+        try:
+            yield self
+        finally:
+            self._profile.disable()
+            self.elapsed = time.perf_counter() - self._start
+            _current_profiler.reset(token)
+            self._loop.set_task_factory(self._previous_factory)
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+            self.write_report()
+            print(f"Profile report written to {self.report_dir}")
+
+    def _task_factory(self, loop, coro, **kwargs):
+        timed = _TimedCoroutine(coro)
+        if self._previous_factory is not None:
+            task = self._previous_factory(loop, timed, **kwargs)
+        else:
+            task = asyncio.Task(timed, loop=loop, **kwargs)
+        task.add_done_callback(functools.partial(self._task_done, _coroutine_name(coro), time.perf_counter(), timed))
+        return task
+
+    def _task_done(self, name, created, timed, task):
+        lifetime = time.perf_counter() - created
+        stats = self._tasks.setdefault(name, {'count': 0, 'cancelled': 0, 'lifetime': 0.0, 'running': 0.0,
+                                              'waiting': 0.0, 'max_waiting': 0.0})
+        stats['count'] += 1
+        stats['cancelled'] += task.cancelled()
+        stats['lifetime'] += lifetime
+        stats['running'] += timed.running
+        stats['waiting'] += lifetime - timed.running
+        stats['max_waiting'] = max(stats['max_waiting'], lifetime - timed.running)
+
+    def profiled(self, func):
+        """Wrap func so calls made in a worker thread are added to the CPU profile"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ profiles every thread from the loop thread's profiler already
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._thread_profiles.append(profile)
+        return wrapper
+
+    @contextmanager
+    def stage(self, name):
+        if not tracemalloc.is_tracing():
+            yield
+            return
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+            diff = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+            self._stages.append({
+                'stage': name,
+                'duration': time.perf_counter() - start,
+                'current_bytes': current,
+                'peak_bytes': peak,
+                'top_allocations': [{
+                    'location': str(stat.traceback),
+                    'size_diff': stat.size_diff,
+                    'count_diff': stat.count_diff,
+                    'size': stat.size,
+                } for stat in diff[:self.top]],
+            })
+
+    def stats(self):
+        stats = pstats.Stats(self._profile)
+        for profile in self._thread_profiles:
+            stats.add(profile)
+        return stats
+
+    def hot_functions(self, stats=None, limit=5):
+        """The `limit` functions with the most cumulative time in each of HOT_MODULES"""
+        stats = stats or self.stats()
+        by_module = {module: [] for module in HOT_MODULES}
+        for (filename, lineno, function), (_, calls, own, cumulative, _) in stats.stats.items():
+            module = os.path.splitext(os.path.basename(filename))[0]
+            if module in by_module and os.path.basename(os.path.dirname(filename)) == 'vibescraper':
+                by_module[module].append({'function': f'{function}:{lineno}', 'calls': calls,
+                                          'own': own, 'cumulative': cumulative})
+        for functions in by_module.values():
+            functions.sort(key=lambda f: f['cumulative'], reverse=True)
+            del functions[limit:]
+        return by_module
+
+    def task_waits(self):
+        """Per coroutine task stats, longest total wait first"""
+        return dict(sorted(self._tasks.items(), key=lambda item: item[1]['waiting'], reverse=True))
+
+    def write_report(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        stats = self.stats()
+        stats.dump_stats(os.path.join(self.report_dir, 'cpu.prof'))
+
+        with open(os.path.join(self.report_dir, 'cpu.txt'), 'w') as f:
+            stats.stream = f
+            stats.sort_stats('cumulative').print_stats(self.top)
+
+        with open(os.path.join(self.report_dir, 'tasks.json'), 'w') as f:
+            json.dump(self.task_waits(), f, indent=2)
+        with open(os.path.join(self.report_dir, 'memory.json'), 'w') as f:
+            json.dump(self._stages, f, indent=2)
+        with open(os.path.join(self.report_dir, 'summary.txt'), 'w') as f:
+            f.write(self.summary(stats))
+        return self.report_dir
+
+    def summary(self, stats=None):
+        lines = [f"Run took {self.elapsed:.3f}s", '', 'Hottest functions (cumulative s / own s / calls):']
+        for module, functions in self.hot_functions(stats).items():
+            lines.append(f"  {module}")
+            if not functions:
+                lines.append('    (not called)')
+            for function in functions:
+                lines.append(f"    {function['cumulative']:8.3f} {function['own']:8.3f} {function['calls']:>8}  {function['function']}")
+
+        lines += ['', 'Task waits (tasks, waiting s, running s):']
+        for name, task in list(self.task_waits().items())[:10]:
+            lines.append(f"  {task['count']:>5} {task['waiting']:9.3f} {task['running']:9.3f}  {name}")
+
+        lines += ['', 'Memory per stage (peak MiB, largest allocation site):']
+        for stage in self._stages:
+            top = stage['top_allocations'][0]['location'] if stage['top_allocations'] else '-'
+            lines.append(f"  {stage['stage']:<10} {stage['peak_bytes'] / 2 ** 20:8.1f}  {top}")
+        lines += ['', 'Details: cpu.prof (pstats / snakeviz), cpu.txt, tasks.json, memory.json', '']
+        return '\n'.join(lines)
+
+
+def get_profiler():
+    """The profiler active in the current context, or None"""
+    return _current_profiler.get()
+
+
+@contextmanager
+def profile_stage(name):
+    """Record the allocations of a pipeline stage on the active profiler; does nothing without one"""
+    profiler = _current_profiler.get()
+    if profiler is None:
+        yield
+        return
+    with profiler.stage(name):
+        yield
+
+
+def profiled(func):
+    """func, wrapped to be CPU profiled in a worker thread when a profiler is active"""
+    profiler = _current_profiler.get()
+    return profiler.profiled(func) if profiler is not None else func
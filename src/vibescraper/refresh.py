@@ -0,0 +1,264 @@
+import asyncio
+import datetime
+from vibescraper.resources import SearchResources
+from vibescraper.tracing import span
+from vibescraper.vibe_search import search_urls, record_fetch
+
+
+async def refresh_operation(operation_id, resources=None, force=False, on_event=None):
+    """
+    Bring a stored operation up to date without redoing work for pages that did not change.
+
+    The search is run again and the new url set is compared with the stored pages:
+        - pages no longer in the results are deleted
+        - pages still in the results are re-fetched with a conditional GET (ETag / Last-Modified);
+          a 304 or an identical content hash keeps the stored chunks and summary
+        - changed pages have their chunks replaced and are re-chunked, re-embedded and re-summarized
+        - new urls are processed like in vibe_search
+    The combined summary is then rebuilt from all current pages.
+
+    Args:
+        operation_id - id of the operation to refresh
+        resources - optional SearchResources to use; a private one is created and closed otherwise
+        force - re-process every page even when it did not change
+        on_event - optional callback on_event(event, data), see vibe_search
+
+    Returns the new combined summary, or None if the operation does not exist.
+    """
+    owns_resources = resources is None
+    if owns_resources:
+        resources = SearchResources()
+
+    try:
+        with resources.activate(), span('refresh', operation_id=operation_id):
+            return await _refresh_operation(operation_id, resources, force, on_event)
+    finally:
+        if owns_resources:
+            await resources.aclose()
+
+
+async def _refresh_operation(operation_id, resources, force, on_event):
+    from vibescraper.page_embedder import PageEmbeddingProcessor, CombinedResultsProcessor, embed_expanded_query
+    from vibescraper.vibe_search import _emit
+
+    db = resources.db
+    operation = db.get_operation(operation_id)
+    if operation is None:
+        print(f"No operation with ID: {operation_id}")
+        return None
+
+    query = operation.search_query
+    settings = operation.settings()
+    stored_pages = {page.url: page for page in db.get_operation_pages(operation_id)}
+    domain_count = operation.domain_count or len(stored_pages) or 5
+
+    urls = await search_urls(query, domain_count)
+    _emit(on_event, 'search', query=query, urls=urls)
+
+    for url, page in stored_pages.items():
+        if url not in urls:
+            print(f"Removing page no longer in results: {url}")
+            await db.write('delete_page', page.id)
+
+    query_embedding = await embed_expanded_query(
+        query, settings['text_model'], settings['embedding_model'], settings['dimensions'])
+
+    combined_processor = CombinedResultsProcessor(query, db_manager=db, operation_id=operation_id, **settings)
+    combined_processor.query_embedding = query_embedding
+    counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'failed': 0}
+
+    async def refresh_url(url):
+        page = stored_pages.get(url)
+        if page is not None and not force:
+            result = await resources.scheduler.fetch_page(url, etag=page.etag, last_modified=page.last_modified)
+        else:
+            result = await resources.scheduler.fetch_page(url)
+
+        unchanged = page is not None and not force and (
+            result.not_modified or (page.content_hash and result.content_hash == page.content_hash))
+        if unchanged:
+            counts['unchanged'] += 1
+            if result.not_modified or result.etag or result.last_modified:
+                await db.write('update_page', page.id, etag=result.etag or page.etag,
+                               last_modified=result.last_modified or page.last_modified,
+                               fetched_at=datetime.datetime.utcnow())
+            return PageEmbeddingProcessor.from_stored(page, query, db, query_embedding, **settings)
+
+        if not result.text:
+            # Keep the stored version of a page that could not be fetched this time
+            counts['failed'] += 1
+            if page is not None:
+                return PageEmbeddingProcessor.from_stored(page, query, db, query_embedding, **settings)
+            return None
+
+        await resources.store_snapshot(result)
+        chunks = await resources.chunk_html(result.text, url)
+        if not chunks:
+            counts['failed'] += 1
+            return None
+
+        async with resources.page_semaphore:
+            print(f"\nRefreshing: {url}")
+            with span('page', url=url, html_bytes=len(result.text), refresh='new' if page is None else 'changed'):
+                if page is not None:
+                    counts['changed'] += 1
+                    await db.write('delete_page_chunks', page.id)
+                    processor = PageEmbeddingProcessor(url, query, db, operation_id, page_id=page.id, **settings)
+                else:
+                    counts['new'] += 1
+                    processor = PageEmbeddingProcessor(url, query, db, operation_id, **settings)
+                    await processor.create_record()
+
+                await processor.process_chunks(chunks, query_embedding=query_embedding)
+                await record_fetch(db, processor.page_id, result)
+                processor.save_to_json()
+        _emit(on_event, 'page', url=url, page_summary=processor.page_summary)
+        return processor
+
+    with span('pages', urls=len(urls)):
+        page_processors = await asyncio.gather(*(refresh_url(url) for url in urls))
+
+    for page_processor in page_processors:
+        if page_processor is not None:
+            combined_processor.add_page_results(page_processor)
+
+    print(f"Refresh of operation {operation_id}: {counts['new']} new, {counts['changed']} changed, "
+          f"{counts['unchanged']} unchanged, {counts['failed']} failed")
+
+    if combined_processor.page_results:
+        with span('combine', pages=len(combined_processor.page_results)):
+            await combined_processor.process_combined_results()
+        combined_processor.save_to_json()
+
+    await db.write('update_operation', operation_id, refreshed_at=datetime.datetime.utcnow(), domain_count=domain_count)
+    await db.flush()
+    _emit(on_event, 'summary', combined_summary=combined_processor.combined_summary)
+    return combined_processor.combined_summary
+
+
+async def rebuild_operation(operation_id, resources=None, embedding_model=None, dimensions=None,
+                            summarize=False, expand_query=True, on_event=None):
+    """
+    Re-chunk and re-embed a stored operation from its HTML snapshots, without fetching any page.
+
+    Use it after a parser or chunking change, or to move an operation to another embedding model.
+    Pages whose snapshot is missing (fetched before snapshots existed, or with snapshots disabled)
+    keep their stored chunks; when the embedding model or dimensions change, those chunks can't be
+    ranked against the new query embedding, so such pages are skipped instead and their stale
+    chunks removed.
+
+    Args:
+        operation_id - id of the operation to rebuild
+        resources - optional SearchResources to use; a private one is created and closed otherwise
+        embedding_model, dimensions - override the stored settings; the operation is updated to match
+        summarize - also regenerate page summaries and the combined summary; otherwise the stored
+                    summaries are kept and only chunks, similarities and ranks are rebuilt
+        expand_query - embed the LLM-expanded query like vibe_search (usually an LLM cache hit);
+                       with False and embedding_model='hashing' no API is called at all
+        on_event - optional callback on_event(event, data), see vibe_search
+
+    Returns a dict of page counts ('rebuilt', 'missing', 'skipped'), or None if the operation does not exist.
+    """
+    owns_resources = resources is None
+    if owns_resources:
+        resources = SearchResources()
+
+    try:
+        with resources.activate(), span('rebuild', operation_id=operation_id):
+            return await _rebuild_operation(operation_id, resources, embedding_model, dimensions,
+                                            summarize, expand_query, on_event)
+    finally:
+        if owns_resources:
+            await resources.aclose()
+
+
+async def _rebuild_operation(operation_id, resources, embedding_model, dimensions, summarize, expand_query, on_event):
+    from vibescraper.embeddings import get_embedding_provider
+    from vibescraper.page_embedder import PageEmbeddingProcessor, CombinedResultsProcessor, embed_expanded_query
+    from vibescraper.vibe_search import _emit
+
+    db = resources.db
+    operation = db.get_operation(operation_id)
+    if operation is None:
+        print(f"No operation with ID: {operation_id}")
+        return None
+    if resources.snapshots is None:
+        raise RuntimeError("Snapshots are disabled (VIBESCRAPER_SNAPSHOTS_DISABLED), nothing to rebuild from")
+
+    query = operation.search_query
+    settings = operation.settings()
+    stored_space = (settings['embedding_model'], settings['dimensions'])
+    if embedding_model is not None:
+        settings['embedding_model'] = getattr(embedding_model, 'name', embedding_model)
+    if dimensions is not None:
+        settings['dimensions'] = dimensions
+
+    if expand_query:
+        query_embedding = await embed_expanded_query(
+            query, settings['text_model'], settings['embedding_model'], settings['dimensions'])
+    else:
+        query_embedding = await get_embedding_provider(settings['embedding_model'], settings['dimensions']).embed_one(query)
+
+    # Stored chunk embeddings are only comparable with the query embedding in the same model and dimensions
+    reembedding = (settings['embedding_model'], settings['dimensions']) != stored_space
+    counts = {'rebuilt': 0, 'missing': 0, 'skipped': 0}
+    skipped_urls = []
+
+    async def rebuild_page(page):
+        html = await asyncio.to_thread(resources.snapshots.get, page.content_hash) if page.content_hash else None
+        if html is None:
+            if reembedding:
+                counts['skipped'] += 1
+                skipped_urls.append(page.url)
+                await db.write('delete_page_chunks', page.id)
+                return None
+            counts['missing'] += 1
+            return PageEmbeddingProcessor.from_stored(page, query, db, query_embedding, **settings)
+
+        chunks = await resources.chunk_html(html, page.url)
+        async with resources.page_semaphore:
+            with span('page', url=page.url, html_bytes=len(html), refresh='rebuild'):
+                processor = PageEmbeddingProcessor(page.url, query, db, operation_id, page_id=page.id, **settings)
+                processor.page_summary = page.page_summary or ""
+                await processor.embed_chunks(chunks)
+                results = processor.rank_chunks(query_embedding, k=processor.top_k)
+                processor.query_embedding = query_embedding
+                processor.release_chunks()
+                if summarize and results:
+                    await processor.summarize(results)
+                await db.write('delete_page_chunks', page.id)
+                await processor.store_results(results, summary=summarize)
+                processor.top_results = results
+                if summarize:
+                    processor.save_to_json()
+        counts['rebuilt'] += 1
+        _emit(on_event, 'page', url=page.url, page_summary=processor.page_summary)
+        return processor
+
+    pages = db.get_operation_pages(operation_id)
+    with span('pages', urls=len(pages)):
+        page_processors = await asyncio.gather(*(rebuild_page(page) for page in pages))
+
+    await db.write('update_operation', operation_id, embedding_model=settings['embedding_model'], dimensions=settings['dimensions'])
+    await db.flush()
+    print(f"Rebuild of operation {operation_id}: {counts['rebuilt']} pages rebuilt from snapshots, "
+          f"{counts['missing']} without a snapshot")
+    if skipped_urls:
+        print(f"Skipped {len(skipped_urls)} pages without a snapshot: their chunks were embedded with "
+              f"{stored_space[0]}/{stored_space[1]} and can't be ranked with {settings['embedding_model']}/"
+              f"{settings['dimensions']}; `vibescraper refresh {operation_id} --force` fetches them again:")
+        for url in skipped_urls:
+            print(f"  {url}")
+
+    if summarize:
+        combined_processor = CombinedResultsProcessor(query, db_manager=db, operation_id=operation_id, **settings)
+        combined_processor.query_embedding = query_embedding
+        for page_processor in page_processors:
+            if page_processor is not None and page_processor.top_results:
+                combined_processor.add_page_results(page_processor)
+        if combined_processor.page_results:
+            with span('combine', pages=len(combined_processor.page_results)):
+                await combined_processor.process_combined_results()
+            combined_processor.save_to_json()
+        _emit(on_event, 'summary', combined_summary=combined_processor.combined_summary)
+    return counts
@@ -0,0 +1,168 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from vibescraper.fetch_scheduler import FetchScheduler
+from vibescraper.profiling import profiled
+from vibescraper.snapshots import get_snapshot_store
+from vibescraper.tracing import span
+
+
+def _chunk_with_template(templates, html, url):
+    """Look up the page's template, chunk the page and record the outcome, all in one worker thread"""
+    from vibescraper.domain_templates import chunk_page
+
+    template, learn = templates.lookup(url) if templates is not None else (None, False)
+    chunks, profile, matched = chunk_page(html, template, learn)
+    if template is not None or profile is not None:
+        templates.record(url, template, matched, profile)
+    return chunks, template, matched
+
+
+class SearchResources:
+    """
+    Long-lived state shared by many vibe_search calls.
+
+    Holds the polite fetch scheduler (and its HTTP connection pool), the DB engine, a global
+    limit on pages processed at once, a per-url cache of fetched and chunked pages so a url
+    returned for several queries is only fetched and chunked once (pages expire after page_ttl
+    seconds, and failed or empty fetches are not kept), and the per-domain
+    extraction templates pages are chunked with.
+    """
+
+    def __init__(self, db_path=None, scheduler=None, max_concurrent_pages=8, max_concurrent_requests=None, max_cached_pages=1000, page_ttl=3600, executor=None, snapshots=None, db_settings=None, templates=None):
+        """
+        Args:
+            db_path - SQLAlchemy database url, overriding the one in db_settings
+            db_settings - config.DatabaseSettings of the database; config.database by default
+            templates - domain_templates.TemplateCache pages are chunked with; defaults to the one at config.templates_path
+            scheduler - FetchScheduler to use; one is created (and closed with these resources) otherwise
+            max_concurrent_pages - pages embedded and summarized at once, across all searches
+            max_concurrent_requests - cap on concurrent OpenAI requests, across every search using these resources
+            max_cached_pages - number of fetched/chunked pages kept for reuse
+            page_ttl - seconds a fetched/chunked page is reused for before it is fetched again
+            executor - optional concurrent.futures executor (e.g. a warm ProcessPoolExecutor) for HTML chunking;
+                       chunking runs in a thread otherwise
+            snapshots - SnapshotStore fetched html is kept in; defaults to the one configured in config.snapshot_dir
+        """
+        from vibescraper.db_schema import DBManager
+        from vibescraper.domain_templates import get_template_cache
+
+        self._owns_scheduler = scheduler is None
+        self.scheduler = scheduler or FetchScheduler()
+        self.db = DBManager(db_path, settings=db_settings)
+        self.db.create_tables()
+        self.page_semaphore = asyncio.Semaphore(max_concurrent_pages)
+        self.max_cached_pages = max_cached_pages
+        self.page_ttl = page_ttl
+        self._pages = {}
+        self._page_times = {}
+        self._waiters = {}
+        self.executor = executor
+        self.snapshots = snapshots if snapshots is not None else get_snapshot_store()
+        self.templates = templates if templates is not None else get_template_cache()
+        # hedging.Hedging of searches run with hedge=, kept so request latencies carry over between searches
+        self.hedging = None
+        # Applies to the searches run under activate()
+        self.request_semaphore = asyncio.Semaphore(max_concurrent_requests) if max_concurrent_requests else None
+
+    @contextmanager
+    def activate(self):
+        """Apply these resources' OpenAI request cap to the code run inside (vibe_search and the worker do this)"""
+        from vibescraper.openai_utils import request_limit
+
+        with request_limit(self.request_semaphore):
+            yield self
+
+    async def chunk_html(self, html, url=None):
+        """
+        Split html into semantic chunks off the event loop. With a url, the domain's learned
+        template is used when there is one, and the page helps learn it otherwise (see domain_templates).
+        """
+        from vibescraper.domain_templates import chunk_page
+
+        templates = self.templates if url else None
+        with span('chunk', url=url) as chunk_span:
+            if self.executor is not None:
+                # The template cache lives in this process: its SQLite reads and writes go to a thread
+                loop = asyncio.get_running_loop()
+                template, learn = await asyncio.to_thread(templates.lookup, url) if templates is not None else (None, False)
+                chunks, profile, matched = await loop.run_in_executor(self.executor, chunk_page, html, template, learn)
+                if template is not None or profile is not None:
+                    await asyncio.to_thread(templates.record, url, template, matched, profile)
+            else:
+                chunks, template, matched = await asyncio.to_thread(profiled(_chunk_with_template), templates, html, url)
+            if chunk_span:
+                chunk_span.set_attribute('chunks', len(chunks))
+                if template is not None:
+                    chunk_span.set_attribute('template', 'hit' if matched else 'miss')
+        return chunks
+
+    async def store_snapshot(self, result):
+        """Keep a compressed copy of a fetched page's html (deduplicated by content hash); returns the hash"""
+        if self.snapshots is None or not result.text:
+            return None
+        try:
+            with span('snapshot', url=result.url, html_bytes=len(result.text)):
+                return await asyncio.to_thread(self.snapshots.put, result.text, result.content_hash)
+        except OSError as e:
+            print(f"Error storing snapshot of {result.url}: {e}")
+            return None
+
+    async def _load_page(self, url):
+        result = await self.scheduler.fetch_page(url)
+        if not result.text:
+            return result, []
+        await self.store_snapshot(result)
+        return result, await self.chunk_html(result.text, url)
+
+    async def get_page(self, url):
+        """Return (FetchResult, chunks) for a url, fetching and chunking it at most once per page_ttl"""
+        task = self._pages.get(url)
+        if task is not None and task.done() and time.monotonic() - self._page_times.get(url, 0) > self.page_ttl:
+            self._drop_page(url, task)
+            task = None
+        if task is None:
+            if len(self._pages) >= self.max_cached_pages:
+                # Drop the oldest finished entry; dicts keep insertion order
+                for cached_url, cached_task in self._pages.items():
+                    if cached_task.done():
+                        self._drop_page(cached_url, cached_task)
+                        break
+            task = asyncio.ensure_future(self._load_page(url))
+            self._pages[url] = task
+            self._page_times[url] = time.monotonic()
+        self._waiters[url] = self._waiters.get(url, 0) + 1
+        try:
+            result, chunks = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Stop the fetch too when nobody else is waiting for this page
+            if self._waiters.get(url) == 1 and not task.done():
+                task.cancel()
+                self._drop_page(url, task)
+            raise
+        except Exception:
+            self._drop_page(url, task)
+            raise
+        finally:
+            self._waiters[url] -= 1
+            if not self._waiters[url]:
+                del self._waiters[url]
+        if not chunks:
+            # A failed or empty fetch is shared with the searches waiting on it, but the next one tries again
+            self._drop_page(url, task)
+        return result, list(chunks)
+
+    def _drop_page(self, url, task):
+        if self._pages.get(url) is task:
+            del self._pages[url]
+            self._page_times.pop(url, None)
+
+    async def aclose(self):
+        """close() after committing the writes still queued for the database"""
+        await self.db.stop_writer()
+        self.close()
+
+    def close(self):
+        if self._owns_scheduler:
+            self.scheduler.close()
+        self.db.close()
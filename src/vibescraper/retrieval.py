@@ -0,0 +1,58 @@
+"""
+Two-stage retrieval over stored chunks.
+
+Every stored chunk keeps a coarse copy of its embedding (see page_embedder.coarse_vectors) next to
+the full one. Searching many stored runs scores the small coarse vectors of every chunk first, and
+only loads and re-scores the full embeddings of a shortlist.
+"""
+import numpy as np
+from vibescraper.page_embedder import (
+    COARSE_DIMS, ChunkResult, coarse_format, coarse_similarities, coarse_vectors, cosine_similarities,
+    embedding_matrix, parse_coarse_format, rank_indices
+)
+from vibescraper.tracing import span
+
+
+def load_coarse_matrix(db_manager, label, operation_ids=None):
+    """(chunk ids, coarse matrix) of every stored chunk whose coarse vectors are encoded as `label`"""
+    dtype, dims = parse_coarse_format(label)
+    rows = db_manager.get_coarse_embeddings(label, operation_ids)
+    chunk_ids = np.fromiter((chunk_id for chunk_id, _ in rows), dtype=np.int64, count=len(rows))
+    matrix = np.frombuffer(b''.join(data for _, data in rows), dtype=dtype).reshape(len(rows), dims)
+    return chunk_ids, matrix
+
+
+def search_stored_chunks(db_manager, query_embedding, k=10, shortlist=None, operation_ids=None,
+                         coarse_dims=COARSE_DIMS, coarse_dtype='int8'):
+    """
+    The k stored chunks most similar to query_embedding, best first, as ChunkResults with page_url set.
+
+    Args:
+        db_manager - DBManager holding the chunks
+        query_embedding - full-dimension query embedding, from the same model as the stored chunks
+        k - number of results
+        shortlist - chunks re-scored at full dimension after the coarse pass (default max(4k, 32))
+        operation_ids - only search the chunks of these operations
+        coarse_dims, coarse_dtype - which stored coarse vectors to scan; chunks stored with another format are skipped
+    """
+    shortlist = shortlist or max(4 * k, 32)
+    with span('retrieval.coarse', dims=coarse_dims):
+        chunk_ids, coarse = load_coarse_matrix(db_manager, coarse_format(coarse_dims, coarse_dtype), operation_ids)
+        if len(chunk_ids) == 0:
+            return []
+        query_coarse = coarse_vectors(query_embedding, coarse_dims, coarse_dtype)
+        candidates = chunk_ids[rank_indices(coarse_similarities(coarse, query_coarse), shortlist)]
+
+    with span('retrieval.rescore', chunks=len(candidates)):
+        chunks = [chunk for chunk in db_manager.get_chunks(candidates.tolist()) if chunk.embedding is not None]
+        if not chunks:
+            return []
+        matrix = embedding_matrix([chunk.embedding for chunk in chunks])
+        similarities = cosine_similarities(matrix, query_embedding)
+        top = rank_indices(similarities, k)
+
+    return [
+        ChunkResult(chunks[row].chunk_text, matrix, row, similarities[row], rank=i + 1, page_url=chunks[row].page.url,
+                    tokens=chunks[row].token_count)
+        for i, row in enumerate(top)
+    ]
@@ -0,0 +1,376 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+from vibescraper.openai_utils import TEXT_MODEL_STAGES
+from vibescraper.resources import SearchResources
+from vibescraper.tracing import Tracer
+
+
+SEARCH_OPTIONS = ('text_model', 'embedding_model', 'dimensions', 'top_k', 'domain_count', 'adaptive', 'first_pass', 'coarse_dims', 'budget', 'hedge')
+LATENCY_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+MAX_BODY_BYTES = 1024 * 1024
+# Upper bounds for the integer search options (None: any positive integer), so one request can't ask for unbounded work
+INT_OPTION_LIMITS = {'domain_count': 50, 'top_k': 100, 'dimensions': 3072, 'coarse_dims': 3072, 'budget': None}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Metrics:
+    """In-memory counters and a latency histogram, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = {}
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_count = 0
+        self.latency_sum = 0.0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe_search(self, seconds):
+        self.latency_count += 1
+        self.latency_sum += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency_buckets[i] += 1
+
+    def observe_trace(self, tracer):
+        for stage, stats in tracer.timings()['operations'].items():
+            self.inc('vibescraper_stage_seconds_total', stats['total'], stage=stage)
+            self.inc('vibescraper_stage_calls_total', stats['count'], stage=stage)
+
+    def render(self, gauges):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            label_str = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{name}{{{label_str}}} {value}' if label_str else f'{name} {value}')
+        for name, value in gauges.items():
+            lines.append(f'{name} {value}')
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            lines.append(f'vibescraper_search_duration_seconds_bucket{{le="{bound}"}} {count}')
+        lines.append(f'vibescraper_search_duration_seconds_bucket{{le="+Inf"}} {self.latency_count}')
+        lines.append(f'vibescraper_search_duration_seconds_sum {self.latency_sum}')
+        lines.append(f'vibescraper_search_duration_seconds_count {self.latency_count}')
+        lines.append(f'vibescraper_uptime_seconds {time.time() - self.started_at:.0f}')
+        return '\n'.join(lines) + '\n'
+
+
+class VibeServer:
+    """
+    Long-running HTTP/JSON service around vibe_search.
+
+    Connection pools, the DB engine, the page cache, the LLM response cache, the tokenizer and a
+    pool of chunking worker processes are created once and stay warm between requests.
+
+    Endpoints:
+        POST /search          {"query": ..., "domain_count": ..., ...} -> {"query", "summary", "seconds"}
+        POST /search/stream   same body; newline-delimited JSON events: search, page, summary, done
+        GET  /metrics         Prometheus text format
+        GET  /healthz
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, max_concurrent_searches=4, max_queued=32, workers=None,
+                 max_concurrent_pages=8, max_concurrent_requests=16, search_timeout=600, db_path=None):
+        self.host = host
+        self.port = port
+        self.max_concurrent_searches = max_concurrent_searches
+        self.max_queued = max_queued
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.max_concurrent_pages = max_concurrent_pages
+        self.max_concurrent_requests = max_concurrent_requests
+        self.search_timeout = search_timeout
+        self.db_path = db_path
+
+        self.metrics = Metrics()
+        self.search_semaphore = None
+        self.active = 0
+        self.queued = 0
+        self.executor = None
+        self.resources = None
+        self.server = None
+
+    async def warm_up(self):
+        """Build the shared state and pay one-off start-up costs before taking traffic"""
+        from vibescraper.domain_templates import chunk_page
+        from vibescraper.llm_cache import get_response_cache
+        from vibescraper.openai_utils import get_encoding
+        from vibescraper.config import get_client
+
+        self.search_semaphore = asyncio.Semaphore(self.max_concurrent_searches)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.resources = SearchResources(db_path=self.db_path, max_concurrent_pages=self.max_concurrent_pages,
+                                         max_concurrent_requests=self.max_concurrent_requests, executor=self.executor)
+
+        loop = asyncio.get_running_loop()
+        warm_html = '<html><body><h1>warm</h1><p>up</p></body></html>'
+        await asyncio.gather(*(loop.run_in_executor(self.executor, chunk_page, warm_html)
+                               for _ in range(self.workers)))
+        try:
+            await asyncio.to_thread(get_encoding)
+        except Exception as e:
+            print(f"Could not preload tokenizer: {e}")
+        get_response_cache()
+        get_client()
+
+    async def start(self):
+        await self.warm_up()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"vibescraper serving on http://{self.host}:{self.port}")
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            if self.resources:
+                await self.resources.db.stop_writer()
+            self.close()
+
+    def close(self):
+        if self.resources:
+            self.resources.close()
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+
+    def _gauges(self):
+        from vibescraper.llm_cache import get_response_cache
+
+        gauges = {
+            'vibescraper_searches_in_flight': self.active,
+            'vibescraper_searches_queued': self.queued,
+            'vibescraper_page_cache_entries': len(self.resources._pages) if self.resources else 0,
+            'vibescraper_known_hosts': len(self.resources.scheduler.hosts) if self.resources else 0,
+        }
+        cache = get_response_cache()
+        if cache is not None:
+            gauges['vibescraper_llm_cache_hits'] = cache.hits
+            gauges['vibescraper_llm_cache_misses'] = cache.misses
+        return gauges
+
+    # --------- HTTP plumbing ---------
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HTTPError(400, 'malformed request line')
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) > 100:
+                raise HTTPError(400, 'too many headers')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        body = b''
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HTTPError(400, 'malformed content-length')
+        if length < 0:
+            raise HTTPError(400, 'malformed content-length')
+        if length > MAX_BODY_BYTES:
+            raise HTTPError(413, 'request body too large')
+        if length:
+            body = await reader.readexactly(length)
+        return method.upper(), urlsplit(target).path, headers, body
+
+    async def _respond(self, writer, status, payload, content_type='application/json', headers=None):
+        body = payload if isinstance(payload, bytes) else (
+            payload.encode('utf-8') if isinstance(payload, str) else json.dumps(payload).encode('utf-8'))
+        head = [f'HTTP/1.1 {status} {REASONS.get(status, "")}', f'Content-Type: {content_type}',
+                f'Content-Length: {len(body)}', 'Connection: close']
+        head += [f'{k}: {v}' for k, v in (headers or {}).items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def _write_chunk(self, writer, data):
+        writer.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        path = None
+        status = 500
+        try:
+            request = await self._read_request(reader)
+            if request is None:
+                return
+            method, path, headers, body = request
+            status = await self.route(method, path, body, writer)
+        except HTTPError as e:
+            status = e.status
+            headers = {'Retry-After': '5'} if e.status == 503 else None
+            await self._respond(writer, e.status, {'error': e.message}, headers=headers)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            status = 499
+        except Exception as e:
+            print(f"Request failed: {e}")
+            status = 500
+            try:
+                await self._respond(writer, 500, {'error': repr(e)})
+            except ConnectionError:
+                pass
+        finally:
+            self.metrics.inc('vibescraper_http_requests_total', path=path or '-', status=status)
+            writer.close()
+
+    async def route(self, method, path, body, writer):
+        if path == '/healthz':
+            await self._respond(writer, 200, {'status': 'ok', 'in_flight': self.active, 'queued': self.queued})
+            return 200
+        if path == '/metrics':
+            await self._respond(writer, 200, self.metrics.render(self._gauges()), 'text/plain; version=0.0.4')
+            return 200
+        if path in ('/search', '/search/stream'):
+            if method != 'POST':
+                raise HTTPError(405, 'use POST')
+            params = self._parse_search(body)
+            if path == '/search':
+                return await self._search(params, writer)
+            return await self._search_stream(params, writer)
+        raise HTTPError(404, 'not found')
+
+    # --------- search endpoints ---------
+
+    def _parse_search(self, body):
+        try:
+            params = json.loads(body or b'{}')
+        except ValueError:
+            raise HTTPError(400, 'body must be JSON')
+        if not isinstance(params, dict) or not str(params.get('query', '')).strip():
+            raise HTTPError(400, "'query' is required")
+        unknown = set(params) - set(SEARCH_OPTIONS) - {'query'}
+        if unknown:
+            raise HTTPError(400, f"unknown options: {', '.join(sorted(unknown))}")
+        if params.get('first_pass') not in (None, 'hashing'):
+            raise HTTPError(400, "'first_pass' must be 'hashing'")
+        text_model = params.get('text_model')
+        if isinstance(text_model, dict):
+            allowed = set(TEXT_MODEL_STAGES) | {'default'}
+            if set(text_model) - allowed or not all(isinstance(model, str) and model for model in text_model.values()):
+                raise HTTPError(400, f"'text_model' stages must be among {', '.join(sorted(allowed))} with model name values")
+        elif text_model is not None and not isinstance(text_model, str):
+            raise HTTPError(400, "'text_model' must be a model name or an object of per-stage model names")
+        for name, limit in INT_OPTION_LIMITS.items():
+            value = params.get(name)
+            if value is None:
+                continue
+            if not isinstance(value, int) or isinstance(value, bool) or value <= 0:
+                raise HTTPError(400, f"'{name}' must be a positive integer")
+            if limit is not None and value > limit:
+                raise HTTPError(400, f"'{name}' must be at most {limit}")
+        hedge = params.get('hedge')
+        if hedge is not None and not isinstance(hedge, bool) and (not isinstance(hedge, (int, float)) or not 0 < hedge <= 1):
+            raise HTTPError(400, "'hedge' must be a boolean or the fraction of extra requests allowed, in (0, 1]")
+        return params
+
+    async def _run_search(self, params, on_event=None):
+        """Admission control, concurrency limit and timeout around one vibe_search call"""
+        from vibescraper.vibe_search import vibe_search
+
+        if self.active + self.queued >= self.max_concurrent_searches + self.max_queued:
+            self.metrics.inc('vibescraper_searches_rejected_total')
+            raise HTTPError(503, 'server busy')
+
+        self.queued += 1
+        try:
+            await self.search_semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        self.active += 1
+        start = time.perf_counter()
+        tracer = Tracer()
+        try:
+            options = {k: params[k] for k in SEARCH_OPTIONS if k in params}
+            if 'adaptive' in options:
+                options['adaptive'] = bool(options['adaptive'])
+            summary = await asyncio.wait_for(
+                vibe_search(params['query'], resources=self.resources, tracer=tracer, on_event=on_event, **options),
+                timeout=self.search_timeout)
+            self.metrics.inc('vibescraper_searches_total', outcome='ok')
+            return summary, time.perf_counter() - start
+        except asyncio.TimeoutError:
+            self.metrics.inc('vibescraper_searches_total', outcome='timeout')
+            raise HTTPError(503, 'search timed out')
+        except Exception:
+            self.metrics.inc('vibescraper_searches_total', outcome='error')
+            raise
+        finally:
+            self.active -= 1
+            self.search_semaphore.release()
+            self.metrics.observe_search(time.perf_counter() - start)
+            self.metrics.observe_trace(tracer)
+
+    async def _search(self, params, writer):
+        summary, seconds = await self._run_search(params)
+        await self._respond(writer, 200, {'query': params['query'], 'summary': summary, 'seconds': seconds})
+        return 200
+
+    async def _search_stream(self, params, writer):
+        events = asyncio.Queue()
+
+        def on_event(event, data):
+            events.put_nowait({'event': event, **data})
+
+        # Fail fast with a normal error response if the server is full
+        if self.active + self.queued >= self.max_concurrent_searches + self.max_queued:
+            self.metrics.inc('vibescraper_searches_rejected_total')
+            raise HTTPError(503, 'server busy')
+
+        writer.write(('HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                      'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        task = asyncio.ensure_future(self._run_search(params, on_event))
+        try:
+            while not (task.done() and events.empty()):
+                getter = asyncio.ensure_future(events.get())
+                await asyncio.wait({getter, task}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    await self._write_chunk(writer, (json.dumps(getter.result()) + '\n').encode('utf-8'))
+                else:
+                    getter.cancel()
+
+            try:
+                _, seconds = task.result()
+                final = {'event': 'done', 'seconds': seconds}
+            except HTTPError as e:
+                final = {'event': 'error', 'error': e.message}
+            except Exception as e:
+                final = {'event': 'error', 'error': repr(e)}
+            await self._write_chunk(writer, (json.dumps(final) + '\n').encode('utf-8'))
+            await self._write_chunk(writer, b'')
+        except ConnectionError:
+            task.cancel()
+            raise
+        return 200
+
+
+def serve(host='127.0.0.1', port=8765, **kwargs):
+    """Run the service until interrupted"""
+    server = VibeServer(host=host, port=port, **kwargs)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        print("Shutting down")
@@ -0,0 +1,165 @@
+"""
+Compressed storage for fetched HTML and chunk text.
+
+SnapshotStore keeps every fetched page's HTML on disk, addressed by the same sha256 content hash
+that is stored on the Page row, so identical pages fetched by many operations are stored once and
+past operations can be re-chunked and re-embedded offline (see refresh.rebuild_operation).
+
+Compression uses zstd when available (the stdlib compression.zstd on Python 3.14+, or the
+zstandard package: pip install vibescraper[compression]), then brotli, then zlib.
+"""
+import base64
+import hashlib
+import os
+import tempfile
+import zlib
+from functools import lru_cache
+
+
+class _Codec:
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+@lru_cache(maxsize=None)
+def _codecs():
+    """Available codecs by name, best first"""
+    codecs = {}
+    try:
+        from compression import zstd
+        codecs['zst'] = _Codec('zst', lambda data: zstd.compress(data, level=9), zstd.decompress)
+    except ImportError:
+        try:
+            import zstandard
+            # The one-shot functions: ZstdCompressor/ZstdDecompressor instances can't be shared across threads
+            codecs['zst'] = _Codec('zst', lambda data: zstandard.compress(data, level=9), zstandard.decompress)
+        except ImportError:
+            pass
+    try:
+        import brotli
+        codecs['br'] = _Codec('br', lambda data: brotli.compress(data, quality=9), brotli.decompress)
+    except ImportError:
+        pass
+    codecs['zz'] = _Codec('zz', lambda data: zlib.compress(data, 6), zlib.decompress)
+    return codecs
+
+
+def best_codec():
+    return next(iter(_codecs().values()))
+
+
+def get_codec(name):
+    codec = _codecs().get(name)
+    if codec is None:
+        raise RuntimeError(f"Data compressed with '{name}' cannot be read: its compression library is not installed")
+    return codec
+
+
+def content_hash(text):
+    """sha256 of the UTF-8 text, the same hash fetch_scheduler.FetchResult.content_hash gives"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# Compressed chunk text is stored in the existing text column as MARKER + codec + ':' + base85 of the
+# compressed bytes, so it works on any database and rows written uncompressed stay readable.
+TEXT_MARKER = '\x1bvz1:'
+MIN_COMPRESS_CHARS = 200
+
+
+def compress_text(text):
+    """Compress text for a text column; short texts, and texts that would not shrink, are kept as they are"""
+    if text is None or len(text) < MIN_COMPRESS_CHARS:
+        return text
+    codec = best_codec()
+    packed = f"{TEXT_MARKER}{codec.name}:{base64.b85encode(codec.compress(text.encode('utf-8'))).decode('ascii')}"
+    return packed if len(packed) < len(text.encode('utf-8')) else text
+
+
+def decompress_text(value):
+    if value is None or not value.startswith(TEXT_MARKER):
+        return value
+    name, _, data = value[len(TEXT_MARKER):].partition(':')
+    return get_codec(name).decompress(base64.b85decode(data)).decode('utf-8')
+
+
+class SnapshotStore:
+    """
+    Content-addressed, compressed HTML snapshots: <root>/<hash[:2]>/<hash>.html.<codec>.
+    Other derived text of a page (e.g. the chunk lists the stage worker passes between jobs) is stored
+    the same way under another kind: <hash>.<kind>.<codec>.
+
+    put() is a no-op for content that is already stored, so re-fetching unchanged pages costs no disk.
+    Files are written to a temporary name and renamed, so concurrent writers of the same page are safe.
+    """
+
+    def __init__(self, root='snapshots'):
+        self.root = root
+
+    def _path(self, digest, codec_name, kind='html'):
+        return os.path.join(self.root, digest[:2], f"{digest}.{kind}.{codec_name}")
+
+    def find(self, digest, kind='html'):
+        """Path of the stored snapshot for a content hash, or None"""
+        for name in _codecs():
+            path = self._path(digest, name, kind)
+            if os.path.exists(path):
+                return path
+        # Written with a codec that is not installed here
+        directory = os.path.join(self.root, digest[:2])
+        if os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                if filename.startswith(f"{digest}.{kind}."):
+                    return os.path.join(directory, filename)
+        return None
+
+    def has(self, digest, kind='html'):
+        return self.find(digest, kind) is not None
+
+    def put(self, text, digest=None, kind='html'):
+        """Store html (or text of another kind) and return its content hash"""
+        digest = digest or content_hash(text)
+        if self.has(digest, kind):
+            return digest
+
+        codec = best_codec()
+        path = self._path(digest, codec.name, kind)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(codec.compress(text.encode('utf-8')))
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return digest
+
+    def get(self, digest, kind='html'):
+        """The stored html (or text of another kind) for a content hash, or None"""
+        path = self.find(digest, kind) if digest else None
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        return get_codec(path.rsplit('.', 1)[1]).decompress(data).decode('utf-8')
+
+    def stats(self):
+        """Number of snapshots and their total size on disk in bytes"""
+        count = size = 0
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if '.html.' in filename and not filename.startswith('.tmp-'):
+                    count += 1
+                    size += os.path.getsize(os.path.join(directory, filename))
+        return {'snapshots': count, 'bytes': size}
+
+
+@lru_cache(maxsize=None)
+def get_snapshot_store():
+    """The process-wide SnapshotStore at config.snapshot_dir, or None when snapshots are disabled"""
+    from vibescraper.config import snapshots_enabled, snapshot_dir
+    return SnapshotStore(snapshot_dir) if snapshots_enabled else None
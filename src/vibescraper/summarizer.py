@@ -0,0 +1,146 @@
+import asyncio
+from vibescraper.openai_utils import generate, count_tokens, truncate_to_tokens, route_model
+from vibescraper.tracing import span
+
+
+REDUCE_SYSTEM_MESSAGE = 'Your goal is to merge a set of referenced summaries of scraped web data into a single, shorter referenced summary, based on a query. Keep every important fact, drop repetition, and keep the references exactly as given in brackets: (reference: <quote>, source: <url>). Never invent quotes or urls.'
+
+# With a token budget, the report is written only when at least this many prompt tokens are left for it
+MIN_REPORT_PROMPT_TOKENS = 256
+# Completion tokens a token budget reserves for the report at most (it is asked for up to 1000 words)
+REPORT_COMPLETION_TOKENS = 2048
+
+REPORT_SYSTEM_MESSAGE = 'You goal is to write a report no more than 1000 words long about a topic, given a query string and a set of summaries from source material. The summaries contain references. Please use these references to create a fully referenced report such that any information contained in the report has a sourced reference in brackets as follows: (reference: <quote>, source: <url>). Note, the <quote> MUST be an actual snippet from the given source material, and the source <url> must be the exact given source url that snippet was taken from.'
+
+
+class MapReduceSummarizer:
+    """
+    Hierarchical map-reduce summarization of page summaries.
+
+    Summaries are packed into token-bounded batches, each batch is reduced to one summary
+    in parallel, and the process repeats until everything fits into a single report prompt.
+    The number of sequential LLM rounds grows with log(number of pages), and the final
+    prompt never exceeds batch_tokens.
+
+    With a usage.TokenBudget, every prompt and completion is sized from what is left of it: reduce
+    completions are capped, a reduce round that would not leave enough for the report is skipped,
+    and the report prompt keeps only the most relevant summaries that fit.
+    """
+
+    def __init__(self, search_query, text_model='gpt-4o', batch_tokens=6000, reduce_words=400, max_concurrency=8, max_tokens=None, budget=None):
+        self.search_query = search_query
+        self.text_model = text_model
+        self.batch_tokens = batch_tokens
+        self.reduce_words = reduce_words
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Any single item is capped at half a batch so every batch holds at least two items
+        self.max_item_tokens = batch_tokens // 2
+        self.rounds = 0
+        # Optional completion cap for the final report, e.g. from a token budget
+        self.max_tokens = max_tokens
+        # Optional usage.TokenBudget the reduce rounds and the report are planned against
+        self.budget = budget
+        self.reduce_tokens = 2 * reduce_words if budget is not None else None
+
+    def _prepare(self, text):
+        text = text.strip()
+        tokens = count_tokens(text)
+        if tokens > self.max_item_tokens:
+            text = truncate_to_tokens(text, self.max_item_tokens)
+            tokens = self.max_item_tokens
+        return text, tokens
+
+    def make_batches(self, items):
+        """Greedily pack (text, tokens) items into batches of at most batch_tokens"""
+        batches = []
+        current = []
+        current_tokens = 0
+        for text, tokens in items:
+            if current and current_tokens + tokens > self.batch_tokens:
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append((text, tokens))
+            current_tokens += tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    async def _reduce_batch(self, batch):
+        if len(batch) == 1:
+            return batch[0][0]
+
+        prompt = f'Given the following query: {self.search_query}, merge the following summaries into one referenced summary of no more than {self.reduce_words} words:\n\n'
+        prompt += '\n\n---\n\n'.join(text for text, _ in batch)
+
+        async with self.semaphore:
+            reduced = await generate(REDUCE_SYSTEM_MESSAGE, prompt, model=route_model(self.text_model, 'reduce'),
+                                     max_tokens=self.reduce_tokens)
+        return reduced or ''
+
+    def report_limits(self):
+        """(prompt tokens, completion tokens) the final report may use"""
+        if self.budget is None:
+            return self.batch_tokens, self.max_tokens
+        remaining = self.budget.remaining()
+        completion = min(REPORT_COMPLETION_TOKENS, max(MIN_REPORT_PROMPT_TOKENS, remaining // 3))
+        if self.max_tokens:
+            completion = min(completion, self.max_tokens)
+        return max(0, min(self.batch_tokens, remaining - completion)), completion
+
+    @staticmethod
+    def fit(items, max_tokens):
+        """The leading (most relevant) items that fit in max_tokens, the first one truncated if need be"""
+        kept = []
+        total = 0
+        for text, tokens in items:
+            if total + tokens > max_tokens:
+                if not kept and max_tokens > 0:
+                    kept.append((truncate_to_tokens(text, max_tokens), max_tokens))
+                break
+            kept.append((text, tokens))
+            total += tokens
+        return kept
+
+    async def reduce(self, summaries):
+        """Reduce summaries level by level until they fit into one batch"""
+        items = [self._prepare(s) for s in summaries if s and s.strip()]
+
+        while len(items) > 1 and sum(tokens for _, tokens in items) > self.report_limits()[0]:
+            batches = self.make_batches(items)
+            if self.budget is not None:
+                # The round's prompts and completions, then a report over its outputs
+                round_tokens = sum(tokens for _, tokens in items) + 2 * len(batches) * self.reduce_tokens
+                if round_tokens + self.report_limits()[1] > self.budget.remaining():
+                    print(f'Token budget: no reduce round for {len(items)} summaries, keeping the most relevant')
+                    break
+            self.rounds += 1
+            print(f'Reduce round {self.rounds}: {len(items)} summaries -> {len(batches)} batches')
+            with span('summarize.reduce', round=self.rounds, summaries=len(items), batches=len(batches)):
+                reduced = await asyncio.gather(*(self._reduce_batch(batch) for batch in batches), return_exceptions=True)
+            # Every batch is sent before a failure (e.g. openai_batch.DeferredRequest) is raised
+            for result in reduced:
+                if isinstance(result, BaseException):
+                    raise result
+            items = [self._prepare(text) for text in reduced if text]
+
+        return [text for text, _ in items]
+
+    async def summarize(self, summaries):
+        """Build the final referenced report from any number of page summaries"""
+        reduced = await self.reduce(summaries)
+        if not reduced:
+            return ''
+
+        summary_str = f'Given the following query: {self.search_query}, please rewrite the following page summaries into a well documented and fully referenced report, no more than 1000 words long: '
+        prompt_tokens, max_tokens = self.report_limits()
+        if self.budget is not None:
+            available = prompt_tokens - count_tokens(summary_str)
+            if available < MIN_REPORT_PROMPT_TOKENS:
+                print('Token budget spent: returning the most relevant summary without a report')
+                return reduced[0]
+            reduced = [text for text, _ in self.fit([(text, count_tokens(text)) for text in reduced], available)]
+        summary_str += '\n\n---\n\n'.join(reduced)
+
+        return await generate(REPORT_SYSTEM_MESSAGE, summary_str, model=route_model(self.text_model, 'report'),
+                              max_tokens=max_tokens)
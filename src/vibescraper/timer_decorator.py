@@ -1,11 +1,27 @@
 import time
+import inspect
 from functools import wraps
+from vibescraper.tracing import span
+
 
 def timer(func):
+    """Print how long each call takes, and record it as a span when a tracer is active. Works on coroutines too."""
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            with span(func.__qualname__):
+                result = await func(*args, **kwargs)
+            elapsed_time = time.perf_counter() - start_time
+            print(f"Function '{func.__name__}' executed in {elapsed_time:.4f} seconds")
+            return result
+        return async_wrapper
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         start_time = time.perf_counter()
-        result = func(*args, **kwargs)
+        with span(func.__qualname__):
+            result = func(*args, **kwargs)
         end_time = time.perf_counter()
         elapsed_time = end_time - start_time
         print(f"Function '{func.__name__}' executed in {elapsed_time:.4f} seconds")
@@ -0,0 +1,250 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+_current_tracer = contextvars.ContextVar('vibescraper_tracer', default=None)
+_current_span = contextvars.ContextVar('vibescraper_span', default=None)
+
+
+def _lane_id():
+    """Identify the asyncio task (or thread) a span runs on, so concurrent spans get separate trace lanes"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return id(task)
+    return threading.get_ident()
+
+
+class Span:
+    """A single timed operation with attributes"""
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.lane = _lane_id()
+        self.status = 'ok'
+        self.error = None
+        self.start_ns = time.time_ns()
+        self._start_perf = time.perf_counter_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, error=None):
+        self.end_ns = self.start_ns + (time.perf_counter_ns() - self._start_perf)
+        if error is not None:
+            self.status = 'error'
+            self.error = repr(error)
+
+    @property
+    def duration(self):
+        """Duration in seconds"""
+        if self.end_ns is None:
+            return None
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start_ns / 1e9,
+            'duration': self.duration,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+class Tracer:
+    """
+    Collects spans for one run of the pipeline.
+
+    Activate it with `with tracer.activate():` (vibe_search does this when given a tracer);
+    span() and traced() calls made inside, including in tasks and threads started from it, are recorded.
+    """
+
+    def __init__(self, name='vibe_search'):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        token = _current_tracer.set(self)
+        try:
+            yield self
+        finally:
+            _current_tracer.reset(token)
+
+    def start_span(self, name, attributes=None):
+        parent = _current_span.get()
+        parent_id = parent.span_id if parent is not None and parent.trace_id == self.trace_id else None
+        return Span(name, self.trace_id, parent_id, attributes)
+
+    def end_span(self, span, error=None):
+        span.finish(error)
+        with self._lock:
+            self.spans.append(span)
+
+    def timings(self):
+        """Structured timings: per-operation aggregates plus every recorded span"""
+        operations = {}
+        for span in self.spans:
+            stats = operations.setdefault(span.name, {'count': 0, 'total': 0.0, 'min': None, 'max': 0.0, 'errors': 0})
+            stats['count'] += 1
+            stats['total'] += span.duration
+            stats['max'] = max(stats['max'], span.duration)
+            stats['min'] = span.duration if stats['min'] is None else min(stats['min'], span.duration)
+            if span.status == 'error':
+                stats['errors'] += 1
+        for stats in operations.values():
+            stats['mean'] = stats['total'] / stats['count']
+
+        return {
+            'trace_id': self.trace_id,
+            'operations': operations,
+            'spans': [span.to_dict() for span in sorted(self.spans, key=lambda s: s.start_ns)],
+        }
+
+    def to_chrome_trace(self):
+        """Chrome trace event format, viewable in chrome://tracing or Perfetto"""
+        if not self.spans:
+            return {'traceEvents': []}
+        origin = min(span.start_ns for span in self.spans)
+        lanes = {}
+        events = []
+        for span in sorted(self.spans, key=lambda s: s.start_ns):
+            tid = lanes.setdefault(span.lane, len(lanes) + 1)
+            args = {key: _plain(value) for key, value in span.attributes.items()}
+            if span.error:
+                args['error'] = span.error
+            events.append({
+                'name': span.name,
+                'cat': span.name.split('.')[0],
+                'ph': 'X',
+                'ts': (span.start_ns - origin) / 1000,
+                'dur': (span.end_ns - span.start_ns) / 1000,
+                'pid': os.getpid(),
+                'tid': tid,
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def to_otel(self):
+        """OpenTelemetry OTLP/JSON export (ResourceSpans), accepted by OTLP/HTTP collectors"""
+        spans = []
+        for span in sorted(self.spans, key=lambda s: s.start_ns):
+            spans.append({
+                'traceId': self.trace_id,
+                'spanId': span.span_id,
+                'parentSpanId': span.parent_id or '',
+                'name': span.name,
+                'kind': 1,
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.end_ns),
+                'attributes': [_otel_attribute(key, value) for key, value in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.status == 'error' else {'code': 1},
+            })
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [_otel_attribute('service.name', 'vibescraper')]},
+                'scopeSpans': [{'scope': {'name': 'vibescraper.tracing'}, 'spans': spans}],
+            }]
+        }
+
+    def export(self, path, format='chrome'):
+        """Write the trace to a JSON file in 'chrome', 'otel' or 'timings' format"""
+        exporters = {'chrome': self.to_chrome_trace, 'otel': self.to_otel, 'timings': self.timings}
+        if format not in exporters:
+            raise ValueError(f"Unknown trace format: {format}")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(exporters[format](), f)
+        return path
+
+
+def _plain(value):
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return str(value)
+
+
+def _otel_attribute(key, value):
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+
+def get_tracer():
+    """The tracer active in the current context, or None"""
+    return _current_tracer.get()
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time a block as a span of the active tracer. Yields the Span (or None when no tracer is active)
+    so the block can add attributes with set_attribute.
+    """
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield None
+        return
+
+    current = tracer.start_span(name, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        tracer.end_span(current, error=e)
+        raise
+    else:
+        tracer.end_span(current)
+    finally:
+        _current_span.reset(token)
+
+
+def traced(name=None, **attributes):
+    """Decorator recording each call of a sync function or coroutine function as a span"""
+
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name, **attributes):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attributes):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -0,0 +1,208 @@
+"""
+Token and cost accounting.
+
+openai_utils reports the `usage` of every response to the UsageMeters active in the current
+context, so a page's meter sees only the calls made while processing that page and the
+operation's meter sees every call of the run. Meters are activated like tracers, with
+`with meter.activate():`, and follow asyncio tasks and to_thread calls started inside.
+"""
+import contextvars
+import re
+import threading
+from contextlib import contextmanager
+
+# USD per 1M tokens: (input, output). Looked up by longest matching prefix of the model name with
+# punctuation removed, so 'gpt_4_1_mini', 'gpt-4.1-mini' and dated snapshots share one entry.
+PRICES = {
+    'gpt4o': (2.50, 10.00),
+    'gpt4omini': (0.15, 0.60),
+    'gpt41': (2.00, 8.00),
+    'gpt41mini': (0.40, 1.60),
+    'gpt41nano': (0.10, 0.40),
+    'gpt4turbo': (10.00, 30.00),
+    'gpt4': (30.00, 60.00),
+    'gpt35turbo': (0.50, 1.50),
+    'o1': (15.00, 60.00),
+    'o1mini': (1.10, 4.40),
+    'o3': (2.00, 8.00),
+    'o3mini': (1.10, 4.40),
+    'o4mini': (1.10, 4.40),
+    'textembedding3small': (0.02, 0.0),
+    'textembedding3large': (0.13, 0.0),
+    'textembeddingada002': (0.10, 0.0),
+}
+
+# Batch API requests (see openai_batch) are billed at half the synchronous price
+BATCH_DISCOUNT = 0.5
+
+_active_meters = contextvars.ContextVar('vibescraper_usage_meters', default=())
+
+
+def _price_key(model):
+    return re.sub(r'[^a-z0-9]', '', str(model).lower())
+
+
+def price(model):
+    """(input, output) USD per 1M tokens for a model, or None when it is not in PRICES"""
+    key = _price_key(model)
+    for prefix in sorted(PRICES, key=len, reverse=True):
+        if key.startswith(prefix):
+            return PRICES[prefix]
+    return None
+
+
+def cost(model, prompt_tokens, completion_tokens=0):
+    """Estimated USD cost of a call; 0.0 for models without a known price"""
+    prices = price(model)
+    if prices is None:
+        return 0.0
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1e6
+
+
+class UsageMeter:
+    """Adds up the tokens, requests and estimated cost of the OpenAI calls made while it is active"""
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.embedding_tokens = 0
+        self.requests = 0
+        self.cached_requests = 0
+        self.cost = 0.0
+        self.by_model = {}
+        self._lock = threading.Lock()
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens + self.embedding_tokens
+
+    @contextmanager
+    def activate(self):
+        token = _active_meters.set(_active_meters.get() + (self,))
+        try:
+            yield self
+        finally:
+            _active_meters.reset(token)
+
+    def add(self, kind, model, prompt_tokens=0, completion_tokens=0, cached=False, batch=False):
+        call_cost = 0.0 if cached else cost(model, prompt_tokens, completion_tokens)
+        if batch:
+            call_cost *= BATCH_DISCOUNT
+        with self._lock:
+            if cached:
+                self.cached_requests += 1
+                return
+            self.requests += 1
+            if kind == 'embedding':
+                self.embedding_tokens += prompt_tokens
+            else:
+                self.prompt_tokens += prompt_tokens
+                self.completion_tokens += completion_tokens
+            self.cost += call_cost
+            model_usage = self.by_model.setdefault(model, {'requests': 0, 'tokens': 0, 'cost': 0.0})
+            model_usage['requests'] += 1
+            model_usage['tokens'] += prompt_tokens + completion_tokens
+            model_usage['cost'] += call_cost
+
+    def columns(self):
+        """The usage columns of an Operation or Page row"""
+        return {
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'embedding_tokens': self.embedding_tokens,
+            'cost': round(self.cost, 6),
+        }
+
+    def to_dict(self):
+        return {**self.columns(), 'total_tokens': self.total_tokens, 'requests': self.requests,
+                'cached_requests': self.cached_requests, 'by_model': self.by_model}
+
+    def __repr__(self):
+        return f"<UsageMeter(tokens={self.total_tokens}, requests={self.requests}, cost=${self.cost:.4f})>"
+
+
+def record_usage(kind, model, usage=None, cached=False, batch=False):
+    """
+    Report one API call to every active meter. kind is 'chat' or 'embedding'; usage is the
+    response's usage object (or dict), None for cache hits. batch=True for Batch API responses.
+    """
+    meters = _active_meters.get()
+    if not meters:
+        return
+    prompt_tokens = completion_tokens = 0
+    if usage is not None:
+        get = usage.get if isinstance(usage, dict) else lambda name, default=0: getattr(usage, name, default)
+        prompt_tokens = get('prompt_tokens', 0) or 0
+        completion_tokens = get('completion_tokens', 0) or 0
+    for meter in meters:
+        meter.add(kind, model, prompt_tokens, completion_tokens, cached=cached, batch=batch)
+
+
+class TokenBudget:
+    """
+    Caps the tokens one vibe_search run uses.
+
+    Pages draw an equal share of what is left, after reserving `summary_reserve` of the budget
+    for the combined summary, when they start. A page that does not fit its share embeds fewer
+    chunks (the most relevant ones by a local pre-rank) and gets a shorter summary; once the
+    budget is spent remaining pages are skipped. The combined summary's reduce rounds and report
+    are sized from what is left (see summarizer.MapReduceSummarizer).
+    """
+
+    def __init__(self, max_tokens, summary_reserve=0.2, min_page_tokens=500):
+        """
+        Args:
+            max_tokens - total tokens (prompt, completion and embedding) the run may use
+            summary_reserve - fraction of max_tokens kept for the combined summary
+            min_page_tokens - pages are skipped once less than this is left for them
+        """
+        self.max_tokens = max_tokens
+        self.summary_reserve = summary_reserve
+        self.min_page_tokens = min_page_tokens
+        self.meter = UsageMeter()
+        self.pages_left = 0
+        self.skipped_pages = 0
+        self._running = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_option(cls, budget):
+        if budget is None or isinstance(budget, TokenBudget):
+            return budget
+        return cls(int(budget))
+
+    def remaining(self):
+        return max(0, self.max_tokens - self.meter.total_tokens)
+
+    def plan_pages(self, count):
+        with self._lock:
+            self.pages_left += count
+
+    def page_allowance(self, page_meter):
+        """
+        Tokens the next page may use, or None when the page should be skipped. page_meter is the
+        page's UsageMeter; until page_done() the unused part of its allowance stays reserved.
+        """
+        with self._lock:
+            pages = max(1, self.pages_left)
+            self.pages_left = max(0, self.pages_left - 1)
+            reserved = sum(max(0, allowance - meter.total_tokens) for allowance, meter in self._running.values())
+            available = self.max_tokens * (1 - self.summary_reserve) - self.meter.total_tokens - reserved
+            allowance = int(available / pages)
+            if allowance < self.min_page_tokens:
+                self.skipped_pages += 1
+                return None
+            self._running[id(page_meter)] = (allowance, page_meter)
+            return allowance
+
+    def page_done(self, page_meter):
+        with self._lock:
+            self._running.pop(id(page_meter), None)
+
+    def summary_tokens(self):
+        """Completion cap for the combined summary, from what is left"""
+        return max(256, self.remaining() // 2)
+
+    def summary(self):
+        return {'max_tokens': self.max_tokens, 'used': self.meter.total_tokens, 'skipped_pages': self.skipped_pages,
+                'cost': round(self.meter.cost, 6)}
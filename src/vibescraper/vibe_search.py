@@ -1,10 +1,16 @@
+import asyncio
+import datetime
+import time
+from contextlib import nullcontext
 import requests
-from vibescraper.openai_utils import get_embedding, generate
 from vibescraper.google_search import google_search
-from vibescraper.page_embedder import PageEmbeddingProcessor, CombinedResultsProcessor
-from vibescraper.html_parser import process_html_with_semantic_chunker
 from vibescraper.brave_search import brave_search
-from vibescraper.db_schema import DBManager
+from vibescraper.adaptive import AdaptiveStop
+from vibescraper.hedging import Hedging
+from vibescraper.resources import SearchResources
+from vibescraper.profiling import RunProfiler, profile_stage
+from vibescraper.tracing import span
+from vibescraper.usage import TokenBudget, UsageMeter
 import json
 
 from vibescraper.config import search_engine
@@ -27,71 +33,361 @@ def fetch_html(url):
 
 
 
-async def vibe_search(query, text_model='gpt_4_1_mini', embedding_model='small', dimensions=1536, top_k=5, domain_count=5):
+async def vibe_search(query, text_model='gpt_4_1_mini', embedding_model='small', dimensions=1536, top_k=5, domain_count=5, scheduler=None, tracer=None, resources=None, on_event=None, adaptive=None, first_pass=None, coarse_dims=None, profile=None, budget=None, hedge=None):
     """
     Args: 
         query - search string
-        text_model - the text generation model used for summaries and query expansion.
+        text_model - the text generation model used for summaries and query expansion, or a dict of models per
+                     stage: 'expand', 'page', 'reduce', 'report' and 'default' (see openai_utils.route_model).
         embedding_model - embedding model size: small, large, legacy. default  = small
+                          'hashing' embeds locally on the CPU (no network), or pass an embeddings.EmbeddingProvider.
         dimensions - embedding dimensions. default 1536
         top_k - the number of top similar chunks to get in vector search/
         domain_count - the number of domains to search
+        scheduler - optional FetchScheduler, to share per-host politeness state between searches
+        tracer - optional tracing.Tracer. Every stage of the run is recorded on it; read tracer.timings()
+                 afterwards or export it with tracer.export(path, format='chrome' or 'otel').
+        resources - optional SearchResources shared between searches (HTTP pool, DB engine, fetched pages).
+                    A private one is created and closed otherwise.
+        on_event - optional callback on_event(event, data) for progress: 'search' (urls), 'page' (url, page_summary)
+                   and 'summary' (combined_summary). Used by the streaming server endpoint.
+        adaptive - optional early termination: True or an adaptive.AdaptiveStop. Pages are then processed a few
+                   at a time and the rest are cancelled once new pages stop improving the best top_k chunk
+                   similarities; when results stay weak more urls than domain_count are searched for.
+        first_pass - optional cheap embedding model (e.g. 'hashing') that pre-ranks each page's chunks so only the
+                     best candidates are embedded with embedding_model.
+        coarse_dims - optional two-stage ranking: chunks are shortlisted on their first coarse_dims embedding
+                      components (renormalized, int8) and only the shortlist is scored at full dimension.
+        budget - optional cap on the OpenAI tokens (prompt, completion and embedding) of the run, an int or a
+                 usage.TokenBudget. Pages share it: when a page would exceed its share fewer chunks are embedded and
+                 summaries are shorter, and once it is spent the remaining pages are skipped. Token usage and
+                 estimated cost are stored on the operation and page rows with or without a budget.
+        profile - optional profiling: a report directory, or True for ./profiles/<query>_<time>. A CPU profile,
+                  asyncio task wait times and per-stage tracemalloc allocations are written there (see profiling).
+        hedge - optional hedged requests against tail latency: True (at most 5% extra requests), the fraction of
+                extra requests allowed, or a hedging.Hedging. Fetches and OpenAI calls slower than the 95th
+                percentile of recent ones are sent again and the first reply wins; spare search urls are started
+                in place of pages whose fetch stalls, and the stalled pages are dropped once enough pages are done.
 
     Returns an AI summary of the search results from the scraped domains.
 
     """
+    owns_resources = resources is None
+    if owns_resources:
+        resources = SearchResources(scheduler=scheduler)
 
-    db = DBManager()
-    db.create_tables()
+    profiler = RunProfiler.from_option(profile, query) if profile else None
+    budget = TokenBudget.from_option(budget)
+    usage = budget.meter if budget else UsageMeter()
+    hedging = Hedging.from_option(hedge, resources)
+    try:
+        with resources.activate(), profiler.activate() if profiler else nullcontext(), usage.activate(), \
+                hedging.activate() if hedging else nullcontext():
+            if tracer is None:
+                return await _vibe_search(query, text_model, embedding_model, dimensions, top_k, domain_count, resources, on_event, adaptive, first_pass, coarse_dims, usage, budget, hedging)
 
+            with tracer.activate():
+                with span('vibe_search', query=query, domain_count=domain_count, top_k=top_k):
+                    return await _vibe_search(query, text_model, embedding_model, dimensions, top_k, domain_count, resources, on_event, adaptive, first_pass, coarse_dims, usage, budget, hedging)
+    finally:
+        if owns_resources:
+            await resources.aclose()
 
-    query = query.strip('"')
 
+def _emit(on_event, event, **data):
+    if on_event is None:
+        return
+    try:
+        on_event(event, data)
+    except Exception as e:
+        print(f"on_event callback failed for {event}: {e}")
 
 
+async def search_urls(query, domain_count=5):
+    """Run the configured search engine and return the result urls"""
     print(f"Starting {search_engine} search: {query}")
 
-    if search_engine == 'brave':
-        print("================ Using Brave search engine ================")
-        urls = await brave_search(query, count=5)
-    else:
-        print("================ Using Google search engine ================")
-        search_results = google_search(query, num_results=domain_count)
+    with span('search', engine=search_engine, query=query) as search_span:
+        if search_engine == 'brave':
+            print("================ Using Brave search engine ================")
+            urls = await brave_search(query, count=domain_count)
+        else:
+            print("================ Using Google search engine ================")
+            search_results = google_search(query, num_results=domain_count)
+
+            urls = [r["link"] for r in search_results]
+        if search_span:
+            search_span.set_attribute('results', len(urls))
+    return urls
+
+
+async def record_fetch(db, page_id, result):
+    """Store what was fetched for a page so a later refresh can tell whether it changed"""
+    if not (db and page_id):
+        return
+    try:
+        await db.write(
+            'update_page',
+            page_id,
+            content_hash=result.content_hash,
+            etag=result.etag,
+            last_modified=result.last_modified,
+            fetched_at=datetime.datetime.utcnow()
+        )
+    except Exception as e:
+        print(f"Error storing fetch info in database: {e}")
+
 
-        urls = [r["link"] for r in search_results]
+async def store_usage(db, operation_id, usage):
+    """Store a run's token usage and estimated cost on its operation row"""
+    if usage is None:
+        return
+    print(f"Token usage: {usage.total_tokens} tokens in {usage.requests} requests, ~${usage.cost:.4f}")
+    if operation_id:
+        await db.write('update_operation', operation_id, **usage.columns())
 
-    combined_processor = CombinedResultsProcessor(query, text_model=text_model, embedding_model=embedding_model, dimensions=dimensions, top_k=top_k)
 
-    for url in urls:
-        html = fetch_html(url)
+def _page_result(task, url):
+    """The processor of a finished page task, or None when the page failed (the rest of the search goes on)"""
+    try:
+        return task.result()
+    except Exception as e:
+        print(f"Error processing {url}: {e}")
+        return None
+
+
+async def _cancel(tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _process_adaptively(query, urls, process_url, policy, on_event=None):
+    """
+    Process urls a few at a time, feeding each finished page to the AdaptiveStop policy.
+    Cancels the pages still running once the policy says to stop, and searches for extra
+    urls when every page is done and the results are still weak.
+    """
+    seen = list(urls)
+    pending = list(urls)
+    page_processors = []
+    limit = asyncio.Semaphore(policy.max_concurrent_pages)
+
+    async def limited(url):
+        async with limit:
+            return await process_url(url)
+
+    running = {}
+    with span('pages', urls=len(urls), adaptive=True) as pages_span:
+        try:
+            while pending:
+                running = {asyncio.ensure_future(limited(url)): url for url in pending}
+                pending = []
+                while running:
+                    done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        page_processor = _page_result(task, running.pop(task))
+                        page_processor = page_processor if page_processor and page_processor.top_results else None
+                        similarities = [r.similarity for r in page_processor.top_results] if page_processor else []
+                        policy.observe(similarities)
+                        page_processors.append(page_processor)
+
+                    if running and policy.should_stop():
+                        print(f"Enough relevant content after {policy.pages} pages (score {policy.score:.3f}), "
+                              f"cancelling {len(running)} remaining")
+                        await _cancel(running)
+                        running = {}
+
+                extra = policy.extra_urls(len(seen))
+                if extra:
+                    more = await search_urls(query, len(seen) + extra)
+                    pending = [url for url in more if url not in seen]
+                    if pending:
+                        policy.extensions += 1
+                        print(f"Weak results (score {policy.score:.3f}), adding {len(pending)} more urls")
+                        seen.extend(pending)
+                        _emit(on_event, 'search', query=query, urls=pending)
+        finally:
+            # The search failed or was cancelled: don't leave its pages running
+            await _cancel(running)
+
+        if pages_span:
+            for name, value in policy.summary().items():
+                if name != 'history':
+                    pages_span.set_attribute(name, value)
+            pages_span.set_attribute('urls', len(seen))
+
+    return page_processors
+
+
+async def _process_speculatively(query, urls, spare_urls, process_url, fetched, policy, on_event=None):
+    """
+    Process urls, starting a spare url whenever a page's fetch has not finished within the fetch hedge
+    delay (and the hedging load limit allows). Once as many pages have been processed as there were
+    urls, pages still running are cancelled.
+    """
+    spare_urls = list(spare_urls)
+    running = {}
+    speculated = set()
+    page_processors = []
+
+    def start(url):
+        fetched[url] = asyncio.Event()
+        running[asyncio.ensure_future(process_url(url))] = (url, time.monotonic())
+
+    with span('pages', urls=len(urls), speculative=True) as pages_span:
+        try:
+            # Each page's fetch counts itself as a call of the fetch policy (HedgePolicy.run)
+            for url in urls:
+                start(url)
+
+            while running:
+                delay = policy.delay()
+                done, _ = await asyncio.wait(running, timeout=max(0.05, delay / 4) if delay else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    url, _ = running.pop(task)
+                    page_processors.append(_page_result(task, url))
+
+                if running and sum(1 for page in page_processors if page is not None) >= len(urls):
+                    print(f"Dropping {len(running)} stalled pages: enough pages are done")
+                    break
+
+                now = time.monotonic()
+                for task, (url, started) in list(running.items()):
+                    if (spare_urls and delay is not None and task not in speculated and not fetched[url].is_set()
+                            and now - started > delay and policy.try_hedge()):
+                        speculated.add(task)
+                        spare = spare_urls.pop(0)
+                        print(f"{url} stalled after {now - started:.1f}s, starting {spare}")
+                        _emit(on_event, 'search', query=query, urls=[spare])
+                        start(spare)
+        finally:
+            # Stalled pages, or every page when the search failed or was cancelled
+            await _cancel(running)
+
+        if pages_span:
+            pages_span.set_attribute('speculative_urls', len(speculated))
+    return page_processors
+
+
+async def _vibe_search(query, text_model, embedding_model, dimensions, top_k, domain_count, resources, on_event=None, adaptive=None, first_pass=None, coarse_dims=None, usage=None, budget=None, hedging=None):
+    # numpy is only loaded once a search actually runs
+    from vibescraper.page_embedder import PageEmbeddingProcessor, CombinedResultsProcessor
+
+    db = resources.db
+
+
+    query = query.strip('"')
+
+
+
+    # Spare results are kept for pages that stall (hedge=); adaptive runs find more urls on their own
+    spare_count = hedging.spare_urls if hedging and not adaptive else 0
+    with profile_stage('search'):
+        urls = await search_urls(query, domain_count + spare_count)
+    urls, spare_urls = urls[:domain_count], urls[domain_count:]
+    _emit(on_event, 'search', query=query, urls=urls)
+    if budget:
+        budget.plan_pages(len(urls))
+
+    combined_processor = CombinedResultsProcessor(query, db_manager=db, text_model=text_model, embedding_model=embedding_model, dimensions=dimensions, top_k=top_k, coarse_dims=coarse_dims)
+    await combined_processor.create_record()
+    if combined_processor.operation_id:
+        await db.write('update_operation', combined_processor.operation_id, domain_count=domain_count,
+                       token_budget=budget.max_tokens if budget else None)
+
+    fetched = {}
+
+    async def process_url(url):
+        result, chunks = await resources.get_page(url)
+        if url in fetched:
+            fetched[url].set()
 
         with open('searched_urls.txt', '+a') as f:
             f.write('\n')
             f.write(url)
 
-        if not html:
-            continue
-
-        print(f"\nProcessing: {url}")
-        chunks = process_html_with_semantic_chunker(html)
-
-        page_processor = PageEmbeddingProcessor(
-            url,
-            query,
-            db,
-            combined_processor.operation_id,
-            text_model, 
-            embedding_model,
-            dimensions,
-            top_k
-        )
+        if not chunks:
+            if budget:
+                # Nothing to process, so the page's share goes to the others
+                budget.plan_pages(-1)
+            return None
+
+        async with resources.page_semaphore:
+            page_usage = UsageMeter()
+            allowance = budget.page_allowance(page_usage) if budget else None
+            if budget and allowance is None:
+                print(f"\nToken budget spent, skipping: {url}")
+                return None
+
+            print(f"\nProcessing: {url}")
+            with span('page', url=url, html_bytes=len(result.text)), page_usage.activate():
+                page_processor = PageEmbeddingProcessor(
+                    url,
+                    query,
+                    db,
+                    combined_processor.operation_id,
+                    text_model, 
+                    embedding_model,
+                    dimensions,
+                    top_k,
+                    first_pass=first_pass,
+                    coarse_dims=coarse_dims,
+                    token_allowance=allowance
+                )
+                await page_processor.create_record()
+
+                try:
+                    await page_processor.process_chunks(chunks)
+                except asyncio.CancelledError:
+                    # Stopped early: don't leave a half processed page behind
+                    if page_processor.page_id:
+                        db.write_nowait('delete_page', page_processor.page_id)
+                    raise
+                finally:
+                    if budget:
+                        budget.page_done(page_usage)
+                await record_fetch(db, page_processor.page_id, result)
+                if page_processor.page_id:
+                    await db.write('update_page', page_processor.page_id, **page_usage.columns())
+
+                page_processor.save_to_json()
+        _emit(on_event, 'page', url=url, page_summary=page_processor.page_summary)
+        return page_processor
+
+    with profile_stage('pages'):
+        if adaptive:
+            if adaptive is True:
+                adaptive = AdaptiveStop(top_k=top_k, max_urls=max(2 * domain_count, domain_count + 5))
+            page_processors = await _process_adaptively(query, urls, process_url, adaptive, on_event)
+        elif spare_urls:
+            page_processors = await _process_speculatively(query, urls, spare_urls, process_url, fetched,
+                                                           hedging.fetch, on_event)
+        else:
+            with span('pages', urls=len(urls)):
+                page_processors = await asyncio.gather(*(process_url(url) for url in urls))
 
-        await page_processor.process_chunks(chunks)
+    for page_processor in page_processors:
+        if page_processor is not None:
+            combined_processor.add_page_results(page_processor)
 
-        page_processor.save_to_json()
-        combined_processor.add_page_results(page_processor)
+    if not combined_processor.page_results:
+        print(f"No pages could be processed for: {query}")
+        await store_usage(db, combined_processor.operation_id, usage)
+        await db.flush()
+        _emit(on_event, 'summary', combined_summary=combined_processor.combined_summary)
+        return combined_processor.combined_summary
 
-    await combined_processor.process_combined_results()
+    if budget:
+        combined_processor.summary_max_tokens = budget.summary_tokens()
+        combined_processor.token_budget = budget
+    with profile_stage('combine'), span('combine', pages=len(combined_processor.page_results)):
+        await combined_processor.process_combined_results()
     combined_processor.save_to_json()
+    await store_usage(db, combined_processor.operation_id, usage)
+    # The run's rows are all committed once it returns
+    await db.flush()
+    _emit(on_event, 'summary', combined_summary=combined_processor.combined_summary)
 
     return combined_processor.combined_summary
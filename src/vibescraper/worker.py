@@ -0,0 +1,359 @@
+import asyncio
+import datetime
+import json
+import os
+import socket
+import uuid
+from contextlib import nullcontext
+from vibescraper.job_queue import JobQueue, RetryLater
+from vibescraper.openai_batch import BatchBroker, DeferredRequest
+from vibescraper.resources import SearchResources
+from vibescraper.tracing import span
+
+# Each search moves through these stages; every stage after `search` is one job per url,
+# except `combine`, which runs once all of an operation's page jobs have finished.
+STAGES = ('search', 'fetch', 'chunk', 'embed', 'summarize', 'combine')
+
+
+def submit_search(queue, query, text_model='gpt_4_1_mini', embedding_model='small', dimensions=1536, top_k=5, domain_count=5, deferred=False):
+    """
+    Queue a vibe_search run for the workers and return its operation id.
+    The combined summary ends up on the operation row and in the result of its `combine` job.
+    With deferred=True its OpenAI calls go through the Batch API (see openai_batch): slower, and cheaper.
+    """
+    query = query.strip('"')
+    operation_id = queue.db.create_operation(
+        query,
+        text_model=text_model,
+        embedding_model=embedding_model,
+        dimensions=dimensions,
+        top_k=top_k,
+        domain_count=domain_count,
+        deferred=deferred or None
+    )
+    queue.enqueue('search', {'operation_id': operation_id},
+                  idempotency_key=f'search:{operation_id}', operation_id=operation_id)
+    return operation_id
+
+
+async def wait_for_operation(queue, operation_id, poll_interval=1.0, timeout=None):
+    """Wait until an operation's combine job has finished; returns the combine job"""
+    deadline = None if timeout is None else asyncio.get_running_loop().time() + timeout
+    while True:
+        job = queue.find(f'combine:{operation_id}')
+        if job is not None and job.status in ('done', 'failed'):
+            return job
+        search_job = queue.find(f'search:{operation_id}')
+        if search_job is not None and search_job.status == 'failed':
+            return search_job
+        if deadline is not None and asyncio.get_running_loop().time() > deadline:
+            raise asyncio.TimeoutError(f"operation {operation_id} did not finish in {timeout}s")
+        await asyncio.sleep(poll_interval)
+
+
+class StageWorker:
+    """
+    Pulls pipeline stage jobs from a JobQueue and runs them.
+
+    A worker holds its own SearchResources (fetch scheduler, DB engine, chunking executor) and runs
+    up to `concurrency` jobs at once. Workers can be limited to some stages, e.g. CPU-heavy `chunk`
+    workers on one machine and API-bound `embed`/`summarize` workers on another. Every stage is
+    idempotent: the jobs it enqueues use idempotency keys and its DB writes replace earlier ones,
+    so a job re-run after a crash or lease expiry does not duplicate work downstream.
+
+    Jobs of deferred operations run with batch_broker active: a job whose OpenAI requests are
+    waiting on the Batch API goes back to the queue and is retried once they may be answered.
+    Every worker also submits and polls batches.
+    """
+
+    def __init__(self, queue, resources, stages=None, concurrency=4, poll_interval=1.0, combine_poll=2.0, worker_id=None,
+                 batch_broker=None):
+        self.queue = queue
+        self.resources = resources
+        self.db = resources.db
+        self.stages = tuple(stages) if stages else STAGES
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.combine_poll = combine_poll
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.batch_broker = batch_broker or BatchBroker(self.db)
+        self.processed = 0
+        self._stopping = False
+        self._deferred = {}
+        self._handlers = {
+            'search': self._handle_search,
+            'fetch': self._handle_fetch,
+            'chunk': self._handle_chunk,
+            'embed': self._handle_embed,
+            'summarize': self._handle_summarize,
+            'combine': self._handle_combine,
+        }
+
+    def stop(self):
+        self._stopping = True
+
+    async def run(self, exit_when_idle=False):
+        """Claim and run jobs until stop() is called (or, with exit_when_idle, until the queue is empty)"""
+        print(f"Worker {self.worker_id} running stages: {', '.join(self.stages)}")
+        tasks = set()
+        batches = asyncio.ensure_future(self._batch_loop())
+        try:
+            while not self._stopping:
+                while len(tasks) < self.concurrency:
+                    job = self.queue.claim(self.worker_id, self.stages)
+                    if job is None:
+                        break
+                    tasks.add(asyncio.ensure_future(self._run_job(job)))
+
+                if not tasks:
+                    if exit_when_idle and self.queue.unfinished_count() == 0:
+                        break
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+
+                _, tasks = await asyncio.wait(tasks, timeout=self.poll_interval, return_when=asyncio.FIRST_COMPLETED)
+
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            batches.cancel()
+        return self.processed
+
+    async def _batch_loop(self):
+        """Submit deferred OpenAI requests and collect finished batches"""
+        while True:
+            try:
+                result = await asyncio.to_thread(self.batch_broker.step)
+                for batch in result['finished']:
+                    print(f"Batch {batch['batch_id']} {batch['status']}: {batch['answered']} requests answered")
+                for batch in result['submitted']:
+                    print(f"Submitted batch {batch['batch_id']}: {batch['requests']} {batch['endpoint']} requests")
+            except Exception as e:
+                print(f"Batch API step failed: {e!r}")
+            await asyncio.sleep(self.batch_broker.poll_interval)
+
+    async def _heartbeat(self, job):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            if not self.queue.heartbeat(job.id, self.worker_id):
+                print(f"Lost lease on job {job.id} ({job.kind})")
+                return
+
+    async def _run_job(self, job):
+        heartbeat = asyncio.ensure_future(self._heartbeat(job))
+        try:
+            deferred = self.batch_broker.activate() if self._is_deferred(job.operation_id) else nullcontext()
+            with self.resources.activate(), span('job', kind=job.kind, job_id=job.id, attempt=job.attempts), deferred:
+                result = await self._handlers[job.kind](job, self.queue.payload(job))
+                # Jobs waiting on this one read what it wrote
+                await self.db.flush()
+            self.queue.complete(job.id, self.worker_id, result)
+            self.processed += 1
+        except (RetryLater, DeferredRequest) as e:
+            self.queue.release(job.id, self.worker_id, delay=e.delay)
+        except Exception as e:
+            print(f"Job {job.id} ({job.kind}) failed on attempt {job.attempts}/{job.max_attempts}: {e!r}")
+            self.queue.fail(job, self.worker_id, repr(e))
+        finally:
+            heartbeat.cancel()
+
+    def _operation(self, operation_id):
+        operation = self.db.get_operation(operation_id)
+        if operation is None:
+            raise ValueError(f"No operation with ID: {operation_id}")
+        return operation
+
+    def _is_deferred(self, operation_id):
+        if operation_id is None:
+            return False
+        if operation_id not in self._deferred:
+            operation = self.db.get_operation(operation_id)
+            self._deferred[operation_id] = bool(operation is not None and operation.deferred)
+        return self._deferred[operation_id]
+
+    def _query_embedding(self, operation_id):
+        search_job = self.queue.find(f'search:{operation_id}')
+        return (self.queue.result(search_job) or {}).get('query_embedding') if search_job else None
+
+    async def _handle_search(self, job, payload):
+        from vibescraper.page_embedder import embed_expanded_query
+        from vibescraper.vibe_search import search_urls
+
+        operation_id = payload['operation_id']
+        operation = self._operation(operation_id)
+        settings = operation.settings()
+
+        # Query embedding first: a deferred job is re-run until it is done, without searching again each time
+        query_embedding = await embed_expanded_query(
+            operation.search_query, settings['text_model'], settings['embedding_model'], settings['dimensions'])
+        urls = await search_urls(operation.search_query, operation.domain_count or 5)
+
+        # combine is queued first; it waits (RetryLater) while this job or any page job is unfinished
+        self.queue.enqueue('combine', {'operation_id': operation_id},
+                           idempotency_key=f'combine:{operation_id}', operation_id=operation_id)
+        for url in urls:
+            self.queue.enqueue('fetch', {'operation_id': operation_id, 'url': url},
+                               idempotency_key=f'fetch:{operation_id}:{url}', operation_id=operation_id)
+        return {'urls': urls, 'query_embedding': [float(x) for x in query_embedding]}
+
+    async def _handle_fetch(self, job, payload):
+        operation_id, url = payload['operation_id'], payload['url']
+        result = await self.resources.scheduler.fetch_page(url)
+
+        with open('searched_urls.txt', '+a') as f:
+            f.write('\n')
+            f.write(url)
+
+        if not result.text:
+            return {'status': result.status, 'skipped': True}
+        stored = await self.resources.store_snapshot(result)
+
+        payload = {
+            'operation_id': operation_id,
+            'url': url,
+            'fetch': {'content_hash': result.content_hash, 'etag': result.etag, 'last_modified': result.last_modified}
+        }
+        # The chunk job reads the page from its snapshot; the html only goes into the jobs table without one
+        if stored is None:
+            payload['html'] = result.text
+        self.queue.enqueue('chunk', payload, idempotency_key=f'chunk:{operation_id}:{url}', operation_id=operation_id)
+        return {'status': result.status, 'bytes': len(result.text)}
+
+    async def _handle_chunk(self, job, payload):
+        operation_id, url = payload['operation_id'], payload['url']
+        fetch = payload.get('fetch') or {}
+        html = payload.get('html')
+        if html is None:
+            html = await asyncio.to_thread(self.resources.snapshots.get, fetch.get('content_hash'))
+            if html is None:
+                raise RuntimeError(f"Snapshot {fetch.get('content_hash')} of {url} is missing")
+        chunks = await self.resources.chunk_html(html, url)
+        if not chunks:
+            return {'chunks': 0, 'skipped': True}
+
+        next_payload = {'operation_id': operation_id, 'url': url, 'fetch': fetch}
+        # Chunks are passed by reference too, as a content-addressed entry of the snapshot store
+        if self.resources.snapshots is not None:
+            next_payload['chunks_hash'] = await asyncio.to_thread(
+                self.resources.snapshots.put, json.dumps(chunks), None, 'chunks')
+        else:
+            next_payload['chunks'] = chunks
+        self.queue.enqueue('embed', next_payload, idempotency_key=f'embed:{operation_id}:{url}', operation_id=operation_id)
+        return {'chunks': len(chunks)}
+
+    async def _handle_embed(self, job, payload):
+        from vibescraper.page_embedder import PageEmbeddingProcessor
+
+        operation_id, url = payload['operation_id'], payload['url']
+        operation = self._operation(operation_id)
+        query_embedding = self._query_embedding(operation_id)
+        chunks = payload.get('chunks')
+        if chunks is None:
+            stored = await asyncio.to_thread(self.resources.snapshots.get, payload['chunks_hash'], 'chunks')
+            if stored is None:
+                raise RuntimeError(f"Chunks {payload['chunks_hash']} of {url} are missing")
+            chunks = json.loads(stored)
+
+        # A retried embed job reuses the page row it created and replaces its chunks
+        page_id = self.db.find_page_id(operation_id, url)
+        if page_id is None:
+            page_id = await self.db.create('create_page', operation_id, url)
+        else:
+            await self.db.write('delete_page_chunks', page_id)
+
+        processor = PageEmbeddingProcessor(url, operation.search_query, self.db, operation_id,
+                                           page_id=page_id, **operation.settings())
+        await processor.embed_chunks(chunks)
+        results = processor.rank_chunks(query_embedding, k=processor.top_k)
+        await processor.store_results(results, summary=False)
+        await self.db.write('update_page', page_id, fetched_at=datetime.datetime.utcnow(), **(payload.get('fetch') or {}))
+        # The summarize job may run on another worker right away
+        await self.db.flush()
+
+        self.queue.enqueue('summarize', {'operation_id': operation_id, 'page_id': page_id},
+                           idempotency_key=f'summarize:{operation_id}:{url}', operation_id=operation_id)
+        return {'page_id': page_id, 'chunks': len(results)}
+
+    async def _handle_summarize(self, job, payload):
+        from vibescraper.page_embedder import PageEmbeddingProcessor
+
+        operation_id = payload['operation_id']
+        operation = self._operation(operation_id)
+        page = self.db.get_page(payload['page_id'])
+        if page is None:
+            return {'skipped': True}
+
+        processor = PageEmbeddingProcessor.from_stored(page, operation.search_query, self.db, **operation.settings())
+        await processor.summarize(processor.top_results)
+        await self.db.write('update_page_summary', page.id, processor.page_summary)
+        processor.save_to_json()
+        return {'page_id': page.id}
+
+    async def _handle_combine(self, job, payload):
+        from vibescraper.page_embedder import PageEmbeddingProcessor, CombinedResultsProcessor
+
+        operation_id = payload['operation_id']
+        if self.queue.unfinished_count(operation_id, exclude_kinds=('combine',)):
+            raise RetryLater(self.combine_poll)
+
+        operation = self._operation(operation_id)
+        settings = operation.settings()
+        query_embedding = self._query_embedding(operation_id)
+
+        combined_processor = CombinedResultsProcessor(operation.search_query, db_manager=self.db,
+                                                      operation_id=operation_id, **settings)
+        combined_processor.query_embedding = query_embedding
+        for page in self.db.get_operation_pages(operation_id):
+            if page.chunks:
+                combined_processor.add_page_results(PageEmbeddingProcessor.from_stored(
+                    page, operation.search_query, self.db, query_embedding, **settings))
+
+        if combined_processor.page_results:
+            with span('combine', pages=len(combined_processor.page_results)):
+                await combined_processor.process_combined_results()
+            combined_processor.save_to_json()
+        else:
+            print(f"No pages could be processed for: {operation.search_query}")
+        return {'combined_summary': combined_processor.combined_summary, 'pages': len(combined_processor.page_results)}
+
+
+async def run_worker(db_path=None, stages=None, concurrency=4, poll_interval=1.0, lease_seconds=300,
+                     max_attempts=3, exit_when_idle=False, max_concurrent_requests=None, executor=None,
+                     batch_poll_interval=30.0, batch_collect_seconds=60.0):
+    """Run one StageWorker with its own resources until stopped; returns the number of jobs it completed"""
+    resources = SearchResources(db_path=db_path, max_concurrent_pages=concurrency,
+                                max_concurrent_requests=max_concurrent_requests, executor=executor)
+    queue = JobQueue(resources.db, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    broker = BatchBroker(resources.db, poll_interval=batch_poll_interval, collect_seconds=batch_collect_seconds)
+    worker = StageWorker(queue, resources, stages=stages, concurrency=concurrency, poll_interval=poll_interval,
+                         batch_broker=broker)
+    try:
+        return await worker.run(exit_when_idle=exit_when_idle)
+    finally:
+        await resources.aclose()
+
+
+def _worker_process(kwargs):
+    try:
+        asyncio.run(run_worker(**kwargs))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(processes=1, **kwargs):
+    """Run `processes` worker processes (each a run_worker) and wait for them; kwargs go to run_worker"""
+    if processes <= 1:
+        _worker_process(kwargs)
+        return
+
+    import multiprocessing
+
+    workers = [multiprocessing.Process(target=_worker_process, args=(kwargs,), daemon=False) for _ in range(processes)]
+    for process in workers:
+        process.start()
+    try:
+        for process in workers:
+            process.join()
+    except KeyboardInterrupt:
+        for process in workers:
+            process.join()